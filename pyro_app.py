@@ -1,24 +1,230 @@
 """Main web application.
 
 Uses classes DB and Pyramid to build a pyramid game.
+
+create_app() returns the WSGI application; the module level application is the one using the default connection
+pool. Run this module, or pyro_server.py, to serve the game.
 """
 
-import wsgiref.simple_server
+import csv
+import hashlib
+import html
+import io
+import json
 import urllib.parse
 import http.cookies
-from pyro_db_sqlite import DB
+from pyro_changes import bus, game_key, user_key, LOBBY
+from pyro_compress import CompressionMiddleware
+from pyro_db_sqlite import DB, DUMP_TABLES
+from pyro_metrics import MetricsMiddleware, metrics as default_metrics
 from pyro_pyramid import Pyramid
-
-
-def application(e, start_response):
-    db = DB()
-
+from pyro_session import sessions as default_sessions
+from pyro_storage import ConcurrentUpdate
+from pyro_templates import (
+    page, chunks, buffered, Response, HEADER, LOGIN_REGISTER_FORM, LOBBY as LOBBY_PAGE, LOBBY_GAME, LOBBY_GAME_AWAITING,
+    LOBBY_GAME_LINK, LOBBY_REGISTERING_GAME, NEW_GAME_FORM, GAME, GAME_MOVE, GAME_NAME, GAME_NAME_QUIT, GAME_SCORE,
+    GAME_TURN, GAME_MOVE_PLAYED, GAME_MOVE_WINNER, GAME_SCRIPT, HISTORY, HISTORY_GAME, HISTORY_NEXT, LEADERBOARD,
+    LEADERBOARD_ROW, LEADERBOARD_RANK, LEADERBOARD_UNRANKED, DUMP,
+    DUMP_CSV_LINK, DUMP_TABLE, DUMP_TABLE_END, DUMP_HEADING, DUMP_NEXT, DUMP_DESCRIPTIONS, DUMP_ROWS, BUFFER_SIZE
+)
+
+WAIT_TIMEOUT = 25  # seconds a long-poll request waits for a change before the browser asks again
+DUMP_PAGE_SIZE = 1000  # rows per table on one /dump page. Exports are not paged unless a limit is given.
+MAX_GOAL = 200  # most rounds a new game can have
+HISTORY_PAGE_SIZE = 50  # archived games on one /history page
+LEADERBOARD_SIZE = 20  # users on the /leaderboard page, unless top=n asks for up to MAX_LEADERBOARD_SIZE
+MAX_LEADERBOARD_SIZE = 1000
+
+# The paths route() serves, so metrics can be recorded per route
+ROUTES = (
+    '/', '/login_register', '/logout', '/updated_games', '/wait_games', '/newgame', '/join', '/quit', '/game',
+    '/updated_game', '/wait_game', '/history', '/leaderboard', '/dump', '/metrics', '/clear_games', '/clear_all',
+)
+
+
+def wait_for_change(e, db, keys, params):
+    """Long-poll the change bus for the /wait_games and /wait_game endpoints.
+
+    :return: 'changed', 'timeout', or 'unavailable' when the server cannot push
+    """
+    if not e.get('wsgi.multithread'):
+        # Waiting would block every other request on a single-threaded server. The page falls back to polling.
+        return 'unavailable'
+    since = int(params['since'][0])
+    # pyro_server limits the requests waiting at the same time, so they cannot take all of its threads
+    waiters = e.get('pyro.waiters')
+    if waiters is not None and not waiters.acquire(blocking=False):
+        return 'unavailable'
+    try:
+        db.close()  # Do not hold on to a pooled connection while waiting
+        return 'changed' if bus.wait(keys, since, WAIT_TIMEOUT) else 'timeout'
+    finally:
+        if waiters is not None:
+            waiters.release()
+
+
+def make_etag(*parts):
+    """Return a strong ETag for a page that only depends on parts, e.g. the versions of what it shows.
+
+    The versions are only valid within one run of the server, so the epoch of the change bus is part of the tag.
+    """
+    return '"{}"'.format(hashlib.sha1(repr((bus.epoch,) + parts).encode()).hexdigest()[:20])
+
+
+def not_modified(e, etag):
+    """Return True if the If-None-Match header of the request lists etag: the browser has the page already."""
+    if_none_match = e.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def join_chunks(separator, parts):
+    """Yield the byte chunks of every part (see pyro_templates.chunks), with separator in between."""
+    for i, part in enumerate(parts):
+        if i:
+            yield separator.encode()
+        yield from chunks(part)
+
+
+def lobby_games(games, username, app_root):
+    """Yield the rows of the "My games" table on the lobby page."""
+    for game in games:
+        players_scores = ', '.join(
+            [
+                '{}{}|{}{}'.format(
+                    '' if p.playing else '<s>',  # Add open strikethrough tag if player left game
+                    p.name,
+                    p.score,
+                    '' if p.playing else '</s>'  # Add close strikethrough tag
+                ) for p in game.players
+            ]
+        )
+        if game.state == 0:  # Accepting players
+            state = LOBBY_GAME_AWAITING.render(missing=game.num_players - len(game.players))
+            players_scores = ', '.join([p.name for p in game.players])
+        elif game.state == 2:
+            state = LOBBY_GAME_LINK.render(app_root=app_root, id=game.id, text='Game over')
+        elif game.is_players_turn(username):  # Playing, player's turn
+            state = LOBBY_GAME_LINK.render(app_root=app_root, id=game.id, text='My turn')
+        else:  # Playing, not player's turn
+            state = LOBBY_GAME_LINK.render(app_root=app_root, id=game.id, text='Awaiting Turn')
+        yield from LOBBY_GAME.render(id=game.id, goal=game.goal, app_root=app_root, state=state, players=players_scores)
+
+
+def game_turns(game, username):
+    """Yield the rows of the game table on the game page, latest round first."""
+    for index, turn in enumerate(reversed(game.decorated_moves(username))):
+        moves = ((GAME_MOVE_WINNER if winner else GAME_MOVE_PLAYED).render(move=move) for move, winner in turn)
+        yield from GAME_TURN.render(round=game.round - index, moves=moves)
+
+
+def dump_key(table, text):
+    """Turn the key of a row, as written in a /dump link, back into column values."""
+    key, columns = DUMP_TABLES[table]
+    values = text.split(',', len(key) - 1)
+    if len(values) != len(key):
+        raise ValueError('expected {} key values'.format(len(key)))
+    return values if table in ('user', 'user_stats') else [int(value) for value in values]
+
+
+def dump_html(db, tables, after, limit, app_root):
+    """Yield the table sections of the /dump page, with a link to the next page of each table that has more rows."""
+    for table in tables:
+        key, columns = DUMP_TABLES[table]
+        yield from DUMP_TABLE.render(
+            table=table, description=DUMP_DESCRIPTIONS[table], headings=DUMP_HEADING.render_rows([c] for c in columns)
+        )
+        count = 0
+        last_row = None
+        for last_row in db.dump_table(table, after, limit):
+            yield from DUMP_ROWS[table].render(*last_row)
+            count += 1
+        yield DUMP_TABLE_END
+        if limit is not None and count == limit:
+            last_key = ','.join(str(value) for value in last_row[:len(key)])
+            yield from DUMP_NEXT.render(app_root=app_root, table=table, after=urllib.parse.quote(last_key), limit=limit)
+
+
+def dump_ndjson(db, tables, after, limit):
+    """Yield the rows of the tables as JSON objects, one per line, each with the name of its table."""
+    for table in tables:
+        key, columns = DUMP_TABLES[table]
+        for row in db.dump_table(table, after, limit):
+            yield (json.dumps({'table': table, **dict(zip(columns, row))}) + '\n').encode()
+
+
+def dump_csv(db, table, after, limit):
+    """Yield the rows of a table as CSV, headed by the column names."""
+    key, columns = DUMP_TABLES[table]
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for row in db.dump_table(table, after, limit):
+        writer.writerow(row)
+        if text.tell() >= BUFFER_SIZE:
+            yield text.getvalue().encode()
+            text.seek(0)
+            text.truncate()
+    yield text.getvalue().encode()
+
+
+def create_app(pool=None, sessions=None, compress=True, metrics=None):
+    """Return the WSGI application.
+
+    :param pool: Where the games are stored: a pyro_db_sqlite.ConnectionPool, a pyro_db_memory.MemoryStore or
+        anything else whose open() returns a pyro_storage.Storage. The default SQLite pool if None.
+    :param sessions: pyro_session.SessionManager checking the session cookies, the default one if None
+    :param compress: Compress responses for browsers accepting gzip or deflate (see pyro_compress)
+    :param metrics: pyro_metrics.Metrics recording the requests and served at /metrics, the default one if None
+    """
+    if sessions is None:
+        sessions = default_sessions
+    if metrics is None:
+        metrics = default_metrics
+
+    def application(e, start_response):
+        # Borrow a pooled connection for this request. Pages are rendered while the server sends them, so the
+        # connection goes back to the pool when the server closes the response.
+        db = DB() if pool is None else pool.open()
+        try:
+            body = route(e, start_response, db, sessions, metrics)
+        except BaseException:
+            db.close()
+            raise
+        if isinstance(body, list):  # Short reply, already complete
+            db.close()
+            return body
+        return Response(buffered(body), db.close)
+
+    app = application
+    if compress:
+        # Every page starts with the same header, which is compressed once
+        app = CompressionMiddleware(app, fragments=[HEADER])
+    # Outermost, so the time and size of compression count too
+    return MetricsMiddleware(app, ROUTES, metrics)
+
+
+application = create_app()
+
+
+def session_cookie(sessions, username):
+    """Return a Set-Cookie header starting a session for username."""
+    return ('Set-Cookie', 'session={}; Max-Age={:d}; HttpOnly; SameSite=Lax'.format(
+        sessions.issue(username), sessions.lifetime
+    ))
+
+
+def route(e, start_response, db, sessions, metrics):
+    """Build the page for one request using an open DB, SessionManager and Metrics."""
     headers = [('Content-Type', 'text/html; charset=utf-8')]
     app_root = urllib.parse.urlunsplit((e['wsgi.url_scheme'], e['HTTP_HOST'], e['SCRIPT_NAME'], '', ''))
     params = urllib.parse.parse_qs(e['QUERY_STRING'])
     path_info = e['PATH_INFO']
 
     # ----- If user has valid session cookie set session = True --------------------
+    # The cookie holds a signed token, checked in memory (see pyro_session). No SQL is needed.
 
     session = False
     session_user = None
@@ -26,20 +232,8 @@ def application(e, start_response):
     if 'HTTP_COOKIE' in e:
         cookies.load(e['HTTP_COOKIE'])
         if 'session' in cookies:
-            session_user, session_pass = cookies['session'].value.split(':')
-            session = db.user_pass_valid(session_user, session_pass)
-
-    # ----- The common start of every page ---------------------------
-
-    page = '''<!DOCTYPE html>
-<html><head><title>Game</title>
-<style>
-    table { border-collapse: collapse; }
-    table, th, td { border: 1px solid silver; padding: 2px; }
-</style>
-</head>
-<body>
-<h1>Pyromid</h1>'''
+            session_user = sessions.verify(cookies['session'].value)
+            session = session_user is not None
 
     # ----- For logging in and registering ---------------------------
 
@@ -48,43 +242,35 @@ def application(e, start_response):
         param_user = params['username'][0] if 'username' in params else None
         param_pass = params['password'][0] if 'password' in params else None
 
-        login_register_form = '''
-<form>
-    <input type="text" name="username"> Username<br>
-    <input type="password" name="password"> Password<br>
-    <input type="submit" name="do" value="Login"> or
-    <input type="submit" name="do" value="Register">
-</form>'''
-
         if param_do == 'Login' and param_user and param_pass:
             if db.user_pass_valid(param_user, param_pass):
-                headers.append(('Set-Cookie', 'session={}:{}'.format(param_user, param_pass)))
+                headers.append(session_cookie(sessions, param_user))
                 headers.append(('Location', app_root))
                 start_response('303 See Other', headers)
                 return []
             else:
                 start_response('200 OK', headers)
-                page += login_register_form
-                return [(page + 'Wrong username or password</body></html>').encode()]
+                return page(LOGIN_REGISTER_FORM.render(), 'Wrong username or password')
 
         elif param_do == 'Register' and param_user and param_pass:
             if db.add_username(param_user, param_pass):
-                headers.append(('Set-Cookie', 'session={}:{}'.format(param_user, param_pass)))
+                headers.append(session_cookie(sessions, param_user))
                 headers.append(('Location', app_root))
                 start_response('303 See Other', headers)
                 return []
             else:
                 start_response('200 OK', headers)
-                page += login_register_form
-                return [(page + 'Username {} is taken.</body></html>'.format(param_user)).encode()]
+                return page(LOGIN_REGISTER_FORM.render(), 'Username {} is taken.'.format(param_user))
 
         else:
             start_response('200 OK', headers)
-            return [(page + login_register_form + '</body></html>').encode()]
+            return page(LOGIN_REGISTER_FORM.render())
 
     # ----- Logout --------------------------------------------
 
     elif path_info == '/logout':
+        if 'session' in cookies:
+            sessions.revoke(cookies['session'].value)
         headers.append(('Set-Cookie', 'session=0; expires=Thu, 01 Jan 1970 00:00:00 GMT'))
         headers.append(('Location', app_root))
         start_response('303 See Other', headers)
@@ -95,82 +281,33 @@ def application(e, start_response):
     elif path_info == '/' or not path_info:
         if not session:
             start_response('200 OK', headers)
-            page += '<a href="{}/login_register">Log in or register</a> to play</body></html>'.format(app_root)
-            return [page.encode()]
-
-        page += '{} | <a href="{}/logout">Logout</a>'.format(session_user, app_root)
-        page += ' | <a href="{}">Refresh</a>'.format(app_root)
-        page += '<h2>My games</h2>\n'
-        page += '<table><tr><th>Game</th><th>Goal</th><th>Quit</th><th>State</th><th>Players</th></tr>\n'
-        games = [
-            Pyramid(i, p, g, st, ts, t, gp, db.connection) for i, p, g, st, ts, t, gp in db.get_games_by_user(session_user)
-            ]
-        for game in games:
-            page += '<tr><td>{}</td><td>{}</td><td><a href="{}/quit?id={}">quit</a></td>'.format(
-                game.id, game.goal, app_root, game.id
-            )
-            players_scores = ', '.join(
-                [
-                    '{}{}|{}{}'.format(
-                        '' if p['playing'] else '<s>',  # Add open strikethrough tag if player left game
-                        p['name'],
-                        p['score'],
-                        '' if p['playing'] else '</s>'  # Add close strikethrough tag
-                    ) for p in game.players
-                ]
-            )
-            if game.state == 0:  # Accepting players
-                page += '<td>Awaiting {}</td>'.format(game.num_players - len(game.players))
-                page += '<td>' + ', '.join([p['name'] for p in game.players]) + '</td>'
-            elif game.state == 2:
-                page += '<td><a href="{}/game?id={}">Game over</a></td>'.format(app_root, game.id)
-                page += '<td>' + players_scores + '</td>'
-            elif game.is_players_turn(session_user):  # Playing, player's turn
-                page += '<td><a href="{}/game?id={}">My turn</a></td>'.format(app_root, game.id)
-                page += '<td>' + players_scores + '</td>'
-            else:  # Playing, not player's turn
-                page += '<td><a href="{}/game?id={}">Awaiting Turn</a></td>'.format(app_root, game.id)
-                page += '<td>' + players_scores + '</td>'
-            page += '</tr>\n'
-        page += '</table>'
-        page += '<p><a href="{}/newgame">Start a New Game</a></p>'.format(app_root)
-        ts1 = max(game.ts for game in games) if games else None
-
-        page += '<h2>Games accepting players</h2>\n'
-        page += '<table><tr><th>Game</th><th>Goal</th><th>Join</th><th>State</th><th>Players</th></tr>\n'
-        games = [
-            Pyramid(i, p, g, 0, ts, t, gp, db.connection)
-            for i, p, g, ts, t, gp in db.get_registering_games_by_user(session_user)
-            ]
-        for game in games:
-            page += '<tr><td>{}</td><td>{}</td><td><a href="{}/join?id={}">join</a></td>'.format(
-                game.id, game.goal, app_root, game.id
-            )
-            page += '<td>{} of {} players</td>'.format(len(game.players), game.num_players, game.id)
-            page += '<td>' + ', '.join([p['name'] for p in game.players]) + '</td>'
-            page += '</tr>\n'
-        page += '</table>'
-        ts2 = max(game.ts for game in games) if games else None
-
-        page += '''
-<script>
-    function callback(event) {{
-        if (event.target.readyState == 4 && event.target.responseText != '{} {}') {{
-            window.location = '{}'
-        }}
-    }}
-    function timeFunc(event) {{
-        var xmlhttp = new XMLHttpRequest();
-        xmlhttp.addEventListener("readystatechange", callback)
-        xmlhttp.open("GET", "{}/updated_games", true)
-        xmlhttp.setRequestHeader("Content-Type", "text/plain")
-        xmlhttp.send()
-    }}
-    setInterval(timeFunc, 1000)
-</script>'''.format(ts1, ts2, app_root, app_root)
+            return page('<a href="{}/login_register">Log in or register</a> to play'.format(app_root))
+
+        since = bus.sequence()  # Changes after this point make the page reload
+        user_version, lobby_version = db.updated_games(session_user)
+        versions = '{} {} {}'.format(bus.epoch, user_version, lobby_version)
+
+        # The page only changes with the versions, and when pyro_archive moves games off it. Browsers revalidate it
+        # on every view (no-cache), and if they have it already, they get a 304 before any game is loaded.
+        etag = make_etag('lobby', app_root, session_user, user_version, lobby_version, db.archive_version())
+        headers.extend([('ETag', etag), ('Cache-Control', 'no-cache')])
+        if not_modified(e, etag):
+            start_response('304 Not Modified', headers[1:])
+            return []
+
+        games, registering_games = db.get_lobby_games(session_user, Pyramid)
 
         start_response('200 OK', headers)
-        return [(page + '</body></html>').encode()]
+        return page(LOBBY_PAGE.render(
+            user=session_user, app_root=app_root, versions=versions, since=since,
+            games=lobby_games(games, session_user, app_root),
+            registering_games=(
+                LOBBY_REGISTERING_GAME.render(
+                    id=game.id, goal=game.goal, app_root=app_root, joined=len(game.players),
+                    num_players=game.num_players, players=', '.join([p.name for p in game.players])
+                ) for game in registering_games
+            )
+        ))
 
     # ----- Check if game list changed -------------------------------------------
 
@@ -179,10 +316,19 @@ def application(e, start_response):
             start_response('200 OK', headers)
             return ['No session'.encode()]
 
-        ts1, ts2 = db.updated_games(session_user)
+        start_response('200 OK', headers)
+        return ['{} {} {}'.format(bus.epoch, *db.updated_games(session_user)).encode()]
+
+    # ----- Wait until game list changes (long poll) -------------------------------
+
+    elif path_info == '/wait_games':
+        if not session:
+            start_response('200 OK', headers)
+            return ['No session'.encode()]
 
+        reply = wait_for_change(e, db, [LOBBY, user_key(session_user)], params)
         start_response('200 OK', headers)
-        return ['{} {}'.format(ts1, ts2).encode()]
+        return [reply.encode()]
 
     # ----- Register new game ---------------------------------------------------------------
     # ***** MODIFY THIS PART TO ASK FOR NUMBER OF PLAYERS AND RECEIVE NUMBER OF PLAYERS *****
@@ -193,6 +339,9 @@ def application(e, start_response):
             return ['No session'.encode()]
 
         # When submitting a new game, it comes here because "goal" is in the parameters.
+        if 'goal' in params and not (params['goal'][0].isdigit() and 1 <= int(params['goal'][0]) <= MAX_GOAL):
+            start_response('200 OK', headers)
+            return page(NEW_GAME_FORM.render(max_goal=MAX_GOAL), 'Play 1 to {} rounds.'.format(MAX_GOAL))
         if 'goal' in params:
             # numplayers is the parameter that holds the number of players the game creator specified.
             # write the game to the database
@@ -203,25 +352,9 @@ def application(e, start_response):
 
         # Ask for the number of players and the number of rounds.
         # Use a type "number" for the number of players to ensure a number is entered and is at least 2 players.
-        page += '''
-<h2>Create a New Game</h2>
-<form>
-    <h3>How many players?</h3>
-    <input type="number" name="numplayers" min="2">
-    <h3>Play until round:</h3>
-    <input type="radio" name="goal" value="4">4<br>
-    <input type="radio" name="goal" value="5">5<br>
-    <input type="radio" name="goal" value="6">6<br>
-    <input type="radio" name="goal" value="7" checked>7<br>
-    <input type="radio" name="goal" value="8">8<br>
-    <input type="radio" name="goal" value="9">9<br>
-    <br>
-    <input type="submit" value="Create">
-</form>
-</body></html>'''
-
+        # The number of rounds is a number too, since paddle sets are bitmasks of any size.
         start_response('200 OK', headers)
-        return [page.encode()]
+        return page(NEW_GAME_FORM.render(max_goal=MAX_GOAL))
 
     # ----- Join game -----------------------------------------
 
@@ -261,72 +394,65 @@ def application(e, start_response):
         # When refreshing the game page, URL like http://localhost:8000/game?id=1
         game_id = params['id'][0]
 
-        (players, goal, state, ts, turns, gamepaddles) = db.get_game_by_id(game_id)
-        # Instantiate the game object
-        game = Pyramid(game_id, players, goal, state, ts, turns, gamepaddles, db.connection)
+        since = bus.sequence()  # Changes after this point make the page reload
+        game_version = db.updated_game(game_id)
+        version = '{} {}'.format(bus.epoch, game_version)
+
+        # Like the lobby page, the game page only changes with the version of the game. Pages after a move have
+        # their own URL and are always built.
+        etag = None
+        if 'move' not in params:
+            etag = make_etag('game', app_root, session_user, game_id, game_version)
+            if not_modified(e, etag):
+                start_response('304 Not Modified', [('ETag', etag), ('Cache-Control', 'no-cache')])
+                return []
+
+        # Instantiate the game object, from the game cache unless the game changed. Old games are in the archive.
+        game = db.load_game(game_id, Pyramid) or db.load_archived_game(game_id, Pyramid)
+        if game is None:
+            start_response('200 OK', headers)
+            return page('Unknown game')
+        if etag is not None:
+            headers.extend([('ETag', etag), ('Cache-Control', 'no-cache')])
         if game.state == 0:  # Error: cannot view game, it is still registering players
             start_response('200 OK', headers)
-            return [(page + 'Still registering players</body></html>').encode()]
+            return page('Still registering players')
 
         if 'move' in params:  # Player came here by making a move
-            game.add_player_move(session_user, params['move'][0])
+            try:
+                game.add_player_move(session_user, params['move'][0])
+            except ConcurrentUpdate:
+                # Other requests kept changing the game, the move was not saved. Show the game as it is now.
+                headers.append(('Location', '{}/game?id={}'.format(app_root, game.id)))
+                start_response('303 See Other', headers)
+                return []
+            since = bus.sequence()  # Do not reload for our own move
+            version = '{} {}'.format(bus.epoch, db.updated_game(game_id))
             # moves_left.append(move)
 
-        page += '<a href="{}">Home</a>'.format(app_root)
-        page += ' | <a href="{}/game?id={}">Refresh</a>'.format(app_root, game_id)
-        page += '<h3>Game {} -- Playing {} rounds</h3>'.format(game.id, game.goal)
-
         if game.state == 2:
-            page += '<p>Game over</p>'
+            status = '<p>Game over</p>'
         elif game.is_players_turn(session_user):
-            page += '<p>Your move: '
-            move_template = '<a href="{}/game?id={}&amp;move={}">{}</a>'
             move_links = [
-                move_template.format(app_root, game.id, mval, mval) for mval in game.valid_moves(session_user)
-                ]
-            page += ' | '.join(move_links)
+                GAME_MOVE.render(app_root=app_root, id=game.id, move=mval) for mval in game.valid_moves(session_user)
+            ]
+            status = ['<p>Your move: ', join_chunks(' | ', move_links)]
         else:
-            page += '<p>Wait for your turn</p>'
-
-        page += '<table>\n<tr><th>&nbsp;</th>'
-        for p in game.players:
-            page += '<th>{}</th>'.format(p['name']) if p['playing'] else '<th><s>{}</s></th>'.format(p['name'])
-        page += '</tr>\n<tr style="background-color: silver"><td>Round</td>'
-        for p in game.players:
-            page += '<td>{} p</td>'.format(p['score'])
-        page += '</tr>\n'
-
-        for index, turn in enumerate(reversed(game.decorated_moves(session_user))):
-            page += '<tr><td>{}</td>'.format(len(game.turns) - index)
-            for move, winner in turn:
-                if winner:
-                    page += '<td style="background-color:lightgreen">{}</td>'.format(move)
-                else:
-                    page += '<td>{}</td>'.format(move)
-            page += '</tr>\n'
-
-        page += '</table>'
+            status = '<p>Wait for your turn</p>'
 
+        script = ''
         if game.state == 1:
-            page += '''
-<script>
-    function callback(event) {{
-        if (event.target.readyState == 4 && event.target.responseText) {{
-            window.location = '{}/game?id={}'
-        }}
-    }}
-    function timeFunc(event) {{
-        var xmlhttp = new XMLHttpRequest();
-        xmlhttp.addEventListener("readystatechange", callback)
-        xmlhttp.open("GET", "{}/updated_game?id={}", true)
-        xmlhttp.setRequestHeader("Content-Type", "text/plain")
-        xmlhttp.send()
-    }}
-    setInterval(timeFunc, 1000)
-</script>'''.format( app_root, game.id, app_root, game.id)
+            script = GAME_SCRIPT.render(version=version, app_root=app_root, id=game.id, since=since)
 
         start_response('200 OK', headers)
-        return [(page + '</body></html>').encode()]
+        return page(GAME.render(
+            app_root=app_root, id=game.id, goal=game.goal, status=status, script=script,
+            names=(
+                (GAME_NAME if p.playing else GAME_NAME_QUIT).render(name=p.name) for p in game.players
+            ),
+            scores=(GAME_SCORE.render(score=p.score) for p in game.players),
+            turns=game_turns(game, session_user)
+        ))
 
     # ----- Check if game changed --------------------------------------
 
@@ -336,47 +462,114 @@ def application(e, start_response):
             return ['No session'.encode()]
 
         start_response('200 OK', headers)
-        p, g, s, ts, t, gp = db.get_game_by_id(params['id'][0])
-        return ['{}'.format(ts).encode()]
+        return ['{} {}'.format(bus.epoch, db.updated_game(params['id'][0])).encode()]
+
+    # ----- Wait until game changes (long poll) ------------------------------
+
+    elif path_info == '/wait_game':
+        if not session:
+            start_response('200 OK', headers)
+            return ['No session'.encode()]
+
+        reply = wait_for_change(e, db, [game_key(params['id'][0])], params)
+        start_response('200 OK', headers)
+        return [reply.encode()]
+
+    # ----- Archived games of the user ------------------------------------------
+
+    # Newest first, HISTORY_PAGE_SIZE games per page. before=id continues with the games older than that one.
+    elif path_info == '/history':
+        if not session:
+            start_response('200 OK', headers)
+            return page('<a href="{}/login_register">Log in or register</a> to play'.format(app_root))
+
+        before = int(params['before'][0]) if 'before' in params and params['before'][0].isdigit() else None
+        games = db.get_archived_games_by_user(session_user, before, HISTORY_PAGE_SIZE)
+        more = len(games) == HISTORY_PAGE_SIZE
+
+        start_response('200 OK', headers)
+        return page(HISTORY.render(
+            app_root=app_root,
+            games=(
+                HISTORY_GAME.render(
+                    app_root=app_root, id=game_id, goal=goal, ts=ts,
+                    players=', '.join('{}|{}'.format(p.name, p.score) for p in players)
+                ) for game_id, goal, ts, players in games
+            ),
+            next=HISTORY_NEXT.render(app_root=app_root, before=games[-1][0]) if more else ''
+        ))
+
+    # ----- Leaderboard ------------------------------------------------
+
+    # The best users, and the rank of the user named by user=name, or of the logged in user. top=n shows n users.
+    elif path_info == '/leaderboard':
+        limit = LEADERBOARD_SIZE
+        if 'top' in params and params['top'][0].isdigit():
+            limit = max(1, min(int(params['top'][0]), MAX_LEADERBOARD_SIZE))
+        username = params['user'][0] if 'user' in params else session_user
+        rank = ''
+        if username is not None:
+            stats = db.get_user_rank(username)
+            if stats is None:
+                rank = LEADERBOARD_UNRANKED.render(user=html.escape(username))
+            else:
+                user_rank, games, wins, points = stats
+                rank = LEADERBOARD_RANK.render(
+                    user=html.escape(username), rank=user_rank, games=games, wins=wins, points=points
+                )
+
+        start_response('200 OK', headers)
+        return page(LEADERBOARD.render(
+            app_root=app_root, rank=rank, rows=LEADERBOARD_ROW.render_rows(db.get_leaderboard(limit))
+        ))
 
     # ----- Dump tables ------------------------------------------------
 
+    # All tables as an HTML page (default), or format=ndjson / format=csv for export. table=name picks one table,
+    # limit=n shows n rows per table, after=key continues after the row with that key.
     elif path_info == '/dump':
-        users, games, players = db.dump()
-
-        page += '<a href="{}">Home</a>'.format(app_root)
-        page += ' | <a href="{}/clear_games">Clear games and players</a>'.format(app_root)
-        page += ' | <a href="{}/clear_all">Clear all</a>'.format(app_root)
-
-        page += '<h2>Table "user"</h2>\n'
-        page += '<p>Contains all registered users and their passwords.</p>\n'
-        page += '<table><tr><th>name</th><th>password</th></tr>\n'
-        for name, password in users:
-            page += '<tr><td>{}</td><td>{}</td></tr>\n'.format(name, password)
-        page += '</table>\n'
-
-        page += '<h2>Table "game"</h2>\n'
-        page += '<p>One row for every game.</p>\n'
-        page += '<table><tr><th>rowid</th><th>players</th><th>goal</th><th>state</th><th>ts</th><th>turns</th><th>gamepaddles</th></tr>\n'
-        for rowid, numplayers, goal, state, ts, turns, gamepaddles in games:
-            page += '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n'.format(
-                rowid, numplayers, goal, state, ts, turns, gamepaddles
-            )
-        page += '</table>\n'
-
-        page += '<h2>Table "player"</h2>\n'
-        page += '<p>Connects players with games. One row for every player in a game.</p>\n'
-        page += '<table><tr><th>rowid</th><th>game_id</th><th>user_name</th><th>score</th><th>playing</th><th>paddles</th></tr>\n'
-        for rowid, game_id, user_name, score, playing, paddles in players:
-            page += '<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n'.format(
-                rowid, game_id, user_name, score, playing, paddles
-            )
-        page += '</table>\n'
-
-        page += '</body></html>'
+        dump_format = params['format'][0] if 'format' in params else 'html'
+        tables = params['table'] if 'table' in params else list(DUMP_TABLES)
+        if dump_format not in ('html', 'ndjson', 'csv') or [t for t in tables if t not in DUMP_TABLES]:
+            start_response('200 OK', headers)
+            return page('Unknown table or format')
+        if dump_format == 'csv' and len(tables) != 1:
+            start_response('200 OK', headers)
+            return page('Choose one table to export as CSV')
+
+        limit = DUMP_PAGE_SIZE if dump_format == 'html' else None
+        if 'limit' in params and params['limit'][0].isdigit():
+            limit = max(1, int(params['limit'][0]))
+        # A key only makes sense for a single table
+        try:
+            after = dump_key(tables[0], params['after'][0]) if 'after' in params and len(tables) == 1 else None
+        except ValueError:
+            start_response('200 OK', headers)
+            return page('Unknown key to continue after')
+
+        if dump_format == 'ndjson':
+            start_response('200 OK', [('Content-Type', 'application/x-ndjson; charset=utf-8')])
+            return dump_ndjson(db, tables, after, limit)
+        if dump_format == 'csv':
+            start_response('200 OK', [
+                ('Content-Type', 'text/csv; charset=utf-8'),
+                ('Content-Disposition', 'attachment; filename="{}.csv"'.format(tables[0]))
+            ])
+            return dump_csv(db, tables[0], after, limit)
 
         start_response('200 OK', headers)
-        return [page.encode()]
+        return page(DUMP.render(
+            app_root=app_root, csv_links=(DUMP_CSV_LINK.render(app_root=app_root, table=t) for t in DUMP_TABLES),
+            tables=dump_html(db, tables, after, limit, app_root)
+        ))
+
+    # ----- Metrics ------------------------------------------------
+
+    # Request and SQL metrics in Prometheus text format, see pyro_metrics
+    elif path_info == '/metrics':
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+        return [metrics.render().encode()]
+
     # ----- Clear tables --------------------------------------
 
     elif path_info == '/clear_games':
@@ -387,6 +580,7 @@ def application(e, start_response):
 
     elif path_info == '/clear_all':
         db.clear_tables(True)
+        sessions.revoke_all()  # The users are gone
         headers.append(('Location', '{}/dump'.format(app_root)))
         start_response('303 See Other', headers)
         return []
@@ -395,7 +589,9 @@ def application(e, start_response):
 
     else:
         start_response('200 OK', headers)
-        return [(page + 'Unknown Web app {}</body></html>'.format(path_info)).encode()]
+        return page('Unknown Web app {}'.format(path_info))
+
 
-httpd = wsgiref.simple_server.make_server('', 8000, application)
-httpd.serve_forever()
+if __name__ == '__main__':
+    import pyro_server
+    pyro_server.main(create_app)
@@ -0,0 +1,65 @@
+"""
+Archival of finished games.
+
+Finished games stay in the game, player and move tables, which the lobby pages and /dump read, until this job moves
+them to the archive tables (see pyro_db_sqlite_migrate). Games over for more than --days days are moved a batch at
+a time, each batch in its own short transaction, so the server keeps serving while the job runs. Run it regularly,
+e.g. daily from cron: every run only moves the games that became due since the last one.
+
+Archived games drop off the lobby, but can still be viewed: /game?id=N shows them, and /history lists the old games
+of the user. Every batch bumps the archive version in the database, which is part of the lobby ETag, so loading the
+lobby again shows the games gone. Lobby pages left open keep listing them until their next change: they poll the
+change bus, which does not reach a job running in a process of its own.
+
+    python pyro_archive.py [--days N] [--batch N] [--pause SECONDS] [database]
+"""
+
+import argparse
+import time
+
+from pyro_db_sqlite import ConnectionPool, DB_PATH
+
+ARCHIVE_DAYS = 30  # days after the end of a game it is archived
+BATCH_SIZE = 500   # games archived in one transaction
+PAUSE = 0.1        # seconds between two batches, so the server's writes do not wait long for the lock
+
+
+def cutoff(days):
+    """Return the time days days ago, in UTC like the ts of a game."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 24 * 60 * 60))
+
+
+def archive(db, days=ARCHIVE_DAYS, batch_size=BATCH_SIZE, pause=PAUSE):
+    """Archive every game over for more than days days.
+
+    :param db: pyro_storage.Storage to archive in
+    :return: The number of games archived
+    """
+    before = cutoff(days)
+    total = 0
+    while True:
+        count = db.archive_games(before, batch_size)
+        total += count
+        if count < batch_size:
+            return total
+        time.sleep(pause)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Move finished games to the archive tables.')
+    parser.add_argument('--days', type=float, default=ARCHIVE_DAYS, help='archive games over for this many days')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='games archived in one transaction')
+    parser.add_argument('--pause', type=float, default=PAUSE, help='seconds to wait between batches')
+    parser.add_argument('database', nargs='?', default=DB_PATH)
+    options = parser.parse_args(args)
+
+    pool = ConnectionPool(options.database)
+    started = time.perf_counter()
+    with pool.open() as db:
+        total = archive(db, options.days, options.batch, options.pause)
+    pool.close_all()
+    print('{} games archived in {:.1f} s'.format(total, time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Batch round scoring with NumPy.
+
+score_rounds() scores a whole array of rounds at once, for offline analysis of stored games and for simulations,
+where scoring rounds one by one with pyro_pyramid.score_round() is too slow. It applies the same rules, and
+check_against_scalar() confirms that both give the same points.
+
+The paddles played are an integer array of shape (games, rounds, players). A 0 marks a paddle not played. Rounds
+with a 0 are incomplete and score nothing, so games with fewer rounds can be padded with zeros to share an array.
+
+NumPy is only needed by this module, not by the game:
+
+    pip install numpy
+    python pyro_batch.py [--games N] [--goal ROUNDS] [--players N] [--seed N]
+    python pyro_batch.py --database pyro_game.db
+"""
+
+import argparse
+import sqlite3
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyro_db_sqlite_migrate import migrate
+from pyro_pyramid import score_round
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('pyro_batch needs NumPy, install it with: pip install numpy')
+
+
+def score_rounds(paddles):
+    """Score every round of many games.
+
+    :param paddles: Array of shape (games, rounds, players) with the paddle every player played, 0 if none
+    :return: (winners, points, scores), each an array of shape (games, rounds, players): winners is True for the
+        players who played the highest paddle of a complete round, points are the points of each round, and scores
+        the total points after each round, so scores[:, -1] are the final scores
+    """
+    _require_numpy()
+    paddles = numpy.asarray(paddles)
+    complete = (paddles > 0).all(axis=2, keepdims=True)
+    winners = (paddles == paddles.max(axis=2, keepdims=True)) & complete
+    shared = winners.sum(axis=2, keepdims=True) > 1
+    points = numpy.where(winners, numpy.where(shared, 1, 2), 0).astype(numpy.int8)
+    scores = points.cumsum(axis=1, dtype=numpy.int64)
+    return winners, points, scores
+
+
+def score_rounds_scalar(paddles):
+    """Score the same rounds as score_rounds(), one by one with pyro_pyramid.score_round().
+
+    :return: Nested lists of points, shaped like paddles
+    """
+    return [
+        [score_round(turn) if all(turn) else [0] * len(turn) for turn in (list(map(int, turn)) for turn in game)]
+        for game in paddles
+    ]
+
+
+def check_against_scalar(paddles):
+    """Score paddles both ways.
+
+    :return: List of (game, round) positions where score_rounds() and score_rounds_scalar() disagree
+    """
+    _, points, _ = score_rounds(paddles)
+    expected = numpy.array(score_rounds_scalar(paddles), dtype=numpy.int8).reshape(points.shape)
+    return [tuple(int(i) for i in position) for position in numpy.argwhere((points != expected).any(axis=2))]
+
+
+def random_games(games, goal, players, seed=0):
+    """Return the paddles of games where every player plays paddles 1 to goal in random order."""
+    _require_numpy()
+    rng = numpy.random.default_rng(seed)
+    decks = numpy.broadcast_to(numpy.arange(1, goal + 1, dtype=numpy.int32), (games, players, goal))
+    return rng.permuted(decks, axis=2).transpose(0, 2, 1)
+
+
+def load_games(connection):
+    """Load the moves of every started game from the database, archived games included.
+
+    Games are grouped by their number of players. Games of one group are padded with zeros to the same number of
+    rounds.
+
+    :param connection: sqlite3 connection to the game database
+    :return: {number of players: (array of game ids, paddles array of shape (games, rounds, players))}
+    """
+    _require_numpy()
+    games = connection.execute(
+        'SELECT rowid, players, round FROM game WHERE round > 0 '
+        'UNION ALL SELECT game_id, players, round FROM archived_game WHERE round > 0 ORDER BY 1'
+    ).fetchall()
+    groups = {}
+    positions = {}  # game id -> (group, index in group)
+    for game_id, num_players, rounds in games:
+        ids, max_rounds = groups.setdefault(num_players, ([], 0))
+        positions[game_id] = (num_players, len(ids))
+        ids.append(game_id)
+        groups[num_players] = (ids, max(max_rounds, rounds))
+
+    arrays = {
+        num_players: (numpy.array(ids), numpy.zeros((len(ids), rounds, num_players), dtype=numpy.int32))
+        for num_players, (ids, rounds) in groups.items()
+    }
+    for game_id, round_number, player, paddle in connection.execute(
+        'SELECT game_id, round, player, paddle FROM move '
+        'UNION ALL SELECT game_id, round, player, paddle FROM archived_move'
+    ):
+        if game_id in positions:
+            num_players, index = positions[game_id]
+            arrays[num_players][1][index, round_number - 1, player] = paddle
+    return arrays
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Score Pyramid rounds in batches and check them against the game.')
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--goal', type=int, default=7, help='rounds per game')
+    parser.add_argument('--players', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='score the games stored in this database instead of random games')
+    options = parser.parse_args(args)
+    _require_numpy()
+
+    if options.database:
+        connection = sqlite3.connect(options.database)
+        migrate(connection)
+        stored_scores = {}  # game id -> score of every player, in player order
+        for sql in ('SELECT game_id, score FROM player ORDER BY rowid',
+                    'SELECT game_id, score FROM archived_player ORDER BY game_id, position'):
+            for game_id, score in connection.execute(sql):
+                stored_scores.setdefault(game_id, []).append(score)
+        for num_players, (game_ids, paddles) in sorted(load_games(connection).items()):
+            _, _, scores = score_rounds(paddles)
+            mismatches = check_against_scalar(paddles)
+            differing = sum(
+                1 for game_id, final in zip(game_ids, scores[:, -1]) if final.tolist() != stored_scores.get(game_id)
+            )
+            print('{} games of {} players: {} rounds scored differently by the scalar rules, '
+                  '{} games with other scores stored'.format(len(game_ids), num_players, len(mismatches), differing))
+        connection.close()
+        return
+
+    paddles = random_games(options.games, options.goal, options.players, options.seed)
+    started = time.perf_counter()
+    score_rounds(paddles)
+    vectorized = time.perf_counter() - started
+    started = time.perf_counter()
+    score_rounds_scalar(paddles)
+    scalar = time.perf_counter() - started
+    rounds = options.games * options.goal
+    print('{} rounds: NumPy {:.3f} s ({:.0f} rounds/s), scalar {:.3f} s ({:.0f} rounds/s)'.format(
+        rounds, vectorized, rounds / vectorized, scalar, rounds / scalar
+    ))
+    mismatches = check_against_scalar(paddles)
+    print('{} rounds scored differently by the scalar rules'.format(len(mismatches)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Endpoint benchmarks.
+
+Drives the WSGI application in-process, with environ dicts instead of HTTP, against a freshly seeded database in a
+temporary directory. Every endpoint is requested a number of times and timed from calling the application until
+the response body is consumed and closed. SQL statements are counted with a trace callback on every pooled
+connection. With --memory the games are stored in a pyro_db_memory.MemoryStore instead, which runs no SQL, so the
+results show the time spent outside the database.
+
+The results are printed and saved as JSON, so a run can be compared with an earlier one:
+
+    python pyro_bench.py [--iterations N] [--users N] [--games N] [--gzip] [--memory] [--output FILE]
+        [--compare OLD_FILE]
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import time
+
+from pyro_app import create_app
+from pyro_db_memory import MemoryStore
+from pyro_db_sqlite import ConnectionPool
+from pyro_metrics import count_query
+from pyro_pyramid import Pyramid
+from pyro_session import SessionManager
+
+PERCENTILES = (50, 95, 99)
+GOAL = 7  # rounds of the seeded games
+
+
+class CountingPool(ConnectionPool):
+    """Connection pool counting the SQL queries run on its connections."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = 0
+
+    def connect(self):
+        connection = super().connect()
+        connection.set_trace_callback(self._count)
+        return connection
+
+    def _count(self, statement):
+        count_query(statement)  # Replaces the pool's own trace callback
+        if statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')):
+            self.queries += 1
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * percent // 100))  # ceil
+    return sorted_values[int(rank) - 1]
+
+
+def seed(pool, users, games):
+    """Fill the database with users and games in every state.
+
+    :return: (user names, ids of started games with their players)
+    """
+    names = ['user{}'.format(i) for i in range(users)]
+    started = []
+    with pool.open() as db:
+        for name in names:
+            db.add_username(name, 'pw')
+        for i in range(games):
+            a, b = names[i % users], names[(i + 1) % users]
+            db.new_game(2, GOAL, a)
+            if i % 4 == 0:
+                continue  # Leave a quarter of the games accepting players
+            (game_id, *_), *_ = db.get_games_by_user(a)[-1:]
+            db.join_game(game_id, b)
+            started.append((game_id, a, b))
+            # Play the games partway, some of them to the end
+            for paddle in range(1, 1 + i % (GOAL + 1)):
+                for name in (a, b):
+                    db.load_game(game_id, Pyramid).add_player_move(name, str(paddle))
+    return names, started
+
+
+class Bench:
+    """Sends requests to the application and records their latency and query counts."""
+    def __init__(self, app, pool, sessions, gzip=False):
+        self.app = app
+        self.pool = pool
+        self.sessions = sessions
+        self.gzip = gzip
+        self.tokens = {}
+        self.results = {}
+
+    def request(self, endpoint, path, query='', user=None):
+        e = {
+            'REQUEST_METHOD': 'GET', 'wsgi.url_scheme': 'http', 'HTTP_HOST': 'localhost:8000', 'SCRIPT_NAME': '',
+            'PATH_INFO': path, 'QUERY_STRING': query, 'wsgi.input': io.BytesIO(), 'wsgi.multithread': False,
+        }
+        if user is not None:
+            if user not in self.tokens:
+                self.tokens[user] = self.sessions.issue(user)
+            e['HTTP_COOKIE'] = 'session=' + self.tokens[user]
+        if self.gzip:
+            e['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            return lambda data: None
+
+        queries = getattr(self.pool, 'queries', 0)
+        started = time.perf_counter()
+        body = self.app(e, start_response)
+        try:
+            size = sum(len(data) for data in body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        seconds = time.perf_counter() - started
+
+        result = self.results.setdefault(endpoint, {'seconds': [], 'queries': 0, 'bytes': 0, 'errors': 0})
+        result['seconds'].append(seconds)
+        result['queries'] += getattr(self.pool, 'queries', 0) - queries
+        result['bytes'] += size
+        if response['status'][0] not in '23':
+            result['errors'] += 1
+
+    def summary(self):
+        """Return {endpoint: statistics} for all requests sent."""
+        summary = {}
+        for endpoint, result in self.results.items():
+            seconds = sorted(result['seconds'])
+            count = len(seconds)
+            summary[endpoint] = {
+                'requests': count,
+                'mean_ms': sum(seconds) / count * 1000,
+                **{'p{}_ms'.format(p): percentile(seconds, p) * 1000 for p in PERCENTILES},
+                'queries_per_request': result['queries'] / count,
+                'bytes_per_request': result['bytes'] / count,
+                'errors': result['errors'],
+            }
+        return summary
+
+
+def run(iterations, users, games, gzip=False, memory=False):
+    """Seed a database and benchmark every endpoint.
+
+    :param memory: Store the games in memory (pyro_db_memory) instead of SQLite
+
+    :return: {endpoint: statistics}, see Bench.summary()
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        pool = MemoryStore() if memory else CountingPool(os.path.join(directory, 'bench.db'))
+        sessions = SessionManager()
+        names, started = seed(pool, users, games)
+        bench = Bench(create_app(pool, sessions), pool, sessions, gzip)
+
+        for i in range(iterations):
+            bench.request('login', '/login_register', 'do=Login&username={}&password=pw'.format(names[i % users]))
+        for i in range(iterations):
+            bench.request('lobby', '/', user=names[i % users])
+        for i in range(iterations):
+            bench.request('updated_games', '/updated_games', user=names[i % users])
+        for i in range(iterations):
+            game_id, a, b = started[i % len(started)]
+            bench.request('game', '/game', 'id={}'.format(game_id), user=(a, b)[i % 2])
+
+        for i in range(iterations):
+            bench.request('newgame', '/newgame', 'numplayers=2&goal={}'.format(GOAL), user=names[i % users])
+        with pool.open() as db:
+            registering = sorted(
+                (game_id, name) for name in names for game_id, _, _, state, *_ in db.get_games_by_user(name)
+                if state == 0
+            )
+        for i, (game_id, creator) in enumerate(registering[:iterations]):
+            joiner = names[(names.index(creator) + 1 + i % (users - 1)) % users]
+            bench.request('join', '/join', 'id={}'.format(game_id), user=joiner)
+
+        # Moves: play new two player games from the start, taking turns
+        with pool.open() as db:
+            move_games = []
+            for i in range(-(-iterations // (2 * GOAL))):
+                a, b = names[i % users], names[(i + 1) % users]
+                db.new_game(2, GOAL, a)
+                (game_id, *_), *_ = db.get_games_by_user(a)[-1:]
+                db.join_game(game_id, b)
+                move_games.append((game_id, a, b))
+        moves = [
+            (game_id, name, paddle) for game_id, a, b in move_games for paddle in range(1, GOAL + 1) for name in (a, b)
+        ]
+        for game_id, name, paddle in moves[:iterations]:
+            bench.request('game_move', '/game', 'id={}&move={}'.format(game_id, paddle), user=name)
+
+        for i in range(max(1, iterations // 10)):
+            bench.request('dump', '/dump')
+
+        pool.close_all()
+        return bench.summary()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the game endpoints in-process.')
+    parser.add_argument('--iterations', type=int, default=200, help='requests per endpoint (/dump gets a tenth)')
+    parser.add_argument('--users', type=int, default=50, help='users in the seeded database')
+    parser.add_argument('--games', type=int, default=200, help='games in the seeded database')
+    parser.add_argument('--gzip', action='store_true', help='send Accept-Encoding: gzip')
+    parser.add_argument('--memory', action='store_true', help='store the games in memory instead of SQLite')
+    parser.add_argument('--output', help='JSON file for the results (default: pyro_bench_<time>.json)')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    options = parser.parse_args(args)
+
+    created = datetime.datetime.now()
+    endpoints = run(options.iterations, options.users, options.games, options.gzip, options.memory)
+    previous = {}
+    if options.compare:
+        with open(options.compare) as file:
+            previous = json.load(file)['endpoints']
+
+    print('{:<14} {:>8} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+        'endpoint', 'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'p50 old'
+    ))
+    for endpoint, stats in endpoints.items():
+        old = previous.get(endpoint)
+        print('{:<14} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.2f} {:>8}'.format(
+            endpoint, stats['requests'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['queries_per_request'], '{:+.0%}'.format(stats['p50_ms'] / old['p50_ms'] - 1) if old else ''
+        ))
+
+    output = options.output or 'pyro_bench_{:%Y%m%d_%H%M%S}.json'.format(created)
+    with open(output, 'w') as file:
+        json.dump({
+            'created': created.isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'options': {name: value for name, value in vars(options).items() if name not in ('output', 'compare')},
+            'endpoints': endpoints,
+        }, file, indent=2)
+    print('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
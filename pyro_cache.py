@@ -0,0 +1,88 @@
+"""
+In-memory cache of game state.
+
+A game page is refreshed whenever the game changes, by every player in the game. The cache keeps the state of
+recently viewed games as snapshots, so DB.load_game() can build a game object without reading the database.
+
+Each snapshot is stored with the version of its game on the change bus (see pyro_changes). A snapshot is only
+returned while the game still has that version, so a change published by any writer makes it stale at once.
+The writes in pyro_db_sqlite store the new state of the game right after publishing the change (write-through),
+so the next page view is a cache hit again. Its size is set by pyro_db_sqlite.GAME_CACHE_BYTES.
+
+A snapshot is an immutable tuple:
+
+    (num_players, goal, state, ts, round, gamepaddles, row_version, players, turns)
+
+row_version is the version column of the game row. players holds a (name, score, playing, paddles) tuple for every
+player, turns a tuple of paddles for every round.
+"""
+
+import collections
+import sys
+import threading
+
+
+def snapshot_size(snapshot):
+    """Estimate the memory used by a snapshot in bytes."""
+    size = 0
+    stack = [snapshot]
+    while stack:
+        value = stack.pop()
+        size += sys.getsizeof(value)
+        if isinstance(value, tuple):
+            stack.extend(value)
+    return size
+
+
+class GameCache:
+    """LRU cache of game snapshots, keyed by game id and version, holding about max_bytes of snapshots."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0  # estimated bytes of all snapshots
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._games = collections.OrderedDict()  # game id -> (version, snapshot, size), least recently used first
+
+    def get(self, game_id, version):
+        """Return the snapshot of the game at version, or None."""
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._games.move_to_end(game_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, game_id, version, snapshot):
+        """Store the snapshot of the game at version, unless a newer version is cached already."""
+        size = snapshot_size(snapshot)
+        with self._lock:
+            entry = self._games.get(game_id)
+            if entry is not None:
+                if entry[0] > version:
+                    return
+                self.size -= entry[2]
+            self._games[game_id] = (version, snapshot, size)
+            self._games.move_to_end(game_id)
+            self.size += size
+            while self.size > self.max_bytes and self._games:
+                _, (_, _, evicted_size) = self._games.popitem(last=False)
+                self.size -= evicted_size
+
+    def __contains__(self, game_id):
+        return game_id in self._games
+
+    def discard(self, game_id):
+        """Forget the game."""
+        with self._lock:
+            entry = self._games.pop(game_id, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def clear(self):
+        """Forget every game."""
+        with self._lock:
+            self._games.clear()
+            self.size = 0
@@ -0,0 +1,177 @@
+"""
+In-process change notifications.
+
+Write paths in pyro_db_sqlite publish the keys of what they changed: a game, the users whose lobby shows that game,
+or the list of games accepting players. The long-poll endpoints in pyro_app wait on the keys a page shows, so an idle
+browser tab costs nothing until something it displays actually changes.
+
+Every publish() gets the next number of a process wide sequence. A page remembers the sequence number current when
+it was built and asks to be woken up when one of its keys has been published after that.
+
+The sequence number of a key's latest change doubles as the version of that key. Versions live in memory only, so
+the polling endpoints answer without SQL, and unlike the one-second ts column they never miss a change. Versions
+start over when the process restarts; the epoch tells versions of different runs apart.
+
+When pyro_server runs several worker processes, their buses are joined with share(): sequence numbers come from a
+counter shared by all processes, and every change is passed on to the other processes through the supervisor, which
+forked them all and so gave them the same epoch. The same way, broadcast() passes other messages, e.g. revoked
+sessions, on to the functions listening to them in the other processes.
+"""
+
+import json
+import os
+import threading
+
+# Key for the list of games accepting players, shown on everybody's lobby page
+LOBBY = 'lobby'
+
+
+def game_key(game_id):
+    """Key for changes to one game."""
+    return 'game:{}'.format(int(game_id))
+
+
+def user_key(username):
+    """Key for changes to the games listed on one user's lobby page."""
+    return 'user:{}'.format(username)
+
+
+class ChangeBus:
+    """Sequence numbered change notifications that threads can wait on."""
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._changed = {}  # key -> sequence number of its latest change
+        self._all_changed = 0  # sequence number of the latest change to every key
+        self.epoch = os.urandom(4).hex()
+        self._counter = None  # sequence number shared with other processes, see share()
+        self._connection = None
+        self._send_lock = threading.Lock()
+        self._listeners = {}  # topic -> functions called with the data of the messages broadcast by other processes
+
+    def sequence(self):
+        """Return the sequence number of the latest change."""
+        return self._sequence
+
+    def version(self, key):
+        """Return the version of key: the sequence number of its latest change, 0 if it never changed."""
+        return max(self._changed.get(key, 0), self._all_changed)
+
+    def publish(self, *keys):
+        """Record a change to keys and wake up everybody waiting.
+
+        :return: The sequence number of the change, the new version of keys
+        """
+        with self._condition:
+            sequence = self._next_sequence()
+            self._record(sequence, keys)
+        self._send(sequence, keys)  # Other processes apply changes in any order
+        return sequence
+
+    def publish_from(self, version, key, *keys):
+        """Record a change to key, and to keys, that was made to key as it was at version.
+
+        :return: The new version of key, or None if key changed after version, i.e. the change was made on top of
+            somebody else's change the caller did not see
+        """
+        keys = (key,) + keys
+        with self._condition:
+            current = self.version(key) == version
+            sequence = self._next_sequence()
+            self._record(sequence, keys)
+        self._send(sequence, keys)  # Not holding the condition, which the thread receiving changes needs
+        return sequence if current else None
+
+    def publish_all(self):
+        """Record a change to every key, e.g. after the tables were cleared."""
+        with self._condition:
+            sequence = self._next_sequence()
+            self._record(sequence, None)
+        self._send(sequence, None)
+
+    def changed_since(self, keys, since):
+        """Return True if any of keys changed after sequence number since."""
+        return any(self.version(key) > since for key in keys)
+
+    def wait(self, keys, since, timeout):
+        """Block until one of keys changes after sequence number since, or timeout seconds pass.
+
+        :return: True if a key changed, False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.changed_since(keys, since), timeout)
+
+    # ----- Sharing changes with other processes ---------------------------
+
+    def listen(self, topic, function):
+        """Call function with the data of every message on topic that another process broadcasts."""
+        self._listeners.setdefault(topic, []).append(function)
+
+    def broadcast(self, topic, data):
+        """Send a message on topic to the listeners in the other processes sharing changes, if any.
+
+        :param data: Anything json can encode
+        """
+        self._write({'topic': topic, 'data': data})
+
+    def share(self, counter, connection, on_disconnect=None):
+        """Share changes with other processes.
+
+        :param counter: multiprocessing.Value holding the latest sequence number of all processes
+        :param connection: Socket that changes published here are sent to, and changes of the other processes are
+            received from, one JSON line each
+        :param on_disconnect: Function called when the other end closes the connection
+        """
+        with self._condition:
+            self._counter = counter
+            self._connection = connection
+            self._sequence = max(self._sequence, counter.value)
+        threading.Thread(target=self._receive, args=(on_disconnect,), daemon=True).start()
+
+    def _receive(self, on_disconnect):
+        for message in self._connection.makefile('rb'):
+            self.receive(message)
+        if on_disconnect is not None:
+            on_disconnect()
+
+    def receive(self, message):
+        """Record a change published by another process, or pass on a message it broadcast, as sent to the shared
+        connection."""
+        message = json.loads(message)
+        if isinstance(message, dict):
+            for function in self._listeners.get(message['topic'], ()):
+                function(message['data'])
+            return
+        sequence, keys = message
+        with self._condition:
+            self._record(sequence, keys)
+
+    def _record(self, sequence, keys):
+        # Call with the condition held. Changes from other processes can arrive out of order, so keep the highest.
+        self._sequence = max(self._sequence, sequence)
+        if keys is None:
+            self._all_changed = max(self._all_changed, sequence)
+        else:
+            for key in keys:
+                self._changed[key] = max(self._changed.get(key, 0), sequence)
+        self._condition.notify_all()
+
+    def _next_sequence(self):
+        # Call with the condition held
+        if self._counter is None:
+            return self._sequence + 1
+        with self._counter.get_lock():
+            self._counter.value += 1
+            return self._counter.value
+
+    def _send(self, sequence, keys):
+        self._write([sequence, keys])
+
+    def _write(self, message):
+        if self._connection is not None:
+            with self._send_lock:
+                self._connection.sendall(json.dumps(message).encode() + b'\n')
+
+
+# The bus shared by the whole process
+bus = ChangeBus()
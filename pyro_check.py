@@ -0,0 +1,377 @@
+"""
+Consistency checks under concurrency.
+
+moves: one thread per player plays all games of a fresh database at the same time, every move on a connection of
+its own. Moves to the same game conflict and are saved again on the new state (see Pyramid.add_player_move). Every
+game must end with all rounds complete, the scores the rules give for them, and no paddles left. The leaderboard
+must count every game exactly once. With --memory the games are stored in a pyro_db_memory.MemoryStore instead of
+SQLite.
+
+workers: starts pyro_server.py --workers N in a scratch directory and plays the same games over HTTP, while the
+workers are replaced with SIGHUP and one of them is killed. The workers must agree on the versions of a game, wake
+up long polls for changes made by other workers, reject a session logged out on another worker, and stop without
+errors. The games are checked as for moves.
+
+    python pyro_check.py moves [--memory] [--games N] [--goal ROUNDS] [--players N] [--seed N]
+    python pyro_check.py workers [--workers N] [--games N] [--goal ROUNDS] [--players N] [--seed N]
+
+Exits with status 1 if a check finds problems.
+"""
+
+import argparse
+import http.client
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from pyro_db_memory import MemoryStore
+from pyro_db_sqlite import ConnectionPool
+from pyro_pyramid import Pyramid, score_round
+from pyro_storage import ConcurrentUpdate
+
+RETRY_PAUSE = 0.001  # seconds a player waits before trying a move again that was not its turn yet
+SWITCH_INTERVAL = 1e-5  # seconds between thread switches while playing, so that moves to the same game overlap
+SERVER_START = 2     # seconds to wait for pyro_server.py to listen
+PLAY_TIMEOUT = 120   # seconds the games over HTTP may take before the check gives up on them
+
+
+def play_concurrently(pool, games, goal, players, seed=0):
+    """Play games in pool with one thread per player, each player playing its paddles in a random order.
+
+    :param pool: ConnectionPool or pyro_db_memory.MemoryStore, with no users yet
+    :return: (ids of the games played, number of moves that gave up with ConcurrentUpdate and were tried again)
+    """
+    names = ['player{}'.format(i) for i in range(players)]
+    with pool.open() as db:
+        for name in names:
+            db.add_username(name, 'pw')
+        game_ids = []
+        for _ in range(games):
+            db.new_game(players, goal, names[0])
+            game_ids.append(db.get_games_by_user(names[0])[-1][0])
+            for name in names[1:]:
+                db.join_game(game_ids[-1], name)
+
+    gave_up = []
+
+    def play(index):
+        rng = random.Random(seed * players + index)
+        name = names[index]
+        for game_id in game_ids:
+            order = list(range(1, goal + 1))
+            rng.shuffle(order)
+            for paddle in order:
+                # Played once the paddle is gone. Until then it is not the player's turn, or the save conflicted.
+                while True:
+                    with pool.open() as db:
+                        game = db.load_game(game_id, Pyramid)
+                        try:
+                            game.add_player_move(name, str(paddle))
+                        except ConcurrentUpdate:
+                            gave_up.append(game_id)
+                            continue
+                        if not game.players[index].paddles >> (paddle - 1) & 1:
+                            break
+                    time.sleep(RETRY_PAUSE)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(SWITCH_INTERVAL)
+    try:
+        threads = [threading.Thread(target=play, args=(index,)) for index in range(players)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    return game_ids, len(gave_up)
+
+
+def check_games(pool, game_ids):
+    """Return the problems of games played by play_concurrently(), as text, one per game."""
+    problems = []
+    with pool.open() as db:
+        for game_id in game_ids:
+            game = db.load_game(game_id, Pyramid)
+            turns = game.turns
+            scores = [0] * len(game.players)
+            for turn in turns:
+                if None not in turn:
+                    scores = [score + points for score, points in zip(scores, score_round(turn))]
+            if (game.state != 2 or game.round != game.goal or len(turns) != game.goal or any(None in t for t in turns)
+                    or [p.score for p in game.players] != scores or any(p.paddles for p in game.players)):
+                problems.append('game {}: state {}, round {}, turns {}, scores {} instead of {}'.format(
+                    game_id, game.state, game.round, turns, [p.score for p in game.players], scores
+                ))
+    return problems
+
+
+def check_stats(pool, game_ids):
+    """Return the problems of the leaderboard after games played by play_concurrently(), the only games in pool."""
+    expected = {}  # user name -> [games, wins, points]
+    with pool.open() as db:
+        for players in db.get_players_by_games(game_ids).values():
+            best = max(player.score for player in players)
+            for player in players:
+                stats = expected.setdefault(player.name, [0, 0, 0])
+                stats[0] += 1
+                stats[1] += player.score == best
+                stats[2] += player.score
+        leaderboard = db.get_leaderboard(len(expected) + 1)
+        problems = []
+        for rank, name, games, wins, points in leaderboard:
+            if [games, wins, points] != expected.get(name):
+                problems.append('user {}: {} games, {} wins, {} points on the leaderboard instead of {}'.format(
+                    name, games, wins, points, expected.get(name)
+                ))
+            if db.get_user_rank(name) != (rank, games, wins, points):
+                problems.append('user {}: rank {} instead of {}'.format(name, db.get_user_rank(name), rank))
+        missing = set(expected) - {name for _, name, *_ in leaderboard}
+        if missing:
+            problems.append('users missing from the leaderboard: {}'.format(', '.join(sorted(missing))))
+    return problems
+
+
+def check_moves(games=12, goal=9, players=3, seed=0, memory=False):
+    """Play games concurrently in a scratch SQLite database and check them.
+
+    :param memory: Store the games in a MemoryStore instead
+    :return: List of problems, empty if every game ended as it should
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        pool = MemoryStore() if memory else ConnectionPool(os.path.join(directory, 'check.db'))
+        started = time.perf_counter()
+        game_ids, gave_up = play_concurrently(pool, games, goal, players, seed)
+        problems = check_games(pool, game_ids) + check_stats(pool, game_ids)
+        pool.close_all()
+    print('{} games of {} players played in {:.1f} s, {} moves tried again after giving up'.format(
+        len(game_ids), players, time.perf_counter() - started, gave_up
+    ))
+    return problems
+
+
+class Client:
+    """Requests to a server on localhost, each on a new connection, so they are spread over the worker processes."""
+    def __init__(self, port):
+        self.port = port
+        self.cookies = {}  # user name -> session cookie
+
+    def get(self, path, user=None):
+        """Return (status, body) of a GET request, sent with the session cookie of user."""
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        headers = {'Connection': 'close'}
+        if user is not None:
+            headers['Cookie'] = self.cookies[user]
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read().decode()
+        finally:
+            connection.close()
+
+    def register(self, user):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request('GET', '/login_register?do=Register&username={}&password=pw'.format(user))
+            response = connection.getresponse()
+            response.read()
+            self.cookies[user] = response.getheader('Set-Cookie').split(';')[0]
+        finally:
+            connection.close()
+
+    def logged_in(self, user, requests):
+        """Return on how many of requests the lobby page accepts the session of user."""
+        return sum('/logout' in self.get('/', user)[1] for _ in range(requests))
+
+
+def _free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+def _worker_pids(pid):
+    output = subprocess.run(['ps', '-o', 'pid=', '--ppid', str(pid)], capture_output=True, text=True).stdout
+    return [int(worker) for worker in output.split()]
+
+
+def check_workers(workers=3, games=6, goal=9, players=3, seed=0):
+    """Play games over HTTP on pyro_server.py --workers in a scratch directory, and check the server and the games.
+
+    :return: List of problems, empty if the workers stayed coherent and every game ended as it should
+    """
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        port = _free_port()
+        log = open(os.path.join(directory, 'server.log'), 'w+')
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pyro_server.py'),
+             '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers), '--threads', '16'],
+            cwd=directory, stdout=log, stderr=subprocess.STDOUT
+        )
+        time.sleep(SERVER_START)
+        client = Client(port)
+        names = ['player{}'.format(i) for i in range(players)]
+        for name in names:
+            client.register(name)
+        pool = ConnectionPool(os.path.join(directory, 'pyro_game.db'))
+        with pool.open() as db:
+            game_ids = []
+            for _ in range(games):
+                db.new_game(players, goal, names[0])
+                game_ids.append(db.get_games_by_user(names[0])[-1][0])
+                for name in names[1:]:
+                    db.join_game(game_ids[-1], name)
+
+        # Every worker knows the version of a game
+        versions = {client.get('/updated_game?id={}'.format(game_ids[0]), names[0])[1] for _ in range(workers * 4)}
+        if len(versions) != 1:
+            problems.append('workers disagree on the version of a game: {}'.format(versions))
+
+        # A long poll wakes up for a move made on another connection, most likely by another worker
+        since = client.get('/updated_game?id={}'.format(game_ids[0]), names[0])[1].split()[1]
+        answer = {}
+        waiter = threading.Thread(target=lambda: answer.update(
+            reply=client.get('/wait_game?id={}&since={}'.format(game_ids[0], since), names[0])[1],
+            answered=time.perf_counter()
+        ))
+        waiter.start()
+        time.sleep(0.3)
+        moved = time.perf_counter()
+        client.get('/game?id={}&move=1'.format(game_ids[0]), names[0])
+        waiter.join()
+        if answer['reply'] != 'changed' or answer['answered'] - moved > 5:
+            problems.append('long poll answered {!r} {:.1f} s after a move'.format(
+                answer['reply'], answer['answered'] - moved
+            ))
+
+        # A session logged out on one worker is rejected by all
+        client.register('leaving')
+        client.get('/logout', 'leaving')
+        accepted = client.logged_in('leaving', workers * 4)
+        if accepted:
+            problems.append('session accepted on {} of {} requests after logout'.format(accepted, workers * 4))
+
+        # Play, while the workers are replaced after a third of the moves and one of them is killed after two thirds
+        moves = [0]
+        progress = threading.Condition()
+        deadline = time.monotonic() + PLAY_TIMEOUT
+        failures = []
+
+        def play(index):
+            rng = random.Random(seed * players + index)
+            for game_id in game_ids:
+                order = list(range(1, goal + 1))
+                rng.shuffle(order)
+                for paddle in order:
+                    while True:
+                        if time.monotonic() > deadline:
+                            failures.append('player{} did not finish its moves in {} s'.format(index, PLAY_TIMEOUT))
+                            return
+                        try:
+                            client.get('/game?id={}&move={}'.format(game_id, paddle), names[index])
+                        except (ConnectionError, TimeoutError, http.client.HTTPException):
+                            pass  # The worker was killed, maybe after saving the move: check, and send it again
+                        with pool.open() as db:
+                            paddles = db.get_players_by_games([game_id])[game_id][index].paddles
+                        if not paddles >> (paddle - 1) & 1:
+                            break
+                        time.sleep(RETRY_PAUSE)
+                    with progress:
+                        moves[0] += 1
+                        progress.notify_all()
+
+        def run(index):
+            try:
+                play(index)
+            except Exception as error:
+                failures.append('player{} failed: {!r}'.format(index, error))
+            finally:
+                with progress:
+                    progress.notify_all()
+
+        def wait_for_moves(count):
+            # Until count moves are made, or a player stopped playing
+            with progress:
+                progress.wait_for(
+                    lambda: moves[0] >= count or failures or not all(t.is_alive() for t in threads),
+                    max(0.0, deadline - time.monotonic())
+                )
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=run, args=(index,), daemon=True) for index in range(players)]
+        for thread in threads:
+            thread.start()
+        wait_for_moves(games * goal * players // 3)
+        server.send_signal(signal.SIGHUP)
+        wait_for_moves(games * goal * players * 2 // 3)
+        killed = None
+        pids = _worker_pids(server.pid)
+        if pids:
+            killed = pids[0]
+            os.kill(killed, signal.SIGKILL)
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()) + 1)
+        problems.extend(failures)
+        if any(thread.is_alive() for thread in threads) and not failures:
+            problems.append('the players did not finish in {} s'.format(PLAY_TIMEOUT))
+        deadline = time.monotonic() + SERVER_START + 5
+        while time.monotonic() < deadline:
+            pids = _worker_pids(server.pid)
+            if len(pids) == workers and killed not in pids:
+                break
+            time.sleep(0.1)
+        else:
+            problems.append('the killed worker was not replaced: workers {}'.format(_worker_pids(server.pid)))
+        print('{} games of {} players played over HTTP on {} workers in {:.1f} s'.format(
+            len(game_ids), players, workers, time.perf_counter() - started
+        ))
+        problems.extend(check_games(pool, game_ids) + check_stats(pool, game_ids))
+        pool.close_all()
+
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(60)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+            problems.append('the server did not stop within 60 s')
+        log.seek(0)
+        output = log.read()
+        log.close()
+        if server.returncode != 0:
+            problems.append('the server exited with status {}'.format(server.returncode))
+        if 'Traceback' in output:
+            problems.append('the server logged {} tracebacks'.format(output.count('Traceback')))
+    return problems
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Check that the game stays consistent under concurrency.')
+    parser.add_argument('check', choices=['moves', 'workers'])
+    parser.add_argument('--memory', action='store_true', help='store the games in memory, for moves')
+    parser.add_argument('--workers', type=int, default=3, help='worker processes of the server, for workers')
+    parser.add_argument('--games', type=int, default=12)
+    parser.add_argument('--goal', type=int, default=9, help='rounds per game')
+    parser.add_argument('--players', type=int, default=3, help='players per game, each playing in a thread')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(args)
+
+    if options.check == 'workers':
+        problems = check_workers(options.workers, options.games, options.goal, options.players, options.seed)
+    else:
+        problems = check_moves(options.games, options.goal, options.players, options.seed, options.memory)
+    for problem in problems:
+        print(problem)
+    print('{} problems'.format(len(problems)))
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Response compression.
+
+CompressionMiddleware wraps a WSGI application and compresses its responses with gzip or deflate, whichever the
+browser accepts (Accept-Encoding). Responses are compressed while they are streamed: every block the application
+yields is compressed and flushed on its own, so a long page still reaches the browser piece by piece.
+
+Small responses, like the replies to the polling requests, are sent as they are. Compressing them would save a few
+bytes at best and cost a compressor per request.
+
+Static fragments every page starts with, like the page header with its CSS, can be compressed once up front. The
+fragment is compressed into complete deflate blocks that the rest of the page is appended to, and the rest may
+still refer back to the fragment's text.
+"""
+
+import struct
+import zlib
+
+from pyro_templates import Response
+
+MINIMUM_SIZE = 512  # bytes; smaller responses are not compressed
+LEVEL = 6           # zlib compression level for the dynamic part of a response
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/x-ndjson', 'application/javascript')
+
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'  # deflate, no file name or time, unknown OS
+ZLIB_HEADER = b'\x78\x9c'  # deflate, 32 KiB window, no dictionary
+
+
+def accepted_encoding(accept_encoding):
+    """Return 'gzip', 'deflate', or None: the best encoding an Accept-Encoding header allows."""
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip()] = quality
+    for coding in ('gzip', 'deflate'):
+        quality = accepted.get(coding, accepted.get('*', 0.0))
+        if quality > 0:
+            return coding
+    return None
+
+
+class Stream:
+    """Compresses one response: an optional precompressed fragment, then the rest of the data, then the trailer."""
+    def __init__(self, encoding, level, fragment=b'', compressed_fragment=b''):
+        self.encoding = encoding
+        # Raw deflate, with the fragment as history the compressor may refer to. The browser has just decompressed
+        # the fragment, so it has that history too.
+        if fragment:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=fragment)
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.length = len(fragment)
+        if encoding == 'gzip':
+            self.checksum = zlib.crc32(fragment)
+            self.start = GZIP_HEADER + compressed_fragment
+        else:
+            self.checksum = zlib.adler32(fragment)
+            self.start = ZLIB_HEADER + compressed_fragment
+
+    def compress(self, data):
+        """Return data compressed and flushed, so the browser can show it before the response is complete."""
+        self.length += len(data)
+        if self.encoding == 'gzip':
+            self.checksum = zlib.crc32(data, self.checksum)
+        else:
+            self.checksum = zlib.adler32(data, self.checksum)
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """Return the end of the compressed stream."""
+        end = self.compressor.flush(zlib.Z_FINISH)
+        if self.encoding == 'gzip':
+            return end + struct.pack('<II', self.checksum & 0xffffffff, self.length & 0xffffffff)
+        return end + struct.pack('>I', self.checksum & 0xffffffff)
+
+
+class CompressionMiddleware:
+    """WSGI middleware compressing the responses of app with gzip or deflate."""
+    def __init__(self, app, minimum_size=MINIMUM_SIZE, level=LEVEL, fragments=()):
+        """
+        :param app: The WSGI application
+        :param minimum_size: Responses shorter than this many bytes are sent uncompressed
+        :param level: zlib compression level
+        :param fragments: Static byte strings responses often start with, compressed once up front
+        """
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.fragments = []  # (fragment, compressed fragment), longest first
+        for fragment in sorted(fragments, key=len, reverse=True):
+            compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+            # A full flush ends the fragment's blocks on a byte boundary without marking the last one final,
+            # so another compressor's output can follow it
+            self.fragments.append((fragment, compressor.compress(fragment) + compressor.flush(zlib.Z_FULL_FLUSH)))
+
+    def __call__(self, e, start_response):
+        encoding = accepted_encoding(e.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self.app(e, start_response)
+
+        # The ETag of a compressed response gets the encoding appended. Take it off again when the browser
+        # revalidates, so the application can compare the tag with its own.
+        suffix = '-{}"'.format(encoding)
+        response = {'revalidated': suffix in e.get('HTTP_IF_NONE_MATCH', '')}
+        if response['revalidated']:
+            e = dict(e, HTTP_IF_NONE_MATCH=e['HTTP_IF_NONE_MATCH'].replace(suffix, '"'))
+        written = []
+
+        def capture_start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = status
+            response['headers'] = headers
+            return written.append  # Data the application writes comes before the body it returns
+
+        body = self.app(e, capture_start_response)
+        if isinstance(body, list) and sum(len(data) for data in written + body) < self.minimum_size:
+            # Short reply, e.g. to a polling request or a 304: nothing to gain
+            start_response(response['status'], self._not_modified_headers(response, encoding))
+            response['started'] = True
+            return written + body
+        return Response(
+            self._respond(body, written, response, encoding, start_response), getattr(body, 'close', lambda: None)
+        )
+
+    def _respond(self, body, written, response, encoding, start_response):
+        """Yield the response, compressed if it is long enough and of a compressible type."""
+        chunks = iter(body)
+        # Collect at least minimum_size bytes, or the whole response if it is shorter
+        head = list(written)
+        length = sum(len(data) for data in head)
+        for data in chunks:
+            head.append(data)
+            length += len(data)
+            if length >= self.minimum_size:
+                break
+        complete = length < self.minimum_size
+
+        status = response['status']
+        headers = response['headers']
+        header_names = {name.lower(): value for name, value in headers}
+        content_type = header_names.get('content-type', '')
+        if not content_type.startswith(COMPRESSIBLE_TYPES) or 'content-encoding' in header_names:
+            start_response(status, self._not_modified_headers(response, encoding))
+            yield from head
+            yield from chunks
+            return
+
+        headers = [(name, value) for name, value in headers if name.lower() != 'vary']
+        headers.append(('Vary', ', '.join(filter(None, [header_names.get('vary'), 'Accept-Encoding']))))
+        if complete or not status.startswith('200'):
+            if status.startswith('304'):
+                headers = self._not_modified_headers(dict(response, headers=headers), encoding)
+            elif status.startswith('200'):
+                headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+                headers.append(('Content-Length', str(length)))
+            start_response(status, headers)
+            yield from head
+            yield from chunks
+            return
+
+        headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+        headers.append(('Content-Encoding', encoding))
+        start_response(status, self._suffixed_etag(headers, encoding))
+        response['started'] = True
+
+        data = b''.join(head)
+        for fragment, compressed_fragment in self.fragments:
+            if data.startswith(fragment):
+                stream = Stream(encoding, self.level, fragment, compressed_fragment)
+                data = data[len(fragment):]
+                break
+        else:
+            stream = Stream(encoding, self.level)
+        yield stream.start + stream.compress(data)
+        for data in chunks:
+            if data:
+                yield stream.compress(data)
+        yield stream.finish()
+
+    def _not_modified_headers(self, response, encoding):
+        """Return the headers of the response. A 304 confirms the compressed page the browser revalidated."""
+        if response['revalidated'] and response['status'].startswith('304'):
+            return self._suffixed_etag(response['headers'], encoding)
+        return response['headers']
+
+    @staticmethod
+    def _suffixed_etag(headers, encoding):
+        """Return headers with the encoding appended to the ETag, since the compressed bytes differ."""
+        return [
+            (name, value[:-1] + '-{}"'.format(encoding) if name.lower() == 'etag' and value.endswith('"') else value)
+            for name, value in headers
+        ]
@@ -0,0 +1,403 @@
+"""
+In-memory storage for the game.
+
+MemoryDB implements pyro_storage.Storage on plain dicts and lists, held by a MemoryStore. Nothing touches the disk
+and every operation takes microseconds, so benchmarks, simulations and tests can run the real app and game classes
+without a database:
+
+    store = MemoryStore()
+    app = pyro_app.create_app(store)
+
+    with store.open() as db:
+        db.add_username('a', 'pw')
+
+The data lives as long as the MemoryStore, in one process. A lock makes every operation atomic, so the store can
+be shared by the threads of pyro_server. Moves are saved with the same compare and swap on the game version as in
+SQLite: the writes of a move are collected and only applied by save_game_state(), if the game did not change
+meanwhile.
+"""
+
+import threading
+import time
+
+from pyro_changes import bus, user_key, LOBBY
+from pyro_metrics import timed
+from pyro_storage import ConcurrentUpdate, DUMP_TABLES, Player, Storage, paddle_numbers
+
+# Positions in the lists of MemoryStore.games and MemoryStore.players
+PLAYERS, GOAL, STATE, TS, ROUND, GAMEPADDLES, VERSION = range(7)
+ROWID, NAME, SCORE, PLAYING, PADDLES = range(5)
+
+
+def now():
+    """Return the time like SQLite's datetime(): UTC, to the second."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+
+class MemoryStore:
+    """The users, games, players and moves of a MemoryDB. Hands out MemoryDB objects like a connection pool."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}          # name -> password
+        self.games = {}          # game id -> [players, goal, state, ts, round, gamepaddles, version]
+        self.players = {}        # game id -> [[rowid, user name, score, playing, paddles], ...] in join order
+        self.moves = {}          # game id -> rounds, each a list with the paddle of every player (None if not played)
+        self.user_games = {}     # user name -> ids of the games the user is in
+        self.registering = set()  # ids of the games accepting players (state 0)
+        self.archive = {}        # game id -> (game list, player lists, rounds) of an archived game
+        self.archived_user_games = {}  # user name -> ids of the archived games the user played
+        self.stats = {}          # user name -> [games, wins, points] of the user's finished games
+        self.archive_version = 0  # number of archive_games() calls that moved games
+        self.last_game_id = 0
+        self.last_player_id = 0
+
+    def open(self):
+        """Return a MemoryDB using this store."""
+        return MemoryDB(self)
+
+    def close_all(self):
+        """Nothing to close; here so that a MemoryStore can replace a pyro_db_sqlite.ConnectionPool."""
+
+
+class MemoryDB(Storage):
+    """Storage on the dicts of a MemoryStore."""
+    def __init__(self, store=None):
+        self.store = store or MemoryStore()
+        # Writes of the move being saved, applied by save_game_state(): (user name, column, value) for players,
+        # (round, player, paddle) for moves and (user name, wins, points) for the statistics of a finished game
+        self._player_writes = []
+        self._move_writes = []
+        self._stats_writes = []
+
+    # ----- Users ---------------------------
+
+    @timed
+    def user_pass_valid(self, username, password):
+        return username in self.store.users and self.store.users[username] == password
+
+    @timed
+    def add_username(self, username, password):
+        with self.store.lock:
+            if username in self.store.users:
+                return False
+            self.store.users[username] = password
+            return True
+
+    # ----- Reading games ---------------------------
+
+    @timed
+    def get_game_by_id(self, game_id):
+        with self.store.lock:
+            game = self.store.games.get(int(game_id))
+            return game and tuple(game)
+
+    @timed
+    def get_games_by_user(self, username):
+        store = self.store
+        with store.lock:
+            return [
+                (game_id, *store.games[game_id][:VERSION])
+                for game_id in sorted(store.user_games.get(username, ()))
+                if any(p[NAME] == username and p[PLAYING] for p in store.players[game_id])
+            ]
+
+    @timed
+    def get_registering_games_by_user(self, username):
+        store = self.store
+        with store.lock:
+            joined = store.user_games.get(username, ())
+            return [
+                (game_id, *store.games[game_id][:STATE], *store.games[game_id][TS:VERSION])
+                for game_id in sorted(store.registering - set(joined), reverse=True)
+            ]
+
+    @timed
+    def get_players_by_games(self, game_ids):
+        store = self.store
+        with store.lock:
+            return {
+                game_id: [Player(*p[NAME:]) for p in store.players.get(game_id, ())] for game_id in game_ids
+            }
+
+    @timed
+    def get_last_turns_by_games(self, num_players):
+        store = self.store
+        last_turns = {}
+        with store.lock:
+            for game_id, players in num_players.items():
+                game = store.games.get(game_id)
+                if game and game[ROUND] and len(store.moves[game_id]) >= game[ROUND]:
+                    turn = store.moves[game_id][game[ROUND] - 1]
+                    last_turns[game_id] = turn[:players] + [None] * (players - len(turn))
+        return last_turns
+
+    @timed
+    def get_turns(self, game_id, rounds, num_players):
+        with self.store.lock:
+            stored = self.store.moves.get(game_id, [])[:rounds]
+            turns = [turn[:num_players] + [None] * (num_players - len(turn)) for turn in stored]
+        return turns + [[None] * num_players for _ in range(rounds - len(turns))]
+
+    # ----- Changing games ---------------------------
+
+    def _add_player(self, game_id, username, paddles):
+        # Call with the store's lock held
+        store = self.store
+        store.last_player_id += 1
+        store.players[game_id].append([store.last_player_id, username, 0, 1, paddles])
+        store.user_games.setdefault(username, set()).add(game_id)
+
+    @timed
+    def new_game(self, players, goal, username):
+        store = self.store
+        with store.lock:
+            store.last_game_id += 1
+            game_id = store.last_game_id
+            store.games[game_id] = [int(players), int(goal), 0, now(), 0, (1 << int(goal)) - 1, 0]
+            store.players[game_id] = []
+            store.moves[game_id] = []
+            store.registering.add(game_id)
+            self._add_player(game_id, username, store.games[game_id][GAMEPADDLES])
+        bus.publish(LOBBY, user_key(username))
+
+    @timed
+    def join_game(self, game_id, username):
+        game_id = int(game_id)
+        store = self.store
+        with store.lock:
+            game = store.games.get(game_id)
+            if not game:
+                print("Unknown game")
+                return
+            if game[STATE] > 1:
+                print("Game full")
+                return
+            if game_id in store.user_games.get(username, ()) or len(store.players[game_id]) >= game[PLAYERS]:
+                return  # Already in the game, or too many players
+            self._add_player(game_id, username, game[GAMEPADDLES])
+            if len(store.players[game_id]) == game[PLAYERS]:  # Players filled
+                game[STATE] = 1
+                store.registering.discard(game_id)
+            game[TS] = now()
+            game[VERSION] += 1
+        self.publish_game_change(game_id, LOBBY)
+
+    @timed
+    def quit_game(self, game_id, username):
+        game_id = int(game_id)
+        store = self.store
+        with store.lock:
+            game = store.games.get(game_id)
+            players = store.players.get(game_id, ())
+            player = next((p for p in players if p[NAME] == username), None)
+            if player is None:
+                print('Player not found in game')
+                return
+            if game[STATE] == 0:  # Still registering players
+                players.remove(player)
+                store.user_games[username].discard(game_id)
+                if players:
+                    game[TS] = now()
+                    game[VERSION] += 1
+                else:
+                    del store.games[game_id], store.players[game_id], store.moves[game_id]
+                    store.registering.discard(game_id)
+                keys = (user_key(username), LOBBY)
+            else:
+                player[PLAYING] = 0
+                game[TS] = now()
+                game[VERSION] += 1
+                keys = ()
+        self.publish_game_change(game_id, *keys)
+
+    @timed
+    def clear_tables(self, clear_all):
+        store = self.store
+        with store.lock:
+            if clear_all:
+                store.users.clear()
+            for table in (
+                store.games, store.players, store.moves, store.user_games, store.registering, store.archive,
+                store.archived_user_games, store.stats
+            ):
+                table.clear()
+        bus.publish_all()
+
+    # ----- Archive ---------------------------
+
+    @timed
+    def archive_games(self, before, limit):
+        store = self.store
+        usernames = set()
+        with store.lock:
+            due = sorted(
+                (game[TS], game_id) for game_id, game in store.games.items() if game[STATE] == 2 and game[TS] < before
+            )[:limit]
+            for _, game_id in due:
+                players = store.players.pop(game_id)
+                store.archive[game_id] = (store.games.pop(game_id), players, store.moves.pop(game_id))
+                for player in players:
+                    store.user_games[player[NAME]].discard(game_id)
+                    store.archived_user_games.setdefault(player[NAME], set()).add(game_id)
+                    usernames.add(player[NAME])
+            if due:
+                store.archive_version += 1
+        if usernames:
+            bus.publish(*[user_key(username) for username in usernames])
+        return len(due)
+
+    @timed
+    def archive_version(self):
+        return self.store.archive_version
+
+    @timed
+    def get_archived_games_by_user(self, username, before=None, limit=None):
+        store = self.store
+        with store.lock:
+            game_ids = sorted(store.archived_user_games.get(username, ()), reverse=True)
+            if before is not None:
+                game_ids = [game_id for game_id in game_ids if game_id < before]
+            return [
+                (game_id, store.archive[game_id][0][GOAL], store.archive[game_id][0][TS],
+                 [Player(*p[NAME:]) for p in store.archive[game_id][1]])
+                for game_id in game_ids[:limit]
+            ]
+
+    @timed
+    def load_archived_game(self, game_id, game_class):
+        game_id = int(game_id)
+        with self.store.lock:
+            if game_id not in self.store.archive:
+                return None
+            game, players, turns = self.store.archive[game_id]
+            players = [Player(*p[NAME:]) for p in players]
+            turns = [turn + [None] * (len(players) - len(turn)) for turn in turns[:game[ROUND]]]
+        return game_class(
+            game_id, *game[:VERSION], self, players=players, turns=turns, row_version=game[VERSION]
+        )
+
+    # ----- Leaderboard ---------------------------
+
+    @timed
+    def get_leaderboard(self, limit):
+        with self.store.lock:
+            best = sorted(
+                ((wins, points, name, games) for name, (games, wins, points) in self.store.stats.items()), reverse=True
+            )[:limit]
+        leaderboard = []
+        for position, (wins, points, name, games) in enumerate(best, 1):
+            if leaderboard and leaderboard[-1][3:] == (wins, points):
+                position = leaderboard[-1][0]
+            leaderboard.append((position, name, games, wins, points))
+        return leaderboard
+
+    @timed
+    def get_user_rank(self, username):
+        with self.store.lock:
+            if username not in self.store.stats:
+                return None
+            games, wins, points = self.store.stats[username]
+            ahead = sum(1 for _, w, p in self.store.stats.values() if (w, p) > (wins, points))
+        return ahead + 1, games, wins, points
+
+    # ----- Saving a move, for Game ---------------------------
+
+    def begin_move(self, game):
+        self._player_writes = []
+        self._move_writes = []
+        self._stats_writes = []
+
+    def save_player_paddles(self, game, index, paddles):
+        self._player_writes.append((game.players[index].name, PADDLES, paddles))
+
+    def save_move(self, game, index, paddle):
+        self._move_writes.append((game.round, index, paddle))
+
+    def save_scores(self, game, indexes):
+        self._player_writes.extend((game.players[index].name, SCORE, game.players[index].score) for index in indexes)
+
+    def save_game_over(self, game):
+        best = max(player.score for player in game.players)
+        self._stats_writes.extend((player.name, int(player.score == best), player.score) for player in game.players)
+
+    @timed
+    def save_game_state(self, game):
+        store = self.store
+        player_writes, move_writes, stats_writes = self._player_writes, self._move_writes, self._stats_writes
+        self._player_writes = []
+        self._move_writes = []
+        self._stats_writes = []
+        with store.lock:
+            row = store.games.get(game.id)
+            if row is None or row[VERSION] != game.row_version:
+                raise ConcurrentUpdate('Game {} changed while saving a move'.format(game.id))
+            players = {p[NAME]: p for p in store.players[game.id]}
+            for name, column, value in player_writes:
+                players[name][column] = value
+            moves = store.moves[game.id]
+            for round_number, index, paddle in move_writes:
+                while len(moves) < round_number:
+                    moves.append([None] * len(players))
+                moves[round_number - 1][index] = paddle
+            for name, wins, points in stats_writes:
+                stats = store.stats.setdefault(name, [0, 0, 0])
+                stats[0] += 1
+                stats[1] += wins
+                stats[2] += points
+            row[STATE] = game.state
+            row[ROUND] = game.round
+            row[TS] = now()
+            row[VERSION] += 1
+            return row[TS], row[VERSION]
+
+    # ----- Exports ---------------------------
+
+    def _table_rows(self, table):
+        # All rows of one of the DUMP_TABLES, like the columns of the SQLite table. Call with the store's lock held.
+        store = self.store
+        if table == 'user':
+            return list(store.users.items())
+        if table == 'game':
+            return [(game_id, *game) for game_id, game in store.games.items()]
+        if table == 'player':
+            return [
+                (p[ROWID], game_id, *p[NAME:]) for game_id, players in store.players.items() for p in players
+            ]
+        if table == 'archived_game':
+            return [(game_id, *game) for game_id, (game, _, _) in store.archive.items()]
+        if table == 'archived_player':
+            return [
+                (game_id, position, *p[NAME:])
+                for game_id, (_, players, _) in store.archive.items() for position, p in enumerate(players)
+            ]
+        if table == 'user_stats':
+            return [(name, *stats) for name, stats in store.stats.items()]
+        if table == 'archived_move':
+            moves = {game_id: turns for game_id, (_, _, turns) in store.archive.items()}
+        else:
+            moves = store.moves
+        return [
+            (game_id, round_number, player, paddle)
+            for game_id, turns in moves.items()
+            for round_number, turn in enumerate(turns, 1)
+            for player, paddle in enumerate(turn) if paddle is not None
+        ]
+
+    def dump_table(self, table, after=None, limit=None, batch_size=500):
+        key, columns = DUMP_TABLES[table]
+        with self.store.lock:
+            rows = sorted(self._table_rows(table))  # The key columns come first
+        if after is not None:
+            after = tuple(after)
+            rows = [row for row in rows if row[:len(key)] > after]
+        if limit is not None:
+            rows = rows[:limit]
+        # Sets of paddles are shown as the numbers of the paddles
+        paddle_columns = [i for i, column in enumerate(columns) if column in ('gamepaddles', 'paddles')]
+        for row in rows:
+            if paddle_columns:
+                row = list(row)
+                for column in paddle_columns:
+                    row[column] = ' '.join(str(n) for n in paddle_numbers(row[column]))
+                row = tuple(row)
+            yield row
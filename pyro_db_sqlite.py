@@ -4,20 +4,169 @@ This module has all of the database read and write routines.
 All sqlite3 dependencies.
 
 All sqlite3 dependent code is collected in this module. The rest of the game app will be isolated from direct
-interaction with sqlite3. This makes it easy to replace sqlite3 with a different database. Only the code in this
-module needs to be adapted for a different database. The rest of the app will work the same.
+interaction with sqlite3: DB implements pyro_storage.Storage, and the app and the game classes only use that
+interface. To use a different database, implement Storage for it, like pyro_db_memory does for plain dicts.
 """
 
+import functools
+import random
 import sqlite3
-import json
-
-
-class DB:
+import threading
+import time
+
+from pyro_cache import GameCache
+from pyro_changes import bus, game_key, user_key, LOBBY
+from pyro_db_sqlite_migrate import migrate
+from pyro_metrics import count_query, timed
+from pyro_storage import ConcurrentUpdate, DUMP_TABLES, Game, Player, Storage, paddle_numbers
+
+# Connection settings. They can be changed before the first DB() is created.
+DB_PATH = 'pyro_game.db'
+BUSY_TIMEOUT = 5000             # milliseconds to wait for a lock held by another connection
+CACHE_SIZE = -16000             # page cache per connection, negative means KiB (16 MB)
+MMAP_SIZE = 64 * 1024 * 1024    # bytes of the database file memory mapped per connection
+STATEMENT_CACHE_SIZE = 512      # compiled statements kept per connection
+POOL_SIZE = 8                   # idle connections kept open by the pool
+GAME_CACHE_BYTES = 16 * 1024 * 1024  # memory for cached game state, see pyro_cache
+BUSY_ATTEMPTS = 4               # tries at a write while other processes keep the database locked
+BUSY_BACKOFF = 0.05             # seconds to wait before the second try at most, doubled for every further try
+
+
+class ConnectionPool:
+    """Keeps long-lived, pre-tuned sqlite3 connections so requests do not pay connect cost.
+
+    A worker takes a connection with acquire() for the length of one request and hands it back with
+    release(). Idle connections are reused most-recently-used first, so their page caches stay warm.
+
+    The pool also holds the game_cache shared by all DB objects using the database.
+    """
+    def __init__(self, path=None, cache_size=None, mmap_size=None, size=None, game_cache_bytes=None):
+        self.path = path or DB_PATH
+        self.cache_size = CACHE_SIZE if cache_size is None else cache_size
+        self.mmap_size = MMAP_SIZE if mmap_size is None else mmap_size
+        self.size = POOL_SIZE if size is None else size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._migrated = False
+        self.game_cache = GameCache(GAME_CACHE_BYTES if game_cache_bytes is None else game_cache_bytes)
+
+    def connect(self):
+        """Open and tune a new connection."""
+        # check_same_thread=False: a pooled connection may serve requests on different worker threads,
+        # but it is only ever used by one of them at a time.
+        connection = sqlite3.connect(
+            self.path, timeout=BUSY_TIMEOUT / 1000, check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.execute('PRAGMA busy_timeout = {:d}'.format(BUSY_TIMEOUT))
+        connection.execute('PRAGMA cache_size = {:d}'.format(self.cache_size))
+        connection.execute('PRAGMA mmap_size = {:d}'.format(self.mmap_size))
+        connection.set_trace_callback(count_query)  # SQL statements per request and method, see pyro_metrics
+        if not self._migrated:
+            # Bring the schema up to date before the first connection is used
+            migrate(connection)
+            self._migrated = True
+        return connection
+
+    def acquire(self):
+        """Return an idle connection, or a new one if none is idle."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.connect()
+
+    def release(self, connection):
+        """Give a connection back to the pool. Uncommitted work is rolled back."""
+        if connection.in_transaction:
+            connection.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def open(self):
+        """Return a DB using a connection of this pool. Close it when done."""
+        return DB(self)
+
+    def close_all(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    """Return the process wide connection pool, creating it on first use."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
+
+
+def paddles_to_db(paddles):
+    """Convert a set of paddles, a bitmask with bit n - 1 set for paddle n, to the little-endian BLOB stored."""
+    return paddles.to_bytes((paddles.bit_length() + 7) // 8, 'little')
+
+
+def paddles_from_db(value):
+    """Convert a stored set of paddles back to a bitmask."""
+    return int.from_bytes(value or b'', 'little')
+
+
+def is_busy(error):
+    """Return True if an sqlite3 error means another connection kept the database locked (SQLITE_BUSY)."""
+    code = getattr(error, 'sqlite_errorcode', None)  # Python 3.11 and up
+    if code is not None:
+        return code & 0xff == sqlite3.SQLITE_BUSY
+    return isinstance(error, sqlite3.OperationalError) and 'database is locked' in str(error)
+
+
+def busy_wait(attempt):
+    """Sleep before trying a locked database again. The time is random, so that the processes waiting for the
+    lock try again one after the other rather than all at once."""
+    time.sleep(random.uniform(0, BUSY_BACKOFF * 2 ** attempt))
+
+
+def retry_busy(method):
+    """Decorator for DB methods writing in one transaction: roll back and try again, up to BUSY_ATTEMPTS times,
+    when another process keeps the database locked for longer than BUSY_TIMEOUT."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        for attempt in range(BUSY_ATTEMPTS):
+            try:
+                return method(self, *args, **kwargs)
+            except sqlite3.Error as error:
+                if not is_busy(error) or attempt == BUSY_ATTEMPTS - 1:
+                    raise
+                if self.connection.in_transaction:
+                    self.connection.rollback()
+                busy_wait(attempt)
+    return wrapper
+
+
+class DB(Storage):
     """Miscellaneous functions for checking username & password, fetching games, updating scores etc."""
-    def __init__(self):
-        self.connection = sqlite3.connect('pyro_game.db')
+    def __init__(self, pool=None):
+        self.pool = pool or default_pool()
+        self.connection = self.pool.acquire()
+
+    # Return the connection to the pool. The DB object must not be used afterwards.
+    def close(self):
+        if self.connection is not None:
+            self.pool.release(self.connection)
+            self.connection = None
 
     # Check the username and password entered to be sure that they match what is in the database.
+    @timed
     def user_pass_valid(self, username, password):
         cursor = self.connection.cursor()
         cursor.execute('SELECT name FROM user WHERE name = ? AND password = ?', [username, password])
@@ -27,6 +176,8 @@ class DB:
             return False
 
     # Adds a new username to the database.
+    @timed
+    @retry_busy
     def add_username(self, username, password):
         cursor = self.connection.cursor()
         # First check to see if the username is already used.
@@ -40,60 +191,159 @@ class DB:
             return True
 
     # For a given game_id, return all the fields in the game database
+    @timed
     def get_game_by_id(self, game_id):
         cursor = self.connection.cursor()
-        cursor.execute('SELECT players, goal, state, ts, turns, gamepaddles FROM game WHERE rowid = ?', [game_id])
-        return cursor.fetchone()
+        cursor.execute(
+            'SELECT players, goal, state, ts, round, gamepaddles, version FROM game WHERE rowid = ?', [game_id]
+        )
+        row = cursor.fetchone()
+        return row and row[:5] + (paddles_from_db(row[5]), row[6])
+
+    # Return the game with the given id as a game_class object with all its players and moves, or None if there is
+    # no such game. While the game has not changed since it was last loaded or written, it comes from the game cache
+    # without any SQL.
+    @timed
+    def load_game(self, game_id, game_class):
+        game_id = int(game_id)
+        cache = self.pool.game_cache
+        version = bus.version(game_key(game_id))  # Read before the game, which is then at least as new
+        snapshot = cache.get(game_id, version)
+        if snapshot is None:
+            row = self.get_game_by_id(game_id)
+            if row is None:
+                return None
+            *row, row_version = row
+            game = game_class(game_id, *row, self, row_version=row_version)
+            cache.put(game_id, version, game.snapshot())
+        else:
+            num_players, goal, state, ts, round, gamepaddles, row_version, players, turns = snapshot
+            game = game_class(
+                game_id, num_players, goal, state, ts, round, gamepaddles, self,
+                players=[Player(*player) for player in players],
+                turns=[list(turn) for turn in turns], row_version=row_version
+            )
+        game.cache = cache
+        game.version = version
+        return game
+
+    # Write-through for changes made to a game by DB methods: store the new state of the game in the game cache,
+    # if it is cached. Call right after publishing the change, so the state read is at least as new as version.
+    @timed
+    def refresh_cached_game(self, game_id, version):
+        game_id = int(game_id)
+        cache = self.pool.game_cache
+        if game_id not in cache:
+            return
+        row = self.get_game_by_id(game_id)
+        if row is None:
+            cache.discard(game_id)
+        else:
+            *row, row_version = row
+            cache.put(game_id, version, Game(game_id, *row, self, row_version=row_version).snapshot())
 
     # For a given username, return both game and player fields for the active (playing = 1) game
+    @timed
     def get_games_by_user(self, username):
         cursor = self.connection.cursor()
         cursor.execute(
-            'SELECT game.rowid, players, goal, state, ts, turns, gamepaddles '
+            'SELECT game.rowid, players, goal, state, ts, round, gamepaddles '
             'FROM game, player '
             'WHERE player.game_id = game.rowid AND playing AND user_name = ? '
             'ORDER BY 1', [username]
         )
-        return cursor.fetchall()
+        return [row[:-1] + (paddles_from_db(row[-1]),) for row in cursor]
 
     # ???
+    @timed
     def get_registering_games_by_user(self, username):
         cursor = self.connection.cursor()
         # state = 0 means game is still adding players
         cursor.execute(
-            'SELECT game_id, players, goal, ts, turns, gamepaddles FROM game, ('
-            ' SELECT rowid game_id FROM game WHERE state = 0 AND rowid NOT IN ('
-            '  SELECT game.rowid FROM game, player'
-            '  WHERE state = 0 AND game.rowid = player.game_id AND player.user_name = ?'
-            ' )'
-            ') registering '
-            'WHERE game.rowid = registering.game_id '
+            'SELECT rowid, players, goal, ts, round, gamepaddles FROM game '
+            'WHERE state = 0 AND rowid NOT IN (SELECT game_id FROM player WHERE user_name = ?) '
             'ORDER BY 1 DESC', [username]
         )
-        return cursor.fetchall()
+        return [row[:-1] + (paddles_from_db(row[-1]),) for row in cursor]
+
+    # For a list of game ids, return {game_id: [Player, ...]} with the players of every game in join order.
+    # One query covers all the games, instead of one query per game in Game.__init__.
+    @timed
+    def get_players_by_games(self, game_ids):
+        players = {game_id: [] for game_id in game_ids}
+        game_ids = list(players)
+        cursor = self.connection.cursor()
+        # Stay well below SQLite's limit on the number of ? parameters in one statement
+        for start in range(0, len(game_ids), 500):
+            chunk = game_ids[start:start + 500]
+            cursor.execute(
+                'SELECT game_id, user_name, score, playing, paddles FROM player '
+                'WHERE game_id IN ({}) ORDER BY rowid'.format(', '.join('?' * len(chunk))), chunk
+            )
+            for game_id, n, s, p, pa in cursor:
+                players[game_id].append(Player(n, s, p, paddles_from_db(pa)))
+        return players
+
+    # For {game_id: number of players}, return {game_id: [paddle or None, ...]} with the moves of the current round
+    # of every game that has started a round. One query covers all the games.
+    @timed
+    def get_last_turns_by_games(self, num_players):
+        last_turns = {}
+        game_ids = list(num_players)
+        cursor = self.connection.cursor()
+        for start in range(0, len(game_ids), 500):
+            chunk = game_ids[start:start + 500]
+            cursor.execute(
+                'SELECT game.rowid, move.player, move.paddle FROM game, move '
+                'WHERE game.rowid IN ({}) AND game.round > 0 '
+                ' AND move.game_id = game.rowid AND move.round = game.round'.format(', '.join('?' * len(chunk))), chunk
+            )
+            for game_id, player, paddle in cursor:
+                if game_id not in last_turns:
+                    last_turns[game_id] = [None] * num_players[game_id]
+                last_turns[game_id][player] = paddle
+        return last_turns
+
+    # Return the first rounds rounds of a game, each a list with the paddle of every player (None if not played).
+    # Rounds started after the game was read are left out.
+    @timed
+    def get_turns(self, game_id, rounds, num_players):
+        turns = [[None] * num_players for _ in range(rounds)]
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT round, player, paddle FROM move WHERE game_id = ? AND round <= ?', [game_id, rounds])
+        for round_number, player, paddle in cursor:
+            turns[round_number - 1][player] = paddle
+        return turns
 
     # Creates a new game row, and a new player row linked to that game in the player table.
+    @timed
+    @retry_busy
     def new_game(self, players, goal, username):
-        # Create the gamepaddles text and store in the game table for this game.
-        # The gamepaddles text contains the initial list of paddles that can be played for any player that joins
-        # Example: 5 rounds, then gamepaddles = "12345"
+        # Create the gamepaddles bitmask and store in the game table for this game.
+        # gamepaddles contains the initial set of paddles that can be played for any player that joins:
+        # bit n - 1 is set for paddle n. Example: 5 rounds, then gamepaddles = 0b11111
         # gamepaddles is copied to the paddles field in each row in the player table when a player joins the game.
-        # As a player uses paddles, the text coresponding to the number used is replaced with "_"
-        gamepaddles = ""
-        pad = 1
-
-        while pad <= int(goal):
-            gamepaddles += str(pad)
-            pad += 1
+        # As a player uses paddles, the bit coresponding to the number used is cleared.
+        gamepaddles = paddles_to_db((1 << int(goal)) - 1)
 
         cursor = self.connection.cursor()
-        cursor.execute('INSERT INTO game (players, goal, gamepaddles) VALUES (?, ?, ?);', [players, goal, gamepaddles])
+        # The new id follows the highest one in use, archived games included, so no two games ever share an id
+        cursor.execute(
+            'INSERT INTO game (rowid, players, goal, gamepaddles) VALUES ('
+            ' max(ifnull((SELECT max(rowid) FROM game), 0), ifnull((SELECT max(game_id) FROM archived_game), 0)) + 1,'
+            ' ?, ?, ?)', [players, goal, gamepaddles]
+        )
         # last_insert_rowid() is for the game table.
         # we need to add the paddles field here for the first person to join the game using the "goal" value.
-        cursor.execute('INSERT INTO player (game_id, user_name, paddles) VALUES (last_insert_rowid(), ?, ?)', [username, gamepaddles])
+        cursor.execute(
+            'INSERT INTO player (game_id, user_name, paddles) VALUES (last_insert_rowid(), ?, ?)', [username, gamepaddles]
+        )
         self.connection.commit()
+        bus.publish(LOBBY, user_key(username))
 
     # A person joins an already listed game.
+    @timed
+    @retry_busy
     def join_game(self, game_id, username):
         game = self.get_game_by_id(game_id)
         if not game:
@@ -101,49 +351,38 @@ class DB:
             return
 
         # extract key value pairs from the game object
-        max_players, goal, state, ts, turns, gamepaddles = game
+        max_players, goal, state, ts, round, gamepaddles, version = game
         # should this read "if state > 0" ??
         if state > 1:
             print("Game full")
             return
 
         cursor = self.connection.cursor()
-        # make a new row in the player table.  Insert paddles using the "goal" value. paddles="12345"
-        cursor.execute('INSERT INTO player (game_id, user_name, paddles) VALUES (?, ?, ?)', [game_id, username, gamepaddles])
+        # make a new row in the player table.  Insert paddles using the "goal" value. paddles=0b11111
+        cursor.execute(
+            'INSERT INTO player (game_id, user_name, paddles) VALUES (?, ?, ?)',
+            [game_id, username, paddles_to_db(gamepaddles)]
+        )
         # figure out how many people are now in the game (including the one just added)
         cursor.execute('SELECT count(*) FROM player WHERE game_id = ?', [game_id])
         (players_in_game,) = cursor.fetchone()
         if players_in_game == max_players:  # Players filled
-            cursor.execute('UPDATE game SET state = 1, ts = datetime() WHERE rowid = ?', [game_id])
+            cursor.execute(
+                'UPDATE game SET state = 1, ts = datetime(), version = version + 1 WHERE rowid = ?', [game_id]
+            )
             self.connection.commit()
+            self.refresh_cached_game(game_id, self.publish_game_change(game_id, LOBBY))
         elif players_in_game < max_players:  # Waiting more players
-            cursor.execute('UPDATE game SET ts = datetime() WHERE rowid = ?', [game_id])
+            cursor.execute('UPDATE game SET ts = datetime(), version = version + 1 WHERE rowid = ?', [game_id])
             self.connection.commit()
+            self.refresh_cached_game(game_id, self.publish_game_change(game_id, LOBBY))
         elif players_in_game > max_players:  # Too many players
             # something went wrong and we added more players than are allowed.  Remove the new player.
             self.connection.rollback()
 
-    # ???
-    def updated_games(self, username):
-        cursor = self.connection.cursor()
-        cursor.execute(  # Find latest timestamps of players' game joins, quits, moves where user himself has not quit
-            'SELECT max(ts) FROM game, player '
-            'WHERE player.user_name = ? AND player.playing AND player.game_id = game.rowid ', [username])
-        (latest_timestamp_of_running_games,) = cursor.fetchone()
-        cursor.execute(  # Latest timestamps of games waiting for registrations
-            'SELECT max(ts) FROM game, ('
-            ' SELECT rowid game_id FROM game WHERE state = 0 AND rowid NOT IN ('
-            '  SELECT game.rowid FROM game, player'
-            '  WHERE state = 0 AND game.rowid = player.game_id AND player.user_name = ?'
-            ' )'
-            ') registering '
-            'WHERE game.rowid = registering.game_id', [username]
-        )
-
-        (latest_timestamp_of_registering_games,) = cursor.fetchone()
-        return latest_timestamp_of_running_games, latest_timestamp_of_registering_games
-
     # Player leaves the game.
+    @timed
+    @retry_busy
     def quit_game(self, game_id, username):
         cursor = self.connection.cursor()
         cursor.execute(
@@ -165,107 +404,266 @@ class DB:
             cursor.execute('SELECT count(*) FROM player WHERE game_id = ?', [game_id])
             (remaining_players,) = cursor.fetchone()
             if remaining_players > 0:
-                cursor.execute('UPDATE game SET ts = datetime() WHERE rowid = ?', [game_id])
+                cursor.execute('UPDATE game SET ts = datetime(), version = version + 1 WHERE rowid = ?', [game_id])
             else:
                 cursor.execute('DELETE FROM game WHERE rowid = ?', [game_id])
                 # Minor prob: Reg list will not update if a newer game is in the list
             self.connection.commit()
+            self.refresh_cached_game(game_id, self.publish_game_change(game_id, user_key(username), LOBBY))
         else:
             cursor.execute(
                 'UPDATE player SET playing = 0 WHERE user_name = ? AND game_id = ?', [username, game_id]
             )
-            cursor.execute('UPDATE game SET ts = datetime() WHERE rowid = ?', [game_id])
+            cursor.execute('UPDATE game SET ts = datetime(), version = version + 1 WHERE rowid = ?', [game_id])
             self.connection.commit()
-
-    # retrieve all the fields from the three tables
-    def dump(self):
+            self.refresh_cached_game(game_id, self.publish_game_change(game_id))
+
+    # Move up to limit finished games that did not change since before (a UTC time like ts) to the archive tables,
+    # oldest first, in one transaction. Returns the number of games moved; pyro_archive calls this until it is less
+    # than limit. The games stay in the game cache: they are over and no longer change.
+    @timed
+    @retry_busy
+    def archive_games(self, before, limit):
         cursor = self.connection.cursor()
-
-        cursor.execute('SELECT name, password FROM user')
-        users = cursor.fetchall()
-
-        cursor.execute('SELECT rowid, players, goal, state, ts, turns, gamepaddles FROM game')
-        games = cursor.fetchall()
-
-        cursor.execute('SELECT rowid, game_id, user_name, score, playing, paddles FROM player')
-        players = cursor.fetchall()
-
-        return users, games, players
-
-    def clear_tables(self, clear_all):
-        cursor = self.connection.cursor()
-        if clear_all:
-            cursor.execute('DELETE FROM user')
-        cursor.execute('DELETE FROM game')
-        cursor.execute('DELETE FROM player')
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT rowid FROM game WHERE state = 2 AND ts < ? ORDER BY ts LIMIT ?', [before, limit])
+        game_ids = [game_id for (game_id,) in cursor.fetchall()]
+        usernames = set()
+        for start in range(0, len(game_ids), 500):
+            chunk = game_ids[start:start + 500]
+            marks = ', '.join('?' * len(chunk))
+            cursor.execute('SELECT user_name FROM player WHERE game_id IN ({})'.format(marks), chunk)
+            usernames.update(username for (username,) in cursor)
+            cursor.execute(
+                'INSERT INTO archived_game (game_id, players, goal, state, ts, round, gamepaddles, version) '
+                'SELECT rowid, players, goal, state, ts, round, gamepaddles, version FROM game '
+                'WHERE rowid IN ({})'.format(marks), chunk
+            )
+            cursor.execute(
+                'INSERT INTO archived_player (game_id, position, user_name, score, playing, paddles) '
+                'SELECT game_id, row_number() OVER (PARTITION BY game_id ORDER BY rowid) - 1, user_name, score, '
+                ' playing, paddles FROM player WHERE game_id IN ({})'.format(marks), chunk
+            )
+            cursor.execute(
+                'INSERT INTO archived_move (game_id, round, player, paddle) '
+                'SELECT game_id, round, player, paddle FROM move WHERE game_id IN ({})'.format(marks), chunk
+            )
+            cursor.execute('DELETE FROM move WHERE game_id IN ({})'.format(marks), chunk)
+            cursor.execute('DELETE FROM player WHERE game_id IN ({})'.format(marks), chunk)
+            cursor.execute('DELETE FROM game WHERE rowid IN ({})'.format(marks), chunk)
+        if game_ids:
+            cursor.execute('UPDATE archive_version SET version = version + 1 WHERE id = 0')
         self.connection.commit()
-
-
-class Game:
-    """Base functionality for game classes."""
-    def __init__(self, game_id, num_players, goal, state, ts, turns, gamepaddles, connection):
-        """Initialize game object with state and load players and scores from database."""
-        self.id = game_id
-        self.num_players = num_players
-        self.goal = goal    # number of rounds
-        self.state = state  # 0={Registering players}, 1={Game on}, 2={Game over}
-        self.ts = ts
-        self.turns = json.loads(turns)
-        self.gamepaddles = gamepaddles
-
-        self.connection = connection
-        cursor = connection.cursor()
-        cursor.execute('SELECT user_name, score, playing, paddles FROM player WHERE game_id = ? ORDER BY rowid', [game_id])
-        self.players = [{'name': n, 'score': s, 'playing': p, 'paddles': pa} for n, s, p, pa in cursor.fetchall()]
-
-
-
-    def player_index(self, username):
-        """Return player's index in player list
-
-        :param username: Name of the user to find index for
-        :return: int
-        """
-        return [p['name'] for p in self.players].index(username)
-
-    # scoring for the game.
-    def save_score_for_player(self, index):
-        """Save player's score.
-
-        :param index: Position of player in Game's player list
-        """
-        player = self.players[index]
+        if usernames:
+            bus.publish(*[user_key(username) for username in usernames])
+        return len(game_ids)
+
+    # Return the number of archive_games() calls that moved games, in any process.
+    @timed
+    def archive_version(self):
+        (version,) = self.connection.execute('SELECT version FROM archive_version WHERE id = 0').fetchone()
+        return version
+
+    # Return (game_id, goal, ts, [Player, ...]) of the archived games a user played, newest first.
+    # before is the id of the last game already seen (keyset pagination), limit caps the number of games.
+    @timed
+    def get_archived_games_by_user(self, username, before=None, limit=None):
+        sql = (
+            'SELECT archived_game.game_id, goal, ts FROM archived_player, archived_game '
+            'WHERE user_name = ? AND archived_game.game_id = archived_player.game_id'
+        )
+        params = [username]
+        if before is not None:
+            sql += ' AND archived_player.game_id < ?'
+            params.append(before)
+        sql += ' ORDER BY archived_player.game_id DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        cursor = self.connection.cursor()
+        games = cursor.execute(sql, params).fetchall()
+        players = {game_id: [] for game_id, _, _ in games}
+        game_ids = list(players)
+        for start in range(0, len(game_ids), 500):
+            chunk = game_ids[start:start + 500]
+            cursor.execute(
+                'SELECT game_id, user_name, score, playing, paddles FROM archived_player '
+                'WHERE game_id IN ({}) ORDER BY game_id, position'.format(', '.join('?' * len(chunk))), chunk
+            )
+            for game_id, n, s, p, pa in cursor:
+                players[game_id].append(Player(n, s, p, paddles_from_db(pa)))
+        return [(game_id, goal, ts, players[game_id]) for game_id, goal, ts in games]
+
+    # Return an archived game as a game_class object with all its players and moves, or None if it is not archived.
+    @timed
+    def load_archived_game(self, game_id, game_class):
+        game_id = int(game_id)
         cursor = self.connection.cursor()
         cursor.execute(
-            'UPDATE player SET score = ? '
-            'WHERE user_name = ? AND game_id = ?', [player['score'], player['name'], self.id])
-        # Commit in save_game_state()
-
-    def update_player_paddles(self, index, new_paddles):
-        """ Update the value of the players paddles to remove a paddle played
+            'SELECT players, goal, state, ts, round, gamepaddles, version FROM archived_game WHERE game_id = ?',
+            [game_id]
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        num_players, goal, state, ts, rounds, gamepaddles, row_version = row
+        cursor.execute(
+            'SELECT user_name, score, playing, paddles FROM archived_player WHERE game_id = ? ORDER BY position',
+            [game_id]
+        )
+        players = [Player(n, s, p, paddles_from_db(pa)) for n, s, p, pa in cursor.fetchall()]
+        turns = [[None] * len(players) for _ in range(rounds)]
+        cursor.execute('SELECT round, player, paddle FROM archived_move WHERE game_id = ?', [game_id])
+        for round_number, player, paddle in cursor:
+            turns[round_number - 1][player] = paddle
+        return game_class(
+            game_id, num_players, goal, state, ts, rounds, paddles_from_db(gamepaddles), self, players=players,
+            turns=turns, row_version=row_version
+        )
 
-        :param index: Position of player in Game's player list
-        """
-        player = self.players[index]
+    # Return (rank, user name, games, wins, points) of the limit best users, by wins and then points. The rows are
+    # read from the end of the user_stats_rank index, and users with the same wins and points share a rank.
+    @timed
+    def get_leaderboard(self, limit):
         cursor = self.connection.cursor()
         cursor.execute(
-            'UPDATE player SET paddles = ? '
-            'WHERE user_name = ? AND game_id = ?', [new_paddles, player['name'], self.id])
-
-    def set_game_over(self):
-        """Set game status to game over."""
-        self.state = 2  # Game over
+            # The index holds user_name too, as the key of the table: ties come in reverse name order without sorting
+            'SELECT user_name, games, wins, points FROM user_stats ORDER BY wins DESC, points DESC, user_name DESC '
+            'LIMIT ?', [limit]
+        )
+        leaderboard = []
+        for position, (name, games, wins, points) in enumerate(cursor, 1):
+            if leaderboard and leaderboard[-1][3:] == (wins, points):
+                position = leaderboard[-1][0]
+            leaderboard.append((position, name, games, wins, points))
+        return leaderboard
+
+    # Return (rank, games, wins, points) of a user, or None if the user has not finished a game. The rank counts the
+    # users ahead in the user_stats_rank index, without reading their rows.
+    @timed
+    def get_user_rank(self, username):
         cursor = self.connection.cursor()
-        cursor.execute('UPDATE game SET state = 2 WHERE rowid = ?', [self.id])
-        # Commit in save_game_state()
+        cursor.execute('SELECT games, wins, points FROM user_stats WHERE user_name = ?', [username])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        games, wins, points = row
+        cursor.execute('SELECT count(*) FROM user_stats WHERE (wins, points) > (?, ?)', [wins, points])
+        (ahead,) = cursor.fetchone()
+        return ahead + 1, games, wins, points
+
+    # Start the transaction saving a move, up to save_game_state().
+    # The write lock is taken right away, so all statements of the move run without waiting for other writers.
+    # If other processes keep the database locked, ConcurrentUpdate is raised after a random wait: the game may
+    # have changed meanwhile, so it has to be read again.
+    @timed
+    def begin_move(self, game):
+        if not self.connection.in_transaction:
+            try:
+                self.connection.execute('BEGIN IMMEDIATE')
+            except sqlite3.Error as error:
+                if not is_busy(error):
+                    raise
+                busy_wait(0)
+                raise ConcurrentUpdate('Game {} is locked'.format(game.id)) from None
+
+    # Save the paddles a player has left. Committed by save_game_state().
+    @timed
+    def save_player_paddles(self, game, index, paddles):
+        self.connection.execute(
+            'UPDATE player SET paddles = ? '
+            'WHERE user_name = ? AND game_id = ?', [paddles_to_db(paddles), game.players[index].name, game.id])
+
+    # Save a paddle played in the current round. Committed by save_game_state().
+    @timed
+    def save_move(self, game, index, paddle):
+        try:
+            self.connection.execute(
+                'INSERT INTO move (game_id, round, player, paddle) VALUES (?, ?, ?, ?)',
+                [game.id, game.round, index, paddle])
+        except sqlite3.IntegrityError:
+            # The player already moved in this round, in a request that saved it after this game was loaded
+            self.connection.rollback()
+            raise ConcurrentUpdate('Game {} changed while saving a move'.format(game.id)) from None
 
-    def save_game_state(self):
-        """Save game state to database."""
+    # Save the scores of some players in one batch. Committed by save_game_state().
+    @timed
+    def save_scores(self, game, indexes):
+        self.connection.executemany(
+            'UPDATE player SET score = ? '
+            'WHERE user_name = ? AND game_id = ?',
+            [(game.players[index].score, game.players[index].name, game.id) for index in indexes])
+
+    # Add a game that just ended to the statistics of its players. Committed by save_game_state().
+    @timed
+    def save_game_over(self, game):
+        best = max(player.score for player in game.players)
+        self.connection.executemany(
+            'INSERT INTO user_stats (user_name, games, wins, points) VALUES (?, 1, ?, ?) '
+            'ON CONFLICT (user_name) DO UPDATE '
+            'SET games = games + 1, wins = wins + excluded.wins, points = points + excluded.points',
+            [(player.name, int(player.score == best), player.score) for player in game.players])
+
+    # Save state and round of the game and commit the move. Compare and swap: the game row is only updated if its
+    # version is still the one the game was loaded at. Otherwise the whole transaction is rolled back.
+    @timed
+    def save_game_state(self, game):
         cursor = self.connection.cursor()
         cursor.execute(
-            'UPDATE game SET turns = ?, ts = datetime() '
-            'WHERE rowid = ?', [json.dumps(self.turns), self.id])
+            'UPDATE game SET state = ?, round = ?, ts = datetime(), version = version + 1 '
+            'WHERE rowid = ? AND version = ? RETURNING ts, version',
+            [game.state, game.round, game.id, game.row_version])
+        row = cursor.fetchall()
+        if not row:
+            self.connection.rollback()
+            raise ConcurrentUpdate('Game {} changed while saving a move'.format(game.id))
         self.connection.commit()
+        return row[0]
+
+    # Stream the rows of one of the DUMP_TABLES in key order, fetching batch_size rows at a time.
+    # after is the key of the last row already seen (keyset pagination), limit caps the number of rows.
+    def dump_table(self, table, after=None, limit=None, batch_size=500):
+        key, columns = DUMP_TABLES[table]
+        sql = 'SELECT {} FROM {}'.format(', '.join(columns), table)
+        params = []
+        if after is not None:
+            sql += ' WHERE ({}) > ({})'.format(', '.join(key), ', '.join('?' * len(key)))
+            params.extend(after)
+        sql += ' ORDER BY {}'.format(', '.join(key))
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        # Sets of paddles are shown as the numbers of the paddles
+        paddle_columns = [i for i, column in enumerate(columns) if column in ('gamepaddles', 'paddles')]
+
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if paddle_columns:
+                for i, row in enumerate(rows):
+                    row = list(row)
+                    for column in paddle_columns:
+                        row[column] = ' '.join(str(n) for n in paddle_numbers(paddles_from_db(row[column])))
+                    rows[i] = tuple(row)
+            yield from rows
+
+    @timed
+    @retry_busy
+    def clear_tables(self, clear_all):
         cursor = self.connection.cursor()
-        cursor.execute('SELECT ts FROM game WHERE rowid = ?', [self.id])
-        self.ts = cursor.fetchone()[0]
+        if clear_all:
+            cursor.execute('DELETE FROM user')
+        cursor.execute('DELETE FROM game')
+        cursor.execute('DELETE FROM player')
+        cursor.execute('DELETE FROM move')
+        cursor.execute('DELETE FROM archived_game')
+        cursor.execute('DELETE FROM archived_player')
+        cursor.execute('DELETE FROM archived_move')
+        cursor.execute('DELETE FROM user_stats')
+        self.connection.commit()
+        self.pool.game_cache.clear()
+        bus.publish_all()
@@ -3,13 +3,16 @@
 # The table are:
 #    user: name, password
 #
-#    game: players, goal, state, ts, turns
+#    game: players, goal, state, ts, round, gamepaddles, version
 #       One line for each game.
 #       players = max number of players in the game
 #       goal = score (or number of rounds)
 #       state = 0=adding players, 1=game in progress, 2=game over
 #       ts = timestamp of last player added to game
-#       turns = text representation of the game history (who played what each turn)
+#       round = number of rounds started
+#       gamepaddles = the paddles every player starts with, a bitmask stored as a little-endian BLOB:
+#                     bit n - 1 is set if paddle n is in the set (e.g. 0b11111 for paddles 1 to 5)
+#       version = incremented by every change to the game, its players or its moves
 #
 #    player: game_id, user_name, score, playing, paddles
 #       One line for each player in each game.
@@ -17,43 +20,47 @@
 #       user_name = user name
 #       score = player's score
 #       playing = 0=left game, 1=in game
-#       paddles = text representation of which paddles are left to play (e.g. "12467" if 3 and 5 have been played)
+#       paddles = bitmask of the paddles left to play, like gamepaddles (e.g. 0b1101011 if 3 and 5 have been played)
+#
+#    move: game_id, round, player, paddle
+#       One line for each paddle played.
+#       round = round number, starting at 1
+#       player = position of the player in the game (players ordered by when they joined)
+#       paddle = value of the paddle played
+#
+#    archived_game, archived_player, archived_move
+#       Finished games moved out of game, player and move by pyro_archive.py, with the same columns.
+#       archived_game.game_id = the rowid the game had
+#       archived_player.position = position of the player in the game, like move.player
+#
+#    user_stats: user_name, games, wins, points
+#       One line for each user who finished a game, updated when a game ends.
+#       games = number of finished games
+#       wins = number of those games the user had the highest score in (shared wins count too)
+#       points = sum of the user's scores in those games
+#
+#    archive_version: id, version
+#       One line (id 0). version = incremented by every pyro_archive.py batch that moves games
 #
 import sqlite3
 
+from pyro_db_sqlite_migrate import migrate
+
 connection = sqlite3.connect('pyro_game.db')
 
 connection.execute('DROP TABLE IF EXISTS user')
 connection.execute('DROP TABLE IF EXISTS game')
 connection.execute('DROP TABLE IF EXISTS player')
+connection.execute('DROP TABLE IF EXISTS move')
+connection.execute('DROP TABLE IF EXISTS archived_game')
+connection.execute('DROP TABLE IF EXISTS archived_player')
+connection.execute('DROP TABLE IF EXISTS archived_move')
+connection.execute('DROP TABLE IF EXISTS user_stats')
+connection.execute('DROP TABLE IF EXISTS archive_version')
 
-connection.execute('''
-CREATE TABLE user (
- name VARCHAR(64) NOT NULL PRIMARY KEY,
- password VARCHAR(64) NOT NULL
-)
-''')
-
-connection.execute('''
-CREATE TABLE game (
- players INTEGER,
- goal INTEGER,
- state INTEGER DEFAULT 0,
- ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
- turns VARCHAR(4096) DEFAULT '[]',
- gamepaddles varchar(10)
-)
-''')
-
-connection.execute('''
-CREATE TABLE player (
- game_id INTEGER,
- user_name VARCHAR(64),
- score INTEGER DEFAULT 0,
- playing INTEGER DEFAULT 1,
- paddles VARCHAR(9),
- UNIQUE (game_id, user_name)
-)
-''')
-
+connection.execute('PRAGMA user_version = 0')
 connection.commit()
+
+# Create the tables and indexes by running every migration in pyro_db_sqlite_migrate.py.
+# To upgrade an existing database without erasing it, run pyro_db_sqlite_migrate.py instead.
+migrate(connection)
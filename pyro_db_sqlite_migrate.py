@@ -0,0 +1,340 @@
+"""
+Versioned schema migrations for the game database.
+
+The schema version is kept in SQLite's user_version pragma. Each entry in MIGRATIONS upgrades the database by one
+version and runs in its own transaction, so an existing pyro_game.db is upgraded in place without losing data.
+The connection pool in pyro_db_sqlite runs migrate() once before handing out the first connection.
+
+Run this module to upgrade pyro_game.db by hand, or with --check to list DB queries whose query plan falls back to
+a full table scan:
+
+    python pyro_db_sqlite_migrate.py [--check] [database]
+"""
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+
+def _base_schema(connection):
+    # The tables as created by the original pyro_db_sqlite_initialize.py. Databases made by that script already
+    # have them, so they are only created when missing.
+    connection.execute('''
+    CREATE TABLE IF NOT EXISTS user (
+     name VARCHAR(64) NOT NULL PRIMARY KEY,
+     password VARCHAR(64) NOT NULL
+    )
+    ''')
+    connection.execute('''
+    CREATE TABLE IF NOT EXISTS game (
+     players INTEGER,
+     goal INTEGER,
+     state INTEGER DEFAULT 0,
+     ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+     turns VARCHAR(4096) DEFAULT '[]',
+     gamepaddles varchar(10)
+    )
+    ''')
+    connection.execute('''
+    CREATE TABLE IF NOT EXISTS player (
+     game_id INTEGER,
+     user_name VARCHAR(64),
+     score INTEGER DEFAULT 0,
+     playing INTEGER DEFAULT 1,
+     paddles VARCHAR(9),
+     UNIQUE (game_id, user_name)
+    )
+    ''')
+
+
+def _lobby_indexes(connection):
+    # get_games_by_user, updated_games, and the "games the user is in" subqueries of get_registering_games_by_user
+    # look players up by user_name. The index covers playing and game_id, so the player table is never read.
+    # (game_id, user_name) lookups in join_game and quit_game use the UNIQUE index of the player table.
+    connection.execute('CREATE INDEX IF NOT EXISTS player_user_playing ON player (user_name, playing, game_id)')
+    # get_registering_games_by_user and updated_games look games up by state. Covering ts lets updated_games
+    # find max(ts) of the registering games without reading the game table.
+    connection.execute('CREATE INDEX IF NOT EXISTS game_state ON game (state, ts)')
+
+
+def _move_table(connection):
+    # One row per paddle played, instead of the whole game history as JSON in game.turns. A move writes one row,
+    # and the current round is read with one primary key range lookup. round counts the rounds started, which is the
+    # length of the old turns list. player is the position of the player in the game's player list.
+    connection.execute('''
+    CREATE TABLE move (
+     game_id INTEGER NOT NULL,
+     round INTEGER NOT NULL,
+     player INTEGER NOT NULL,
+     paddle INTEGER NOT NULL,
+     PRIMARY KEY (game_id, round, player)
+    ) WITHOUT ROWID
+    ''')
+    connection.execute('ALTER TABLE game ADD COLUMN round INTEGER DEFAULT 0')
+
+    # Convert the turns of existing games, a batch of games at a time
+    last_id = 0
+    while True:
+        batch = connection.execute(
+            'SELECT rowid, turns FROM game WHERE rowid > ? ORDER BY rowid LIMIT 500', [last_id]
+        ).fetchall()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+        moves = []
+        rounds = []
+        for game_id, turns in batch:
+            turns = json.loads(turns or '[]')
+            for round_number, turn in enumerate(turns, 1):
+                moves.extend((game_id, round_number, player, int(paddle))
+                             for player, paddle in enumerate(turn) if paddle is not None)
+            rounds.append((len(turns), game_id))
+        connection.executemany('INSERT INTO move (game_id, round, player, paddle) VALUES (?, ?, ?, ?)', moves)
+        connection.executemany('UPDATE game SET round = ? WHERE rowid = ?', rounds)
+
+    connection.execute('ALTER TABLE game DROP COLUMN turns')
+
+
+def _paddle_bitmasks(connection):
+    # Sets of paddles were text with one digit per paddle ("12467"), which cannot hold paddle 10 and up. They become
+    # bitmasks, bit n - 1 set if paddle n is in the set, stored as little-endian BLOBs of any length. SQLite's
+    # INTEGER would stop at 63 paddles.
+    for table, column in (('game', 'gamepaddles'), ('player', 'paddles')):
+        connection.execute('ALTER TABLE {0} RENAME COLUMN {1} TO {1}_text'.format(table, column))
+        connection.execute('ALTER TABLE {} ADD COLUMN {} BLOB'.format(table, column))
+        last_id = 0
+        while True:
+            batch = connection.execute(
+                'SELECT rowid, {}_text FROM {} WHERE rowid > ? ORDER BY rowid LIMIT 500'.format(column, table),
+                [last_id]
+            ).fetchall()
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            masks = []
+            for rowid, text in batch:
+                mask = sum(1 << (int(digit) - 1) for digit in set(text or '') if digit in '123456789')
+                masks.append((mask.to_bytes((mask.bit_length() + 7) // 8, 'little'), rowid))
+            connection.executemany('UPDATE {} SET {} = ? WHERE rowid = ?'.format(table, column), masks)
+        connection.execute('ALTER TABLE {0} DROP COLUMN {1}_text'.format(table, column))
+
+
+def _game_version(connection):
+    # Every write to a game, its players or its moves increments game.version. A move is only saved if the version
+    # is still the one the game was loaded with, so two requests moving in the same game at once cannot overwrite
+    # each other's changes.
+    connection.execute('ALTER TABLE game ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+
+def _archive_tables(connection):
+    # pyro_archive.py moves finished games out of game, player and move, so the tables read by the lobby and the
+    # game pages only hold the games being played and the recently finished ones. game_id is the id the game had;
+    # new games never get the id of an archived game. position is the place of the player in join order.
+    connection.execute('''
+    CREATE TABLE archived_game (
+     game_id INTEGER PRIMARY KEY,
+     players INTEGER,
+     goal INTEGER,
+     state INTEGER,
+     ts TIMESTAMP,
+     round INTEGER,
+     gamepaddles BLOB,
+     version INTEGER
+    )
+    ''')
+    connection.execute('''
+    CREATE TABLE archived_player (
+     game_id INTEGER NOT NULL,
+     position INTEGER NOT NULL,
+     user_name VARCHAR(64),
+     score INTEGER,
+     playing INTEGER,
+     paddles BLOB,
+     PRIMARY KEY (game_id, position)
+    ) WITHOUT ROWID
+    ''')
+    # The old games of a user, newest first
+    connection.execute('CREATE INDEX archived_player_user ON archived_player (user_name, game_id)')
+    connection.execute('''
+    CREATE TABLE archived_move (
+     game_id INTEGER NOT NULL,
+     round INTEGER NOT NULL,
+     player INTEGER NOT NULL,
+     paddle INTEGER NOT NULL,
+     PRIMARY KEY (game_id, round, player)
+    ) WITHOUT ROWID
+    ''')
+
+
+def _user_stats(connection):
+    # Totals of the finished games of every user, for the leaderboard. A game adds to them when it ends, so the
+    # leaderboard never reads the player table. Users are ranked by wins, then points; the index serves both the
+    # top of the leaderboard (read backwards) and the rank of a user (counting the entries above it).
+    connection.execute('''
+    CREATE TABLE user_stats (
+     user_name VARCHAR(64) NOT NULL PRIMARY KEY,
+     games INTEGER NOT NULL DEFAULT 0,
+     wins INTEGER NOT NULL DEFAULT 0,
+     points INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''')
+    connection.execute('CREATE INDEX user_stats_rank ON user_stats (wins, points)')
+
+    # Add up the games that ended before, archived ones included. Everybody with the highest score of a game wins it.
+    connection.execute('''
+    INSERT INTO user_stats (user_name, games, wins, points)
+    SELECT user_name, count(*), sum(score = best), sum(score) FROM (
+     SELECT user_name, score, max(score) OVER (PARTITION BY game_id) AS best
+     FROM player, game WHERE game.rowid = player.game_id AND state = 2
+     UNION ALL
+     SELECT user_name, score, max(score) OVER (PARTITION BY game_id) FROM archived_player
+    )
+    GROUP BY user_name
+    ''')
+
+
+def _archive_version(connection):
+    # Bumped by every pyro_archive.py batch that moves games. The job usually runs in a process of its own, which the
+    # change bus does not reach, so the lobby ETag includes this version to notice games that left the lobby.
+    connection.execute('CREATE TABLE archive_version (id INTEGER PRIMARY KEY, version INTEGER NOT NULL)')
+    connection.execute('INSERT INTO archive_version (id, version) VALUES (0, 0)')
+
+
+# MIGRATIONS[n] upgrades a database from version n to version n + 1.
+MIGRATIONS = [
+    _base_schema,
+    _lobby_indexes,
+    _move_table,
+    _paddle_bitmasks,
+    _game_version,
+    _archive_tables,
+    _user_stats,
+    _archive_version,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(connection):
+    """Return the schema version of the database."""
+    (version,) = connection.execute('PRAGMA user_version').fetchone()
+    return version
+
+
+def migrate(connection):
+    """Upgrade the database to SCHEMA_VERSION.
+
+    :param connection: sqlite3 connection to the database
+    :return: (old version, new version)
+    """
+    old_version = schema_version(connection)
+    if old_version > SCHEMA_VERSION:
+        raise RuntimeError('Database schema version {} is newer than this code ({})'.format(old_version, SCHEMA_VERSION))
+
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None  # Manage the transactions here, schema changes included
+    try:
+        for version in range(old_version, SCHEMA_VERSION):
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                # Another process may have upgraded the database while we waited for the lock
+                if schema_version(connection) != version:
+                    connection.execute('ROLLBACK')
+                    continue
+                MIGRATIONS[version](connection)
+                connection.execute('PRAGMA user_version = {:d}'.format(version + 1))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+    finally:
+        connection.isolation_level = isolation_level
+    return old_version, schema_version(connection)
+
+
+# A full table scan as SQLite 3.36 and later (SCAN game) and earlier versions (SCAN TABLE game AS g) word it
+_full_scan = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+def _exercise_db(db, game_class):
+    """Call every DB and game method once, using a small set of users and games.
+
+    dump_table() and clear_tables() are left out: they read or empty whole tables on purpose.
+    """
+    db.add_username('a', 'pw')
+    db.add_username('b', 'pw')
+    db.user_pass_valid('a', 'pw')
+    db.new_game(2, 3, 'a')
+    db.new_game(2, 3, 'a')
+    (game_id, *_), *_ = db.get_registering_games_by_user('b')
+    db.join_game(game_id, 'b')
+    db.get_games_by_user('a')
+    db.get_lobby_games('a', game_class)
+    db.updated_games('b')
+    *row, row_version = db.get_game_by_id(game_id)
+    game = game_class(game_id, *row, db, row_version=row_version)
+    game.add_player_move('a', '1')
+    game.add_player_move('b', '1')
+    db.updated_game(game_id)
+    game = db.load_game(game_id, game_class)
+    game.turns
+    for move in ('2', '3'):
+        game.add_player_move('a', move)
+        game.add_player_move('b', move)
+    db.quit_game(game_id, 'b')
+    (other_id, *_), *_ = db.get_registering_games_by_user('b')
+    db.quit_game(other_id, 'a')
+    db.archive_games('9999-12-31 23:59:59', 10)
+    db.archive_version()
+    db.get_archived_games_by_user('a', game_id + 1, 10)
+    db.load_archived_game(game_id, game_class)
+    db.get_leaderboard(10)
+    db.get_user_rank('a')
+    db.new_game(2, 3, 'a')
+
+
+def check_query_plans(game_class=None):
+    """Run every DB method against a scratch database and EXPLAIN QUERY PLAN each statement it issues.
+
+    :param game_class: Game class to exercise, pyro_pyramid.Pyramid by default
+    :return: List of (statement, plan detail) pairs where a table is read with a full scan
+    """
+    import pyro_db_sqlite
+    if game_class is None:
+        from pyro_pyramid import Pyramid as game_class
+
+    statements = []
+    with tempfile.TemporaryDirectory() as directory:
+        pool = pyro_db_sqlite.ConnectionPool(os.path.join(directory, 'check.db'))
+        with pyro_db_sqlite.DB(pool) as db:
+            db.connection.set_trace_callback(statements.append)
+            _exercise_db(db, game_class)
+            db.connection.set_trace_callback(None)
+
+            full_scans = []
+            for statement in dict.fromkeys(statements):
+                if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+                    continue
+                for _, _, _, detail in db.connection.execute('EXPLAIN QUERY PLAN ' + statement):
+                    if _full_scan.match(detail):
+                        full_scans.append((statement, detail))
+        pool.close_all()
+    return full_scans
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '--check' in args:
+        problems = check_query_plans()
+        for statement, detail in problems:
+            print('{}\n    {}'.format(statement, detail))
+        print('{} full table scans'.format(len(problems)))
+        sys.exit(1 if problems else 0)
+
+    path = args[0] if args else 'pyro_game.db'
+    connection = sqlite3.connect(path)
+    print('Schema version {} -> {}'.format(*migrate(connection)))
+    connection.close()
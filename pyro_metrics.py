@@ -0,0 +1,267 @@
+"""
+Request and SQL metrics in Prometheus text format.
+
+MetricsMiddleware times every request, from calling the application until the server closes the response, and
+records it by route and status code together with the response size and the number of SQL queries it ran.
+DB and Game methods decorated with @timed record their calls, duration and queries, including those of the methods
+they call. Queries are counted by a trace callback the connection pool installs on every connection.
+
+pyro_app serves the shared metrics object at /metrics:
+
+    curl http://localhost:8000/metrics
+
+With pyro_server --workers N, every worker process records its own requests. Workers share one listening socket, so
+a scrape reaches any one of them; each worker therefore broadcasts its metrics on the change bus every
+SHARE_INTERVAL seconds, and /metrics lists the metrics of all workers, each series with a worker label holding the
+pid. Those of the other workers are up to SHARE_INTERVAL seconds old. Sum over the label for totals, e.g.
+sum without (worker) (rate(pyro_requests_total[5m])).
+"""
+
+import functools
+import os
+import threading
+import time
+
+from pyro_templates import Response
+
+# Upper bounds of the histogram buckets. Long polls wait up to pyro_app.WAIT_TIMEOUT seconds.
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+SHARE_INTERVAL = 5  # seconds between two broadcasts of the metrics of a worker process
+
+_local = threading.local()  # queries: number of SQL queries run by this thread
+
+
+def count_query(statement):
+    """sqlite3 trace callback: count a statement run by this thread."""
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def queries():
+    """Return the number of SQL statements run by this thread so far."""
+    return getattr(_local, 'queries', 0)
+
+
+def _labels(names, values, worker=None):
+    if worker is not None:
+        names, values = ('worker', *names), (worker, *values)
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                    for name, value in zip(names, values))
+
+
+class Counter:
+    """A value per combination of labels that only goes up."""
+    kind = 'counter'
+
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}  # label values -> value
+
+    def add(self, labels, amount=1):
+        # Call with the lock of the Metrics object held
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self, values, worker=None):
+        for labels, value in sorted(values):
+            yield '{}{{{}}} {}'.format(self.name, _labels(self.label_names, labels, worker), value)
+
+
+class Histogram:
+    """Observations per combination of labels, counted in buckets of values up to a bound."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, label_names, buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}  # label values -> [count per bucket..., count, sum]
+
+    def observe(self, labels, value):
+        # Call with the lock of the Metrics object held
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += 1
+        counts[-1] += value
+
+    def lines(self, values, worker=None):
+        for labels, counts in sorted(values):
+            label_text = _labels(self.label_names, labels, worker)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '{}_bucket{{{},le="{}"}} {}'.format(self.name, label_text, bound, cumulative)
+            yield '{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label_text, counts[-2])
+            yield '{}_sum{{{}}} {}'.format(self.name, label_text, counts[-1])
+            yield '{}_count{{{}}} {}'.format(self.name, label_text, counts[-2])
+
+
+class Metrics:
+    """All metrics of the process, and those the other worker processes shared."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.worker = None  # worker label of the metrics of this process, set by share()
+        self.others = {}    # worker label -> (time received, metric name -> [[labels, value], ...])
+        self.share_interval = SHARE_INTERVAL
+        self.requests = Counter('pyro_requests_total', 'Requests handled.', ('route', 'status'))
+        self.request_seconds = Histogram(
+            'pyro_request_duration_seconds', 'Time from calling the application until the response was closed.',
+            ('route',), DURATION_BUCKETS
+        )
+        self.response_bytes = Histogram(
+            'pyro_response_size_bytes', 'Size of the response body as sent.', ('route',), SIZE_BUCKETS
+        )
+        self.request_queries = Counter('pyro_request_queries_total', 'SQL statements run by requests.', ('route',))
+        self.errors = Counter('pyro_request_errors_total', 'Requests that raised an exception.', ('route',))
+        self.method_seconds = Histogram(
+            'pyro_db_method_duration_seconds', 'Time spent in DB and Game methods.', ('method',), DURATION_BUCKETS
+        )
+        self.method_queries = Counter(
+            'pyro_db_method_queries_total', 'SQL statements run by DB and Game methods.', ('method',)
+        )
+        self.all = [
+            self.requests, self.request_seconds, self.response_bytes, self.request_queries, self.errors,
+            self.method_seconds, self.method_queries,
+        ]
+
+    def observe_request(self, route, status, seconds, size, query_count, error):
+        with self._lock:
+            self.requests.add((route, status))
+            self.request_seconds.observe((route,), seconds)
+            self.response_bytes.observe((route,), size)
+            self.request_queries.add((route,), query_count)
+            if error:
+                self.errors.add((route,))
+
+    def observe_method(self, method, seconds, query_count):
+        with self._lock:
+            self.method_seconds.observe((method,), seconds)
+            self.method_queries.add((method,), query_count)
+
+    def render(self):
+        """Return all metrics in Prometheus text format."""
+        lines = []
+        with self._lock:
+            # Forget the workers that stopped sharing, e.g. because they exited
+            expired = time.monotonic() - 3 * self.share_interval
+            self.others = {worker: other for worker, other in self.others.items() if other[0] > expired}
+            for metric in self.all:
+                lines.append('# HELP {} {}'.format(metric.name, metric.help))
+                lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+                lines.extend(metric.lines(metric.values.items(), self.worker))
+                for worker, (_, snapshot) in sorted(self.others.items()):
+                    values = [(tuple(labels), value) for labels, value in snapshot.get(metric.name, ())]
+                    lines.extend(metric.lines(values, worker))
+        return '\n'.join(lines) + '\n'
+
+    def share(self, bus, interval=SHARE_INTERVAL):
+        """Exchange metrics with the other worker processes, so that each of them can render those of all.
+
+        :param bus: pyro_changes.ChangeBus shared with the other processes
+        :param interval: Seconds between two broadcasts of the metrics of this process
+        """
+        self.worker = str(os.getpid())
+        self.share_interval = interval
+        bus.listen('metrics', self._receive)
+        threading.Thread(target=self._broadcast, args=(bus,), daemon=True).start()
+
+    def _broadcast(self, bus):
+        while True:
+            time.sleep(self.share_interval)
+            with self._lock:
+                snapshot = {metric.name: [[list(labels), value] for labels, value in metric.values.items()]
+                            for metric in self.all}
+            try:
+                bus.broadcast('metrics', {'worker': self.worker, 'metrics': snapshot})
+            except OSError:
+                return  # The supervisor is gone, the worker is stopping
+
+    def _receive(self, data):
+        # The metrics of another worker
+        with self._lock:
+            self.others[data['worker']] = (time.monotonic(), data['metrics'])
+
+
+# The metrics shared by the whole process
+metrics = Metrics()
+
+
+def timed(method):
+    """Decorator recording the calls, duration and SQL queries of a DB or Game method in metrics."""
+    name = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        query_count = queries()
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            metrics.observe_method(name, time.perf_counter() - started, queries() - query_count)
+    return wrapper
+
+
+class MetricsMiddleware:
+    """WSGI middleware recording every request of app in a Metrics object."""
+    def __init__(self, app, routes, metrics_=None):
+        """
+        :param app: The WSGI application
+        :param routes: The paths the application serves. Other paths are recorded as route "other".
+        :param metrics_: Metrics object, the shared one if None
+        """
+        self.app = app
+        self.routes = frozenset(routes)
+        self.metrics = metrics_ or metrics
+
+    def __call__(self, e, start_response):
+        path = e.get('PATH_INFO') or '/'
+        route = path if path in self.routes else 'other'
+        response = {'status': '500', 'size': 0}
+        query_count = queries()
+        started = time.perf_counter()
+
+        def recording_start_response(status, headers, exc_info=None):
+            response['status'] = status[:3]
+            return start_response(status, headers, exc_info)
+
+        def record(error=False):
+            self.metrics.observe_request(
+                route, response['status'], time.perf_counter() - started, response['size'], queries() - query_count,
+                error
+            )
+
+        try:
+            body = self.app(e, recording_start_response)
+        except BaseException:
+            record(error=True)
+            raise
+
+        if isinstance(body, list):  # Short reply, already complete
+            response['size'] = sum(len(data) for data in body)
+            record()
+            return body
+
+        def counted():
+            try:
+                for data in body:
+                    response['size'] += len(data)
+                    yield data
+            except BaseException:
+                response['error'] = True
+                raise
+
+        def close():
+            try:
+                if hasattr(body, 'close'):
+                    body.close()
+            finally:
+                record(response.get('error', False))
+
+        return Response(counted(), close)
@@ -4,49 +4,92 @@ The code below is still the same as for Rock-Paper-Scissors.
 Modify to implement the Pyramid game.
 """
 
-from pyro_db_sqlite import Game
+from pyro_metrics import timed
+from pyro_storage import Game, ConcurrentUpdate, MOVE_ATTEMPTS, paddle_numbers
+
+
+def round_winners(turn):
+    """Return the positions of the players who played the highest paddle in a complete round.
+
+    :param turn: The paddle of every player
+    """
+    maxpaddle = max(turn)
+    return [index for index, paddle in enumerate(turn) if paddle == maxpaddle]
+
+
+def score_round(turn):
+    """Return the points every player gets for a complete round.
+
+    The rules of the game, free of any database access, so pyro_simulate can play them in memory.
+
+    :param turn: The paddle of every player
+    :return: List of points, 2 for the only player with the highest paddle, 1 each if several played it, else 0
+    """
+    winners = round_winners(turn)
+    points = [0] * len(turn)
+    for index in winners:
+        points[index] = 2 if len(winners) == 1 else 1
+    return points
 
 
 class Pyramid(Game):
+    __slots__ = ()
+
     # valid move logic goes here
     def valid_moves(self, username):
-        """Return list of pairs with valid moves for this player and how to display them.
+        """Return the paddles this player can still play.
 
         :param username: The moves valid for this user
-        :return: List of pairs
+        :return: List of paddle numbers, lowest first
 
-        self.players contains a list of dictionaries - one dictionary per player.
-        Each dictionary has the player variables for the players in the game.
+        self.players contains a list of Player records - one record per player.
+        Each record has the player variables for the players in the game.
 
         Example:
         [
-        {'name': 'a', 'score': 0, 'playing': 1, 'paddles': '13456'},
-        {'name': 'b', 'score': 1, 'playing': 1, 'paddles': '12345'},
-        {'name': 'c', 'score': 0, 'playing': 1, 'paddles': '12356'}
+        Player(name='a', score=0, playing=1, paddles=0b111101),
+        Player(name='b', score=1, playing=1, paddles=0b11111),
+        Player(name='c', score=0, playing=1, paddles=0b110111)
         ]
+
+        paddles is a bitmask: bit n - 1 is set if the player still has paddle n.
         """
 
-        # First, get the index in the list for the dictionary that coresponds to username
+        # First, get the index in the list for the record that coresponds to username
         # Example: If username = 'b', index = 1
         index = self.player_index(username)
 
         # Now, retrieve the paddles for username
-        # Example: '12345'
-        paddles = self.players[index]['paddles']
+        # Example: 0b11111
+        paddles = self.players[index].paddles
 
-        # Explode the paddles string into a list of individual characters
+        # Explode the bitmask into a list of paddle numbers
         # Example: [1, 2, 3, 4, 5]
-        mval = list(paddles)
+        mval = paddle_numbers(paddles)
 
         return mval
 
     # a player just played a paddle
+    @timed
     def add_player_move(self, username, move):
         """Add a new move by a player to the game.
 
+        If another request changes the game at the same time, the move is not saved (see Game.save_game_state).
+        The game is then read again and the move tried on the new state, up to MOVE_ATTEMPTS times.
+
         :param username: Username of player who moves
         :param move: The value of the paddle that was played
         """
+        for _ in range(MOVE_ATTEMPTS - 1):
+            try:
+                return self._add_player_move(username, move)
+            except ConcurrentUpdate:
+                if not self.reload():
+                    return  # The game was deleted
+        self._add_player_move(username, move)
+
+    def _add_player_move(self, username, move):
+        """Add a move to the game as loaded. Raises ConcurrentUpdate if the game changed in the meantime."""
         # Discard move if Game not in play (i.e. state != 1)
         if self.state != 1:
             return
@@ -55,58 +98,46 @@ class Pyramid(Game):
         # In the case of RPS games this value will be 0 or 1 since RPS always has 2 players.
         index = self.player_index(username)
 
-        # Update the paddles for this player to remove the paddle just played.
-        old_paddles = self.players[index]['paddles']
-        new_paddles = old_paddles.replace(move, '')
-        # Now update the player table
-        self.update_player_paddles(index, new_paddles)
+        # Discard paddles the player does not have (anymore): test the paddle's bit
+        try:
+            paddle = int(move)
+        except ValueError:
+            return
+        paddle_bit = 1 << (paddle - 1) if paddle > 0 else 0
+        if not self.players[index].paddles & paddle_bit:
+            return
 
+        last_turn = self.last_turn
 
         # If there are no game rounds yet, or the last one is complete
-        if not self.turns or not [None for m in self.turns[-1] if m is None]:  # No turns or last complete
-            new_turn = [None] * len(self.players)
-            new_turn[index] = move
-            self.turns.append(new_turn)
+        if not last_turn or not [None for m in last_turn if m is None]:  # No turns or last complete
+            self.begin_move()
+            # Update the paddles for this player to remove the paddle just played.
+            self.update_player_paddles(index, self.players[index].paddles & ~paddle_bit)
+            new_turn = self.start_turn()
+            new_turn[index] = paddle
+            self.save_move(index, paddle)
             self.save_game_state()
 
         # If opponent(s) moved in last round but user has not
-        elif self.turns[-1][index] is None:
-            last_turn = self.turns[-1]
-            last_turn[index] = move
+        elif last_turn[index] is None:
+            self.begin_move()
+            self.update_player_paddles(index, self.players[index].paddles & ~paddle_bit)
+            last_turn[index] = paddle
+            self.save_move(index, paddle)
             # Check if turn is complete and if so calculate scores
             if not [None for m in last_turn if m is None]:
-                # First, find the max value in the list
-                maxpaddle = max(last_turn)
-
-                # Next, find the players that played the value of maxpaddle
-                # The index of the winning players will be added to the winners list
-                start_at = -1
+                # Score the round: the only player with the highest paddle gets 2 points, or if several players
+                # played the highest paddle, they get 1 point each
                 winners = []
-
-                while True:
-                    try:
-                        player_index = last_turn.index(maxpaddle, start_at+1)
-                    except ValueError:
-                        break
-                    else:
+                for player_index, points in enumerate(score_round(last_turn)):
+                    if points:
+                        self.players[player_index].score += points
                         winners.append(player_index)
-                        start_at = player_index
-
-                # Only one winner?  If so, they get 2 points
-                if len(winners) == 1:
-                    self.players[winners[0]]['score'] +=2
-                    self.save_score_for_player(winners[0])
-
-                # If more than one winner, each gets 1 point
-                i = 0
-                if len(winners) > 1:
-                    while i < len(winners):
-                        self.players[winners[i]]['score'] +=1
-                        self.save_score_for_player(winners[i])
-                        i += 1
+                self.save_scores(winners)  # One batch for all winners
 
                 # Check to see if the number of turns is greater than the goal (rounds in the game)
-                if len(self.turns) == self.goal:
+                if self.round == self.goal:
                     self.set_game_over()
 
             self.save_game_state()
@@ -182,10 +213,10 @@ class Pyramid(Game):
         """
         if self.state != 1:  # Game not in play
             return False
-        if not self.turns:  # Nobody has made any moves yet
+        if not self.round:  # Nobody has made any moves yet
             return True
 
-        latest_turn = self.turns[-1]
+        latest_turn = self.last_turn
         if not latest_turn[self.player_index(username)]:  # User not yet moved in latest turn
             return True
         if not [None for m in latest_turn if m is None]:  # Latest turn is complete, start new turn
@@ -0,0 +1,516 @@
+"""
+Production web server for the game.
+
+Runs a WSGI application (pyro_app.create_app() by default) on a fixed pool of worker threads:
+
+- One thread accepts connections and hands them to the workers through a bounded queue. When the queue is full the
+  acceptor stops accepting, and further clients wait in the listen backlog instead of piling up in memory.
+- Connections speak HTTP/1.1 and are kept alive between requests, so the polling pages reuse one connection.
+  Responses without a Content-Length are sent with chunked transfer encoding.
+- Between two requests, a kept-alive connection waits in a selector, not in a worker thread. It goes back into the
+  queue when the next request arrives, and is closed when it stays idle for --keepalive seconds.
+
+A long poll (/wait_games, /wait_game) holds a worker thread while it waits. At most --waiters of them wait at the same
+time, fewer than the threads, so the other requests always find a free thread. Beyond that the application answers
+that it cannot push changes, and the page polls instead. The limit is passed to the application as a semaphore in
+the environ key pyro.waiters.
+
+With --workers N, a Supervisor forks N worker processes that share the listening socket, each with its own threads
+and database connections, so page rendering can use N cores (Unix only). SIGHUP replaces the workers gracefully,
+SIGTERM or Ctrl-C stops them. /metrics then shows the metrics of every worker, with a worker label (see pyro_metrics).
+
+    python pyro_server.py [--host HOST] [--port PORT] [--threads N] [--queue N] [--backlog N] [--keepalive SECONDS]
+                          [--waiters N] [--workers N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import selectors
+import signal
+import socket
+import threading
+import time
+import traceback
+import wsgiref.simple_server
+
+from pyro_changes import bus
+from pyro_metrics import metrics
+
+THREADS = 64            # worker threads
+QUEUE_SIZE = 128        # accepted connections waiting for a worker
+BACKLOG = 128           # connections waiting in the kernel to be accepted
+KEEPALIVE_TIMEOUT = 5   # seconds an idle keep-alive connection is kept open
+FREE_THREADS = 0.25     # share of the threads long polls cannot take, at least one
+DRAIN_TIMEOUT = 30      # seconds a stopping worker process waits for its requests in progress, long polls included
+RESTART_DELAY = 1       # seconds between restarts of a worker process that keeps exiting
+
+
+class ServerHandler(wsgiref.simple_server.ServerHandler):
+    """Runs the application for one request and sends a response that can keep the connection alive."""
+    http_version = '1.1'
+    wsgi_multithread = True
+
+    keep_alive = False
+    chunked = False
+
+    def cleanup_headers(self):
+        super().cleanup_headers()  # Sets Content-Length if the application returned a single chunk
+        request_handler = self.request_handler
+        self.chunked = False
+        if 'Content-Length' not in self.headers and self.status[:3] not in ('204', '304'):
+            if request_handler.request_version == 'HTTP/1.1':
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+            else:
+                # The end of the body can only be told by closing the connection
+                request_handler.close_connection = True
+        if request_handler.server.draining:
+            request_handler.close_connection = True
+        self.keep_alive = not request_handler.close_connection
+        if not self.keep_alive:
+            self.headers['Connection'] = 'close'
+
+    def write(self, data):
+        if self.status and not self.headers_sent:
+            self.bytes_sent = len(data)  # Content-Length of a single chunk response
+            self.send_headers()  # Decides on chunked encoding
+            self.bytes_sent = 0
+        if self.chunked:
+            if not data:
+                return  # An empty chunk would end the response
+            data = b'%X\r\n%s\r\n' % (len(data), data)
+        super().write(data)
+
+    def finish_content(self):
+        if not self.headers_sent and self.status[:3] in ('204', '304'):
+            self.send_headers()  # No body, and unlike the base class, no Content-Length: 0 either
+        super().finish_content()
+        if self.chunked:
+            self._write(b'0\r\n\r\n')
+            self._flush()
+
+    def handle_error(self):
+        self.request_handler.close_connection = True
+        super().handle_error()
+
+
+class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """Handles the requests on one connection, one request each time the server calls handle()."""
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
+    def __init__(self, request, client_address, server):
+        # Unlike the base class, only set up the connection. The server calls handle() whenever a request arrives,
+        # and finish() when the connection is closed.
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def handle(self):
+        """Handle the next request. close_connection tells whether the connection can be kept alive."""
+        self.close_connection = True
+        self.handle_one_request()
+
+    def input_pending(self):
+        """Return True if data of the next request is waiting, in the buffer of rfile or in the socket."""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return True  # handle() will find out what is wrong
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:  # Client closed the connection
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+
+        if not self.parse_request():  # An error code has been sent, parse_request() decides on closing
+            return
+        if self.headers.get('Content-Length', '0') != '0':
+            # The game only uses GET. Do not try to find the next request behind a body the application did not read.
+            self.close_connection = True
+
+        handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+        handler.request_handler = self  # backpointer for logging and keep-alive
+        handler.run(self.server.get_app())
+        self.wfile.flush()
+
+
+class PooledWSGIServer(wsgiref.simple_server.WSGIServer):
+    """WSGI server that serves connections on a fixed pool of worker threads."""
+    draining = False  # True once drain() started: finish the requests in progress, keep no connection alive
+
+    def __init__(self, server_address, threads=THREADS, queue_size=QUEUE_SIZE, backlog=BACKLOG,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, waiters=None, handler_class=RequestHandler, listener=None):
+        """
+        :param waiters: Most long polls waiting at the same time. By default FREE_THREADS of the threads, and at
+            least one, are kept for the other requests.
+        :param listener: Socket already listening, e.g. one shared by several worker processes. server_address is
+            not used then.
+        """
+        self.request_queue_size = backlog  # listen() backlog, used by the base class
+        handler_class = type(handler_class.__name__, (handler_class,), {'timeout': keepalive_timeout})
+        super().__init__(server_address, handler_class, bind_and_activate=listener is None)
+        if listener is not None:
+            self.socket.close()
+            self.socket = listener
+            self.server_address = listener.getsockname()
+            host, port = self.server_address[:2]
+            self.server_name = socket.getfqdn(host)
+            self.server_port = port
+            self.setup_environ()
+        if waiters is None:
+            waiters = threads - max(1, int(threads * FREE_THREADS))
+        self.base_environ['pyro.waiters'] = threading.BoundedSemaphore(max(0, waiters))
+        self.keepalive_timeout = keepalive_timeout
+        self._connections = queue.Queue(queue_size)
+        # Kept-alive connections between two requests: handler -> time when it is closed if no request came
+        self._idle = {}
+        self._idle_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_write.setblocking(False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        self._idle_thread = threading.Thread(target=self._watch_idle, daemon=True)
+        self._idle_thread.start()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(threads)]
+        for worker in self._workers:
+            worker.start()
+
+    def process_request(self, request, client_address):
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        # Blocks while the queue is full, which stops the accept loop
+        self._connections.put(handler)
+
+    def _work(self):
+        while True:
+            handler = self._connections.get()
+            if handler is None:
+                return
+            try:
+                handler.handle()
+            except Exception:
+                handler.close_connection = True
+                self.handle_error(handler.request, handler.client_address)
+            if handler.close_connection or self.draining:
+                self._close(handler)
+            elif handler.input_pending():
+                self._connections.put(handler)  # A pipelined request
+            else:
+                self._park(handler)
+
+    def _close(self, handler):
+        try:
+            handler.finish()
+        except OSError:
+            pass  # The client is gone
+        self.shutdown_request(handler.request)
+
+    def _park(self, handler):
+        # Let the idle thread watch the connection until the next request arrives
+        with self._idle_lock:
+            self._idle[handler] = time.monotonic() + self.keepalive_timeout
+            self._selector.register(handler.connection, selectors.EVENT_READ, handler)
+        self._wake_idle_thread()
+
+    def _wake_idle_thread(self):
+        try:
+            self._wakeup_write.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # A wakeup is pending already, or the server is closed
+
+    def _watch_idle(self):
+        while True:
+            with self._idle_lock:
+                deadlines = list(self._idle.values())
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            events = self._selector.select(timeout)
+            ready = []
+            with self._idle_lock:
+                for key, _ in events:
+                    if key.fileobj is self._wakeup_read:
+                        self._wakeup_read.recv(4096)
+                    elif key.data in self._idle:
+                        ready.append(key.data)
+                now = time.monotonic()
+                closing = self.draining
+                expired = [handler for handler, deadline in self._idle.items()
+                           if (closing or deadline <= now) and handler not in ready]
+                for handler in ready + expired:
+                    del self._idle[handler]
+                    self._selector.unregister(handler.connection)
+            for handler in expired:
+                self._close(handler)
+            for handler in ready:
+                if closing:
+                    self._close(handler)
+                else:
+                    self._connections.put(handler)  # Blocks while the queue is full
+            if closing:
+                return
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._connections.put(None)
+        self._wake_idle_thread()  # Closes the idle connections when draining
+
+    def drain(self, timeout):
+        """Stop accepting connections and wait up to timeout seconds for the requests in progress to finish.
+        Call after serve_forever() returned."""
+        self.draining = True
+        self.server_close()
+        deadline = time.monotonic() + timeout
+        for worker in self._workers + [self._idle_thread]:
+            worker.join(max(0.0, deadline - time.monotonic()))
+
+
+def make_server(host, port, app, **options):
+    """Create a PooledWSGIServer for app. options are passed on to PooledWSGIServer."""
+    server = PooledWSGIServer((host, port), **options)
+    server.set_app(app)
+    return server
+
+
+def serve_worker(listener, app_factory, connection, counter, server_options):
+    """Serve the application in a worker process forked by a Supervisor, until it sends SIGTERM.
+
+    :param listener: The listening socket shared by all workers
+    :param connection: Socket to the supervisor, which passes changes on to the other workers
+    :param counter: multiprocessing.Value with the sequence number shared by the change buses of all workers
+    :param server_options: Keyword arguments for PooledWSGIServer
+    """
+    server = PooledWSGIServer(None, listener=listener, **server_options)
+
+    def stop(*args):
+        threading.Thread(target=server.shutdown, daemon=True).start()  # Blocks until serve_forever() returns
+
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the supervisor too, which stops the workers
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, stop)
+    bus.share(counter, connection, on_disconnect=stop)  # Stop when the supervisor is gone
+    metrics.share(bus)  # /metrics lists the metrics of every worker, whichever one is scraped
+    server.set_app(app_factory())  # After the fork, so the worker opens its own database connections
+    server.serve_forever()
+    server.drain(DRAIN_TIMEOUT)
+
+
+class Supervisor:
+    """Runs the server in worker processes forked from this one, which share its listening socket.
+
+    Every worker has its own threads, connection pool and game cache. The supervisor passes every change a worker
+    publishes on its change bus on to the other workers (see ChangeBus.share), so long polls wake up and cached
+    games are refreshed whichever worker made the change. It records the changes on its own bus as well: a worker
+    forked later starts out with the current versions.
+
+    SIGHUP starts new workers and lets the old ones finish their requests. SIGTERM and SIGINT stop all workers the
+    same way, then the supervisor. A worker that exits otherwise is replaced.
+    """
+    def __init__(self, listener, app_factory, workers, server_options):
+        """
+        :param listener: Listening socket
+        :param app_factory: Function returning the WSGI application, called in every worker
+        :param workers: Number of worker processes
+        :param server_options: Keyword arguments for PooledWSGIServer
+        """
+        self.listener = listener
+        listener.setblocking(False)  # All workers wake up for a new connection, one gets it
+        self.app_factory = app_factory
+        self.size = workers
+        self.server_options = server_options
+        self.counter = multiprocessing.Value('q', 0)  # latest sequence number of all change buses
+        self.selector = selectors.DefaultSelector()
+        self.wakeup = ()
+        self.workers = {}   # pid -> [socket to the worker, start time, unprocessed data received]
+        self.retiring = set()  # pids of workers told to stop, not to be replaced
+        self.restarts = []  # times when to start a replacement worker
+        self.signals = []
+        self.stopping = False
+
+    def run(self):
+        """Start the workers and supervise them until stopped by a signal."""
+        # Signals are handled in the loop below. The wakeup socket ends the wait for the workers' messages.
+        wakeup_read, wakeup_write = self.wakeup = socket.socketpair()
+        wakeup_write.setblocking(False)
+        signal.set_wakeup_fd(wakeup_write.fileno())
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        self.selector.register(wakeup_read, selectors.EVENT_READ)
+
+        for _ in range(self.size):
+            self.start_worker()
+        stop_deadline = None
+        while self.workers or not self.stopping:
+            timeout = 1.0
+            if self.restarts:
+                timeout = max(0.0, min(timeout, self.restarts[0] - time.monotonic()))
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is wakeup_read:
+                    wakeup_read.recv(4096)
+                else:
+                    self.relay(key.data)
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+                    self.stopping = True
+                    stop_deadline = time.monotonic() + DRAIN_TIMEOUT + 5
+                    self.stop_workers()
+                elif signum == signal.SIGHUP and not self.stopping:
+                    print('Replacing the workers')
+                    old = list(self.workers)
+                    for _ in range(self.size):
+                        self.start_worker()
+                    self.stop_workers(old)
+            self.reap()
+            while self.restarts and self.restarts[0] <= time.monotonic() and not self.stopping:
+                self.restarts.pop(0)
+                self.start_worker()
+            if stop_deadline is not None and time.monotonic() > stop_deadline:
+                self.stop_workers(signum=signal.SIGKILL)
+        self.listener.close()
+
+    def start_worker(self):
+        supervisor_end, worker_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self.selector.close()
+                for connection in [supervisor_end, *self.wakeup] + [c for c, _, _ in self.workers.values()]:
+                    connection.close()
+                serve_worker(self.listener, self.app_factory, worker_end, self.counter, self.server_options)
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        worker_end.close()
+        self.workers[pid] = [supervisor_end, time.monotonic(), b'']
+        self.selector.register(supervisor_end, selectors.EVENT_READ, pid)
+
+    def stop_workers(self, pids=None, signum=signal.SIGTERM):
+        for pid in list(self.workers) if pids is None else pids:
+            self.retiring.add(pid)
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def relay(self, pid):
+        """Pass the changes a worker published on to the other workers, and record them here."""
+        connection, started, pending = self.workers[pid]
+        try:
+            data = connection.recv(65536)
+        except ConnectionError:
+            data = b''
+        if not data:  # The worker exited
+            self._unregister(connection)
+            return
+        *messages, self.workers[pid][2] = (pending + data).split(b'\n')
+        if not messages:
+            return
+        for message in messages:
+            bus.receive(message)
+        data = b''.join(message + b'\n' for message in messages)
+        for other_pid, (other, _, _) in self.workers.items():
+            if other_pid != pid:
+                try:
+                    other.sendall(data)
+                except OSError:
+                    pass  # Exiting, it will be reaped
+
+    def _unregister(self, connection):
+        try:
+            self.selector.unregister(connection)
+        except KeyError:
+            pass  # Already unregistered
+
+    def reap(self):
+        """Collect exited workers and schedule their replacements."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid not in self.workers:
+                continue
+            connection, started, _ = self.workers.pop(pid)
+            self._unregister(connection)
+            connection.close()
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif not self.stopping:
+                print('Worker {} exited with status {}, restarting it'.format(pid, os.waitstatus_to_exitcode(status)))
+                self.restarts.append(max(time.monotonic(), started + RESTART_DELAY))
+                self.restarts.sort()
+
+
+def main(app_factory=None, args=None):
+    """Parse the command line and serve the application until interrupted.
+
+    :param app_factory: Function returning the WSGI application, pyro_app.create_app by default
+    """
+    parser = argparse.ArgumentParser(description='Serve the Pyromid game.')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--threads', type=int, default=THREADS, help='worker threads')
+    parser.add_argument('--queue', type=int, default=QUEUE_SIZE, help='accepted connections waiting for a worker')
+    parser.add_argument('--backlog', type=int, default=BACKLOG, help='connections waiting to be accepted')
+    parser.add_argument('--keepalive', type=float, default=KEEPALIVE_TIMEOUT, help='idle keep-alive timeout')
+    parser.add_argument('--waiters', type=int, help='long polls waiting at the same time (default: 3/4 of threads)')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes (default: serve in this process)')
+    options = parser.parse_args(args)
+
+    if app_factory is None:
+        from pyro_app import create_app as app_factory
+
+    if options.workers:
+        listener = socket.create_server((options.host, options.port), backlog=options.backlog)
+        print('Serving on port {} with {} workers of {} threads'.format(options.port, options.workers, options.threads))
+        Supervisor(listener, app_factory, options.workers, {
+            'threads': options.threads, 'queue_size': options.queue, 'backlog': options.backlog,
+            'keepalive_timeout': options.keepalive, 'waiters': options.waiters,
+        }).run()
+        return
+
+    server = make_server(
+        options.host, options.port, app_factory(), threads=options.threads, queue_size=options.queue,
+        backlog=options.backlog, keepalive_timeout=options.keepalive, waiters=options.waiters
+    )
+    print('Serving on port {} with {} threads'.format(options.port, options.threads))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
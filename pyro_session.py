@@ -0,0 +1,157 @@
+"""
+Signed session tokens.
+
+Logging in gives the browser a session cookie holding a token issued by the server:
+
+    base64(username).expires.nonce.signature
+
+The signature is an HMAC of the rest of the token, so the server can tell a valid token from a forged one without a
+database lookup. Tokens expire after SESSION_LIFETIME seconds and can be revoked before that, e.g. on logout.
+
+Checked tokens are kept in an LRU cache, so the polling endpoints identify the user with a dict lookup instead of
+checking the signature again. Revocations live in memory, as does the secret unless PYRO_SESSION_SECRET is set:
+without it, restarting the server logs everybody out.
+
+When pyro_server runs several worker processes, revocations are broadcast on the change bus, so every worker
+forgets the revoked token. revoke_all() derives the new secret from the old one, so all workers that apply it end
+up with the same secret and accept each other's new tokens.
+"""
+
+import base64
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from pyro_changes import bus as default_bus
+
+SESSION_LIFETIME = 7 * 24 * 3600  # seconds a session token is valid
+CACHE_SIZE = 10000                # checked tokens kept in memory
+REVOKED_KEPT = 1000               # expired revocations are forgotten once there are twice this many
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class SessionManager:
+    """Issues, checks and revokes session tokens."""
+    def __init__(self, secret=None, lifetime=SESSION_LIFETIME, cache_size=CACHE_SIZE, bus=None):
+        """
+        :param secret: Key for signing tokens as bytes. PYRO_SESSION_SECRET or a random key if None.
+        :param lifetime: Seconds a token is valid
+        :param cache_size: Number of checked tokens kept in memory
+        :param bus: pyro_changes.ChangeBus that revocations are broadcast on to the other processes, None if the
+            tokens are only checked in this process
+        """
+        if secret is None:
+            secret = os.environ.get('PYRO_SESSION_SECRET', '').encode() or os.urandom(32)
+        self.secret = secret
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()  # token -> (username, expires), least recently used first
+        self._revoked = {}  # token -> expires, forgotten once the token has expired anyway
+        self._revoked_kept = REVOKED_KEPT  # revocations left after expired ones were last forgotten
+        self.bus = bus
+        if bus is not None:
+            bus.listen('sessions', self._receive)
+
+    def _sign(self, payload):
+        return _encode(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, username):
+        """Return a new token for username."""
+        expires = int(time.time()) + self.lifetime
+        payload = '{}.{}.{}'.format(_encode(username.encode()), expires, _encode(os.urandom(8)))
+        token = '{}.{}'.format(payload, self._sign(payload))
+        with self._lock:
+            self._remember(token, username, expires)
+        return token
+
+    def verify(self, token):
+        """Return the username of a valid token, or None if the token is forged, expired or revoked."""
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(token)
+            if cached is not None:
+                username, expires = cached
+                if expires > now:
+                    self._cache.move_to_end(token)
+                    return username
+                del self._cache[token]
+                return None
+
+        try:
+            encoded_username, expires, nonce, signature = token.split('.')
+            expires = int(expires)
+            username = _decode(encoded_username).decode()
+        except ValueError:  # Includes bad base64 and UTF-8
+            return None
+        if not hmac.compare_digest(signature, self._sign(token.rpartition('.')[0])) or expires <= now:
+            return None
+
+        with self._lock:
+            if token in self._revoked:
+                return None
+            self._remember(token, username, expires)
+        return username
+
+    def revoke(self, token):
+        """Make token invalid before it expires. Forged, expired and already revoked tokens are ignored."""
+        if self.verify(token) is None:
+            return
+        self._revoke(token)
+        if self.bus is not None:
+            self.bus.broadcast('sessions', ['revoke', token])
+
+    def revoke_all(self):
+        """Make every token issued so far invalid, e.g. after the users were deleted."""
+        self._revoke_all()
+        if self.bus is not None:
+            self.bus.broadcast('sessions', ['revoke_all'])
+
+    def _receive(self, message):
+        # A revocation made in another process
+        if message[0] == 'revoke':
+            self._revoke(message[1])
+        elif message[0] == 'revoke_all':
+            self._revoke_all()
+
+    def _revoke(self, token):
+        # Only called with tokens that verify() accepted, here or in the process that broadcast the revocation
+        now = time.time()
+        with self._lock:
+            self._cache.pop(token, None)
+            self._revoked[token] = int(token.split('.')[1])
+            # Forget expired revocations once the dict has doubled since the last time, so a logout costs O(1) on
+            # average
+            if len(self._revoked) >= 2 * self._revoked_kept:
+                self._revoked = {t: expires for t, expires in self._revoked.items() if expires > now}
+                self._revoked_kept = max(len(self._revoked), REVOKED_KEPT)
+
+    def _revoke_all(self):
+        with self._lock:
+            # Every process makes the same new secret. Two revoke_all() at the same time in different processes
+            # make the same secret too, whatever order each process applies them in.
+            self.secret = hmac.new(self.secret, b'revoke_all', hashlib.sha256).digest()
+            self._cache.clear()
+            self._revoked.clear()
+            self._revoked_kept = REVOKED_KEPT
+
+    def _remember(self, token, username, expires):
+        # Call with the lock held
+        self._cache[token] = (username, expires)
+        self._cache.move_to_end(token)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+# The session manager shared by the whole process
+sessions = SessionManager(bus=default_bus)
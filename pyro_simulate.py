@@ -0,0 +1,232 @@
+"""
+Headless Pyramid simulations.
+
+Plays whole games in memory with bots, using the scoring rules of pyro_pyramid (score_round), so rule changes and
+strategies can be tried on millions of games without a database or a browser. Batches of games are spread over a
+process pool.
+
+Every player starts with paddles 1 to goal and plays one of them each round. All players choose at the same time,
+seeing the rounds played so far. The game is over after goal rounds; the player with the most points wins.
+
+A strategy is a function strategy(game, index, rng) returning the paddle player index plays next, an int from
+game.paddles[index]. Strategies are named in STRATEGIES, or as 'module:function' for strategies defined elsewhere.
+
+    python pyro_simulate.py [--games N] [--goal ROUNDS] [--workers N] [--seed N] STRATEGY [STRATEGY ...]
+
+e.g. python pyro_simulate.py --games 1000000 highest random counter
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import os
+import random
+import time
+
+from pyro_pyramid import score_round
+
+BATCH_SIZE = 10000  # games simulated by a worker process in one go
+
+
+class IllegalMove(ValueError):
+    """A player played a paddle it does not have."""
+    def __init__(self, message, index):
+        super().__init__(message)
+        self.index = index  # the player
+
+    def __reduce__(self):
+        # Raised in a worker process of simulate(), it is pickled to reach the caller
+        return IllegalMove, (str(self), self.index)
+
+
+class SimulatedGame:
+    """The state of a game played in memory."""
+    __slots__ = ('goal', 'round', 'paddles', 'scores', 'turns')
+
+    def __init__(self, num_players, goal):
+        self.goal = goal
+        self.round = 0  # number of rounds played
+        self.paddles = [(1 << goal) - 1] * num_players  # bitmask of the paddles left, bit n - 1 for paddle n
+        self.scores = [0] * num_players
+        self.turns = []  # the paddles played in every round
+
+    def play_round(self, turn):
+        """Play a round with the paddle of every player and score it.
+
+        :raise IllegalMove: A player played a paddle it does not have. The game is left half updated.
+        """
+        for index, paddle in enumerate(turn):
+            paddle_bit = 1 << (paddle - 1) if type(paddle) is int and paddle > 0 else 0
+            if not self.paddles[index] & paddle_bit:
+                raise IllegalMove('player {} does not have paddle {!r}'.format(index + 1, paddle), index)
+            self.paddles[index] ^= paddle_bit
+        for index, points in enumerate(score_round(turn)):
+            self.scores[index] += points
+        self.turns.append(turn)
+        self.round += 1
+
+    def is_over(self):
+        """Return True once goal rounds have been played."""
+        return self.round == self.goal
+
+
+# ----- Strategies ---------------------------
+
+def random_paddle(game, index, rng):
+    """Play any paddle left."""
+    paddles = game.paddles[index]
+    while True:  # Draw until a paddle left comes up, which is quicker than listing them all
+        paddle = rng.randrange(game.goal) + 1
+        if paddles >> (paddle - 1) & 1:
+            return paddle
+
+
+def highest_paddle(game, index, rng):
+    """Play the highest paddle left."""
+    return game.paddles[index].bit_length()
+
+
+def lowest_paddle(game, index, rng):
+    """Play the lowest paddle left."""
+    paddles = game.paddles[index]
+    return (paddles & -paddles).bit_length()
+
+
+def counter_paddle(game, index, rng):
+    """Play the lowest paddle that beats every paddle the opponents have left. Throw away the lowest paddle if
+    there is none."""
+    paddles = game.paddles[index]
+    best_opponent = max(p.bit_length() for i, p in enumerate(game.paddles) if i != index)
+    above = paddles >> best_opponent  # Bit 0 is paddle best_opponent + 1
+    if above:
+        return best_opponent + (above & -above).bit_length()
+    return (paddles & -paddles).bit_length()
+
+
+STRATEGIES = {
+    'random': random_paddle,
+    'highest': highest_paddle,
+    'lowest': lowest_paddle,
+    'counter': counter_paddle,
+}
+
+
+def find_strategy(name):
+    """Return the strategy function for a name in STRATEGIES or a 'module:function' name."""
+    if name in STRATEGIES:
+        return STRATEGIES[name]
+    module, _, function = name.partition(':')
+    if not function:
+        raise ValueError('Unknown strategy {}, use one of {} or module:function'.format(name, ', '.join(STRATEGIES)))
+    return getattr(importlib.import_module(module), function)
+
+
+# ----- Running games ---------------------------
+
+def play_game(goal, strategies, rng):
+    """Play one game to the end.
+
+    :param goal: Number of rounds
+    :param strategies: Strategy function of every player
+    :param rng: random.Random the strategies draw from
+    :return: The SimulatedGame played
+    :raise IllegalMove: A strategy chose a paddle its player does not have
+    """
+    game = SimulatedGame(len(strategies), goal)
+    while not game.is_over():
+        try:
+            game.play_round([strategy(game, index, rng) for index, strategy in enumerate(strategies)])
+        except IllegalMove as error:
+            raise IllegalMove('Strategy {}: {} in round {}'.format(
+                strategies[error.index].__name__, error, game.round + 1
+            ), error.index) from None
+    return game
+
+
+def play_batch(games, goal, strategy_names, seed):
+    """Play games games and return their statistics, see simulate(). Runs in a worker process."""
+    strategies = [find_strategy(name) for name in strategy_names]
+    rng = random.Random(seed)
+    num_players = len(strategies)
+    wins = [0] * num_players
+    draws = 0
+    total_scores = [0] * num_players
+    for _ in range(games):
+        scores = play_game(goal, strategies, rng).scores
+        best = max(scores)
+        winners = [index for index, score in enumerate(scores) if score == best]
+        if len(winners) == 1:
+            wins[winners[0]] += 1
+        else:
+            draws += 1
+        for index, score in enumerate(scores):
+            total_scores[index] += score
+    return {'games': games, 'wins': wins, 'draws': draws, 'total_scores': total_scores}
+
+
+def simulate(games, goal, strategy_names, workers=None, seed=0, batch_size=BATCH_SIZE):
+    """Play games games between the given strategies on a process pool.
+
+    :param games: Number of games to play
+    :param goal: Number of rounds per game
+    :param strategy_names: Strategy of every player, see find_strategy()
+    :param workers: Number of worker processes, the number of CPUs if None. 0 plays in this process.
+    :param seed: Seed of the random numbers. Batch n uses seed + n, so results do not depend on the worker count.
+    :return: dict with the number of games, seconds, games_per_second, and per player wins, win_rate and mean_score,
+        plus the number of draws: games where several players had the best score
+    """
+    for name in strategy_names:
+        find_strategy(name)  # Fail early on unknown names
+    batches = [
+        (min(batch_size, games - start), goal, list(strategy_names), seed + number)
+        for number, start in enumerate(range(0, games, batch_size))
+    ]
+
+    started = time.perf_counter()
+    if workers == 0:
+        results = [play_batch(*batch) for batch in batches]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers or os.cpu_count()) as executor:
+            results = list(executor.map(play_batch, *zip(*batches))) if batches else []
+    seconds = time.perf_counter() - started
+
+    num_players = len(strategy_names)
+    wins = [sum(result['wins'][index] for result in results) for index in range(num_players)]
+    total_scores = [sum(result['total_scores'][index] for result in results) for index in range(num_players)]
+    return {
+        'games': games,
+        'seconds': seconds,
+        'games_per_second': games / seconds if seconds else 0.0,
+        'strategies': list(strategy_names),
+        'wins': wins,
+        'win_rate': [count / games if games else 0.0 for count in wins],
+        'mean_score': [total / games if games else 0.0 for total in total_scores],
+        'draws': sum(result['draws'] for result in results),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Simulate Pyramid games between bots.')
+    parser.add_argument('strategies', nargs='+', metavar='STRATEGY',
+                        help='strategy of every player: {} or module:function'.format(', '.join(STRATEGIES)))
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--goal', type=int, default=7, help='rounds per game')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, 0 for none (default: CPUs)')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(args)
+    if len(options.strategies) < 2:
+        parser.error('a game needs at least 2 players')
+
+    result = simulate(options.games, options.goal, options.strategies, options.workers, options.seed)
+    print('{games} games of {goal} rounds in {seconds:.2f} s, {games_per_second:.0f} games/s'.format(
+        goal=options.goal, **result
+    ))
+    for index, name in enumerate(result['strategies']):
+        print('player {} {:<12} wins {:6.2%}  mean score {:.2f}'.format(
+            index + 1, name, result['win_rate'][index], result['mean_score'][index]
+        ))
+    print('draws {:6.2%}'.format(result['draws'] / result['games'] if result['games'] else 0.0))
+
+
+if __name__ == '__main__':
+    main()
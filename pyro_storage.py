@@ -0,0 +1,440 @@
+"""
+Storage interface of the game.
+
+Storage lists every operation the web app and the game classes need from a database. Game and its subclasses keep
+the rules and the state of one game in memory and save their changes through the Storage object they were loaded
+from, so they never see SQL. Two implementations exist:
+
+- pyro_db_sqlite.DB stores everything in SQLite. This is what the server uses.
+- pyro_db_memory.MemoryDB keeps everything in dicts, for benchmarks, simulations and tests that should not touch
+  the disk.
+
+A Storage object is opened for one request (or one job) and closed when done, with close() or a with block. It
+is used by one thread at a time.
+"""
+
+import abc
+
+from pyro_changes import bus, game_key, user_key, LOBBY
+from pyro_metrics import timed
+
+MOVE_ATTEMPTS = 5  # tries at saving a move while other requests change the same game
+
+# Tables that can be dumped: name -> (key columns, all columns). The key columns come first.
+DUMP_TABLES = {
+    'user': (['name'], ['name', 'password']),
+    'game': (['rowid'], ['rowid', 'players', 'goal', 'state', 'ts', 'round', 'gamepaddles', 'version']),
+    'player': (['rowid'], ['rowid', 'game_id', 'user_name', 'score', 'playing', 'paddles']),
+    'move': (['game_id', 'round', 'player'], ['game_id', 'round', 'player', 'paddle']),
+    'archived_game': (
+        ['game_id'], ['game_id', 'players', 'goal', 'state', 'ts', 'round', 'gamepaddles', 'version']
+    ),
+    'archived_player': (
+        ['game_id', 'position'], ['game_id', 'position', 'user_name', 'score', 'playing', 'paddles']
+    ),
+    'archived_move': (['game_id', 'round', 'player'], ['game_id', 'round', 'player', 'paddle']),
+    'user_stats': (['user_name'], ['user_name', 'games', 'wins', 'points']),
+}
+
+
+def paddle_numbers(paddles):
+    """Return the numbers of the paddles in a bitmask, lowest first."""
+    numbers = []
+    while paddles:
+        lowest = paddles & -paddles
+        numbers.append(lowest.bit_length())
+        paddles ^= lowest
+    return numbers
+
+
+class ConcurrentUpdate(Exception):
+    """The game was changed by another request after it was loaded, so a change to it was not saved."""
+
+
+class Storage(abc.ABC):
+    """Everything the game stores: users, games, their players and moves."""
+
+    def close(self):
+        """Release what this object holds, e.g. a pooled connection."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # ----- Users ---------------------------
+
+    @abc.abstractmethod
+    def user_pass_valid(self, username, password):
+        """Return True if the user exists and has this password."""
+
+    @abc.abstractmethod
+    def add_username(self, username, password):
+        """Register a new user. Return False if the name is taken."""
+
+    # ----- Reading games ---------------------------
+
+    @abc.abstractmethod
+    def get_game_by_id(self, game_id):
+        """Return (players, goal, state, ts, round, gamepaddles, version) of a game, or None if there is none."""
+
+    @abc.abstractmethod
+    def get_games_by_user(self, username):
+        """Return (game_id, players, goal, state, ts, round, gamepaddles) of the games the user plays, by id."""
+
+    @abc.abstractmethod
+    def get_registering_games_by_user(self, username):
+        """Return (game_id, players, goal, ts, round, gamepaddles) of the games accepting players that the user is
+        not in, newest first."""
+
+    @abc.abstractmethod
+    def get_players_by_games(self, game_ids):
+        """Return {game_id: [Player, ...]} with the players of every game in join order."""
+
+    @abc.abstractmethod
+    def get_last_turns_by_games(self, num_players):
+        """For {game_id: number of players}, return {game_id: [paddle or None, ...]} with the moves of the current
+        round of every game that has started a round."""
+
+    @abc.abstractmethod
+    def get_turns(self, game_id, rounds, num_players):
+        """Return rounds 1 to rounds of a game, each a list with the paddle of every player (None if not played).
+        Rounds started after the game was read are left out."""
+
+    @timed
+    def load_game(self, game_id, game_class):
+        """Return the game with the given id as a game_class object, or None if there is no such game."""
+        row = self.get_game_by_id(int(game_id))
+        if row is None:
+            return None
+        *row, row_version = row
+        return game_class(int(game_id), *row, self, row_version=row_version)
+
+    @timed
+    def get_lobby_games(self, username, game_class):
+        """Return everything the lobby page needs: the user's active games and the games the user can join, as
+        game_class objects. The players of all those games are loaded at once, and so are their current rounds."""
+        running = self.get_games_by_user(username)
+        registering = [
+            (i, p, g, 0, ts, r, gp) for i, p, g, ts, r, gp in self.get_registering_games_by_user(username)
+        ]
+        players = self.get_players_by_games([row[0] for row in running + registering])
+        # Registering games have not started a round yet
+        last_turns = self.get_last_turns_by_games({row[0]: len(players[row[0]]) for row in running if row[5]})
+        return (
+            [
+                game_class(*row, self, players=players[row[0]], last_turn=last_turns.get(row[0]))
+                for row in running
+            ],
+            [game_class(*row, self, players=players[row[0]]) for row in registering],
+        )
+
+    # ----- Changing games ---------------------------
+
+    @abc.abstractmethod
+    def new_game(self, players, goal, username):
+        """Create a game for players players and goal rounds, with username as its first player."""
+
+    @abc.abstractmethod
+    def join_game(self, game_id, username):
+        """Add a player to a game accepting players. The game starts when it is full."""
+
+    @abc.abstractmethod
+    def quit_game(self, game_id, username):
+        """Take a player out of a game. A game still accepting players is deleted when its last player quits."""
+
+    @abc.abstractmethod
+    def clear_tables(self, clear_all):
+        """Delete all games and the statistics of the users, and all users too if clear_all."""
+
+    # ----- Archive ---------------------------
+
+    @abc.abstractmethod
+    def archive_games(self, before, limit):
+        """Move up to limit finished games, oldest first, whose last change was before a time to the archive, in
+        one transaction. They disappear from the lobby, but can still be viewed, see load_archived_game(). Tells the
+        change bus of this process, so the lobby pages of their players reload.
+
+        :param before: UTC time as 'YYYY-MM-DD HH:MM:SS', like the ts of a game
+        :return: The number of games archived. Fewer than limit once no more games are due.
+        """
+
+    @abc.abstractmethod
+    def archive_version(self):
+        """Return a number bumped by every archive_games() call that moved games, in any process. Part of the lobby
+        ETag, because an archive job in another process does not reach the change bus."""
+
+    @abc.abstractmethod
+    def get_archived_games_by_user(self, username, before=None, limit=None):
+        """Return (game_id, goal, ts, [Player, ...]) of archived games the user played, newest first.
+
+        :param before: Only games with a lower id (keyset pagination)
+        :param limit: Most games to return
+        """
+
+    @abc.abstractmethod
+    def load_archived_game(self, game_id, game_class):
+        """Return an archived game as a game_class object with all its players and moves, or None if there is no
+        such game in the archive. The game is over, so it cannot be changed."""
+
+    # ----- Leaderboard ---------------------------
+
+    @abc.abstractmethod
+    def get_leaderboard(self, limit):
+        """Return (rank, user name, games, wins, points) of the limit best users. Users are ranked by wins, then
+        points, over all their finished games. Users with the same wins and points share a rank."""
+
+    @abc.abstractmethod
+    def get_user_rank(self, username):
+        """Return (rank, games, wins, points) of a user like get_leaderboard(), or None if the user has not finished
+        any game."""
+
+    # ----- Saving a move, for Game ---------------------------
+
+    @abc.abstractmethod
+    def begin_move(self, game):
+        """Start saving a move. Nothing is stored until save_game_state().
+
+        Raises ConcurrentUpdate if the game cannot be saved now, e.g. because other processes keep it locked.
+        """
+
+    @abc.abstractmethod
+    def save_player_paddles(self, game, index, paddles):
+        """Save the paddles player index has left."""
+
+    @abc.abstractmethod
+    def save_move(self, game, index, paddle):
+        """Save a paddle played by player index in the current round."""
+
+    @abc.abstractmethod
+    def save_scores(self, game, indexes):
+        """Save the scores of the players at indexes."""
+
+    @abc.abstractmethod
+    def save_game_over(self, game):
+        """Add the game, which just ended, to the statistics of its players (see get_leaderboard): one more game,
+        its score as points, and a win for everybody with the highest score."""
+
+    @abc.abstractmethod
+    def save_game_state(self, game):
+        """Save state and round of the game and everything since begin_move(), if the game's version is still
+        game.row_version.
+
+        :return: (ts, version) of the game as saved
+        :raise ConcurrentUpdate: The game changed after it was loaded; nothing was saved
+        """
+
+    # ----- Changes and exports ---------------------------
+
+    # Versions of the games on the user's lobby page and of the list of games accepting players.
+    # They are kept in memory by the change bus and bumped by every write, so polling costs no storage access.
+    def updated_games(self, username):
+        return bus.version(user_key(username)), bus.version(LOBBY)
+
+    # Version of a game, bumped by every write to the game or its players.
+    def updated_game(self, game_id):
+        return bus.version(game_key(game_id))
+
+    def publish_game_change(self, game_id, *keys):
+        """Tell the change bus that a game changed. Wakes up the game page and the lobby page of every player in
+        the game, plus whatever other keys are given.
+
+        :return: The new version of the game
+        """
+        game_id = int(game_id)
+        players = self.get_players_by_games([game_id])[game_id]
+        return bus.publish(game_key(game_id), *[user_key(player.name) for player in players], *keys)
+
+    @abc.abstractmethod
+    def dump_table(self, table, after=None, limit=None, batch_size=500):
+        """Yield the rows of one of the DUMP_TABLES in key order, sets of paddles as space separated numbers.
+
+        :param after: Key of the last row already seen (keyset pagination)
+        :param limit: Most rows to yield
+        """
+
+
+class Player:
+    """One player in a game."""
+    __slots__ = ('name', 'score', 'playing', 'paddles')
+
+    def __init__(self, name, score, playing, paddles):
+        self.name = name
+        self.score = score
+        self.playing = playing  # 1 while in the game, 0 after quitting
+        self.paddles = paddles  # bitmask of the paddles not played yet, bit n - 1 for paddle n
+
+    def __repr__(self):
+        return 'Player(name={!r}, score={!r}, playing={!r}, paddles={!r})'.format(
+            self.name, self.score, self.playing, self.paddles
+        )
+
+
+class Game:
+    """Base functionality for game classes.
+
+    Games are kept in memory by the thousand (see pyro_cache), so they and their players use __slots__.
+    Subclasses should declare __slots__ as well.
+    """
+    __slots__ = (
+        'id', 'num_players', 'goal', 'state', 'ts', 'round', 'gamepaddles', 'row_version', 'db', 'players',
+        'cache', 'version', '_turns', '_last_turn', '_player_indexes'
+    )
+
+    def __init__(self, game_id, num_players, goal, state, ts, round, gamepaddles, db, players=None,
+                 last_turn=None, turns=None, row_version=None):
+        """Initialize game object with state and load players and scores from storage.
+
+        The moves are loaded when they are first used: last_turn reads the current round only, turns reads the
+        whole history.
+
+        :param db: The Storage the game was read from, and is saved to
+        :param players: Players already loaded by Storage.get_players_by_games(). Skips loading them.
+        :param last_turn: Current round already loaded by Storage.get_last_turns_by_games(). Skips loading it.
+        :param turns: All rounds, e.g. from the game cache. Skips loading them.
+        :param row_version: The version of the stored game. Needed to save moves, see save_game_state().
+        """
+        self.id = game_id
+        self.num_players = num_players
+        self.goal = goal    # number of rounds
+        self.state = state  # 0={Registering players}, 1={Game on}, 2={Game over}
+        self.ts = ts
+        self.round = round  # number of rounds started
+        self.gamepaddles = gamepaddles  # bitmask of the paddles every player starts with
+        self.row_version = row_version
+        self._turns = turns
+        self._last_turn = turns[-1] if turns else last_turn
+        # Set by DB.load_game(): the game cache and the version of the game on the change bus it was loaded at
+        self.cache = None
+        self.version = None
+        self._player_indexes = None  # name -> position in players, built on first use
+
+        self.db = db
+        if players is not None:
+            self.players = players
+            return
+        self.players = db.get_players_by_games([game_id])[game_id]
+
+    @property
+    def turns(self):
+        """All rounds of the game, each a list with the paddle of every player (None if not played yet)."""
+        if self._turns is None:
+            self._turns = self.db.get_turns(self.id, self.round, len(self.players))
+            self._last_turn = self._turns[-1] if self._turns else None
+        return self._turns
+
+    @property
+    def last_turn(self):
+        """The current round, a list with the paddle of every player (None if not played yet), or None."""
+        if self._last_turn is None and self.round:
+            self._last_turn = self.db.get_last_turns_by_games({self.id: len(self.players)}).get(
+                self.id, [None] * len(self.players)
+            )
+        return self._last_turn
+
+    def snapshot(self):
+        """Return the state of the game as an immutable tuple for the game cache (see pyro_cache)."""
+        return (
+            self.num_players, self.goal, self.state, self.ts, self.round, self.gamepaddles, self.row_version,
+            tuple((p.name, p.score, p.playing, p.paddles) for p in self.players),
+            tuple(tuple(turn) for turn in self.turns)
+        )
+
+    @timed
+    def reload(self):
+        """Read the game again from storage, dropping all changes made in memory.
+
+        :return: False if the game no longer exists
+        """
+        if self.cache is not None:
+            self.cache.discard(self.id)
+            self.version = bus.version(game_key(self.id))  # Read before the game, like DB.load_game()
+        row = self.db.get_game_by_id(self.id)
+        if row is None:
+            return False
+        _, _, self.state, self.ts, self.round, _, self.row_version = row
+        self._turns = self._last_turn = self._player_indexes = None
+        self.players = self.db.get_players_by_games([self.id])[self.id]
+        return True
+
+    def start_turn(self):
+        """Start a new round and return it."""
+        new_turn = [None] * len(self.players)
+        if self._turns is not None:
+            self._turns.append(new_turn)
+        self._last_turn = new_turn
+        self.round += 1
+        return new_turn
+
+    def player_index(self, username):
+        """Return player's index in player list
+
+        :param username: Name of the user to find index for
+        :return: int
+        """
+        if self._player_indexes is None:
+            self._player_indexes = {player.name: index for index, player in enumerate(self.players)}
+        try:
+            return self._player_indexes[username]
+        except KeyError:
+            raise ValueError('{} is not a player in game {}'.format(username, self.id)) from None
+
+    # scoring for the game.
+    def begin_move(self):
+        """Start saving a move, up to save_game_state().
+
+        Raises ConcurrentUpdate if the game cannot be saved now: it has to be read again.
+        """
+        self.db.begin_move(self)
+
+    def save_scores(self, indexes):
+        """Save the scores of some players, in one batch.
+
+        :param indexes: Positions of the players in Game's player list
+        """
+        self.db.save_scores(self, indexes)
+        # Stored by save_game_state()
+
+    def update_player_paddles(self, index, new_paddles):
+        """ Update the value of the players paddles to remove a paddle played
+
+        :param index: Position of player in Game's player list
+        :param new_paddles: Bitmask of the paddles the player has left
+        """
+        self.db.save_player_paddles(self, index, new_paddles)
+        self.players[index].paddles = new_paddles
+
+    def save_move(self, index, paddle):
+        """Save a paddle played in the current round.
+
+        :param index: Position of player in Game's player list
+        :param paddle: The value of the paddle played
+        """
+        self.db.save_move(self, index, paddle)
+        # Stored by save_game_state()
+
+    def set_game_over(self):
+        """Set game status to game over, and add the game to the statistics of its players."""
+        self.state = 2  # Game over
+        self.db.save_game_over(self)
+        # Written by save_game_state()
+
+    def save_game_state(self):
+        """Save game state to storage, and to the game cache if the game came from DB.load_game().
+
+        Compare and swap: the game is only saved if its stored version is still row_version. Otherwise another
+        request changed it after it was loaded, so nothing is saved and ConcurrentUpdate raised. reload() the game
+        and try again.
+        """
+        self.ts, self.row_version = self.db.save_game_state(self)
+        keys = [user_key(p.name) for p in self.players]
+        if self.cache is None:
+            bus.publish(game_key(self.id), *keys)
+            return
+        self.version = bus.publish_from(self.version, game_key(self.id), *keys)
+        if self.version is None or self._turns is None:
+            # Another request changed the game after it was loaded, so this object does not hold all of it
+            self.cache.discard(self.id)
+        else:
+            self.cache.put(self.id, self.version, self.snapshot())
@@ -0,0 +1,299 @@
+"""
+Page templates.
+
+Every page fragment is compiled once, when the module is imported: its static text is split from its {fields} and
+encoded to bytes up front. Rendering fills in the fields and yields byte chunks, so a page is never built as one big
+string. pyro_app returns the chunks to the WSGI server through buffered(), which streams them in blocks of a few KiB.
+
+A field value can be a str, bytes, a number, or an iterable of such values, e.g. another rendered template.
+Fields are named like in str.format(): {0} is the first positional value, {name} a keyword value. Format specs and
+conversions are not supported.
+"""
+
+import string
+
+BUFFER_SIZE = 8192  # bytes per block handed to the WSGI server
+
+
+def chunks(value):
+    """Yield value as byte chunks. Iterables are flattened, so their items can be any kind of value too."""
+    if isinstance(value, bytes):
+        yield value
+    elif isinstance(value, str):
+        yield value.encode()
+    elif hasattr(value, '__iter__'):
+        for item in value:
+            yield from chunks(item)
+    else:
+        yield str(value).encode()
+
+
+class Template:
+    """A text fragment with {fields}, compiled to bytes once."""
+    def __init__(self, text):
+        self.parts = []  # (static bytes, field name or None)
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if spec or conversion:
+                raise ValueError('Format specs and conversions are not supported: {}'.format(field))
+            if field is not None and field.isdigit():
+                field = int(field)
+            self.parts.append((literal.encode(), field))
+
+    def render(self, *args, **values):
+        """Yield the fragment as byte chunks, with each field replaced by its value."""
+        for literal, field in self.parts:
+            if literal:
+                yield literal
+            if field is None:
+                continue
+            yield from chunks(args[field] if isinstance(field, int) else values[field])
+
+    def render_rows(self, rows):
+        """Yield the fragment once for every row, a tuple of positional values."""
+        for row in rows:
+            yield from self.render(*row)
+
+
+def buffered(chunks, size=BUFFER_SIZE):
+    """Join small chunks into blocks of about size bytes, so the server is not called for every table cell."""
+    block = []
+    length = 0
+    for chunk in chunks:
+        block.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b''.join(block)
+            block = []
+            length = 0
+    if block:
+        yield b''.join(block)
+
+
+class Response:
+    """WSGI response body that calls on_close once the server is done with it."""
+    def __init__(self, chunks, on_close):
+        self.chunks = chunks
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            self.on_close()
+
+
+# ----- The common start and end of every page ---------------------------
+
+HEADER = '''<!DOCTYPE html>
+<html><head><title>Game</title>
+<style>
+    table { border-collapse: collapse; }
+    table, th, td { border: 1px solid silver; padding: 2px; }
+</style>
+</head>
+<body>
+<h1>Pyromid</h1>'''.encode()
+
+FOOTER = b'</body></html>'
+
+
+def page(*body):
+    """Yield a whole page: the header, each part of body (see chunks()), and the footer."""
+    yield HEADER
+    for part in body:
+        yield from chunks(part)
+    yield FOOTER
+
+
+# ----- Logging in and registering ---------------------------
+
+LOGIN_REGISTER_FORM = Template('''
+<form>
+    <input type="text" name="username"> Username<br>
+    <input type="password" name="password"> Password<br>
+    <input type="submit" name="do" value="Login"> or
+    <input type="submit" name="do" value="Register">
+</form>''')
+
+# ----- Root page -----------------------------------------
+
+LOBBY = Template('''{user} | <a href="{app_root}/logout">Logout</a> | <a href="{app_root}">Refresh</a>
+ | <a href="{app_root}/history">Old games</a> | <a href="{app_root}/leaderboard">Leaderboard</a>
+<h2>My games</h2>
+<table><tr><th>Game</th><th>Goal</th><th>Quit</th><th>State</th><th>Players</th></tr>
+{games}</table><p><a href="{app_root}/newgame">Start a New Game</a></p><h2>Games accepting players</h2>
+<table><tr><th>Game</th><th>Goal</th><th>Join</th><th>State</th><th>Players</th></tr>
+{registering_games}</table>
+<script>
+    function callback(event) {{
+        if (event.target.readyState == 4 && event.target.responseText != '{versions}') {{
+            window.location = '{app_root}'
+        }}
+    }}
+    function timeFunc(event) {{
+        var xmlhttp = new XMLHttpRequest();
+        xmlhttp.addEventListener("readystatechange", callback)
+        xmlhttp.open("GET", "{app_root}/updated_games", true)
+        xmlhttp.setRequestHeader("Content-Type", "text/plain")
+        xmlhttp.send()
+    }}
+    function waitFunc() {{
+        // Wait for the server to push a change. Fall back to polling every second if it cannot.
+        var xmlhttp = new XMLHttpRequest();
+        xmlhttp.addEventListener("load", function (event) {{
+            if (event.target.status == 200 && event.target.responseText == 'changed') {{
+                window.location = '{app_root}'
+            }} else if (event.target.status == 200 && event.target.responseText == 'timeout') {{
+                waitFunc()
+            }} else {{
+                setInterval(timeFunc, 1000)
+            }}
+        }})
+        xmlhttp.addEventListener("error", function (event) {{ setInterval(timeFunc, 1000) }})
+        xmlhttp.open("GET", "{app_root}/wait_games?since={since}", true)
+        xmlhttp.send()
+    }}
+    waitFunc()
+</script>''')
+
+LOBBY_GAME = Template(
+    '<tr><td>{id}</td><td>{goal}</td><td><a href="{app_root}/quit?id={id}">quit</a></td>{state}<td>{players}</td></tr>\n'
+)
+LOBBY_GAME_AWAITING = Template('<td>Awaiting {missing}</td>')
+LOBBY_GAME_LINK = Template('<td><a href="{app_root}/game?id={id}">{text}</a></td>')
+
+LOBBY_REGISTERING_GAME = Template(
+    '<tr><td>{id}</td><td>{goal}</td><td><a href="{app_root}/join?id={id}">join</a></td>'
+    '<td>{joined} of {num_players} players</td><td>{players}</td></tr>\n'
+)
+
+# ----- Archived games ----------------------------------------------------------------
+
+HISTORY = Template('''<a href="{app_root}">Home</a><h2>Old games</h2>
+<table><tr><th>Game</th><th>Goal</th><th>Ended</th><th>Players</th></tr>
+{games}</table>{next}''')
+HISTORY_GAME = Template(
+    '<tr><td><a href="{app_root}/game?id={id}">{id}</a></td><td>{goal}</td><td>{ts}</td><td>{players}</td></tr>\n'
+)
+HISTORY_NEXT = Template('<p><a href="{app_root}/history?before={before}">Older games</a></p>')
+
+# ----- Leaderboard ----------------------------------------------------------------
+
+LEADERBOARD = Template('''<a href="{app_root}">Home</a><h2>Leaderboard</h2>{rank}
+<table><tr><th>Rank</th><th>Player</th><th>Games</th><th>Wins</th><th>Points</th></tr>
+{rows}</table>
+<form action="{app_root}/leaderboard"><p>Rank of <input name="user"> <input type="submit" value="Look up"></p></form>''')
+LEADERBOARD_ROW = Template('<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td></tr>\n')
+LEADERBOARD_RANK = Template('<p>{user}: rank {rank}, {wins} wins and {points} points in {games} games</p>')
+LEADERBOARD_UNRANKED = Template('<p>{user} has not finished a game yet</p>')
+
+# ----- Register new game ---------------------------------------------------------------
+
+NEW_GAME_FORM = Template('''
+<h2>Create a New Game</h2>
+<form>
+    <h3>How many players?</h3>
+    <input type="number" name="numplayers" min="2">
+    <h3>Play until round:</h3>
+    <input type="number" name="goal" min="1" max="{max_goal}" value="7"><br>
+    <br>
+    <input type="submit" value="Create">
+</form>
+''')
+
+# ----- Game ------------------------------------------------------------
+
+GAME = Template('''<a href="{app_root}">Home</a> | <a href="{app_root}/game?id={id}">Refresh</a><h3>Game {id} -- Playing {goal} rounds</h3>{status}<table>
+<tr><th>&nbsp;</th>{names}</tr>
+<tr style="background-color: silver"><td>Round</td>{scores}</tr>
+{turns}</table>{script}''')
+
+GAME_MOVE = Template('<a href="{app_root}/game?id={id}&amp;move={move}">{move}</a>')
+GAME_NAME = Template('<th>{name}</th>')
+GAME_NAME_QUIT = Template('<th><s>{name}</s></th>')
+GAME_SCORE = Template('<td>{score} p</td>')
+GAME_TURN = Template('<tr><td>{round}</td>{moves}</tr>\n')
+GAME_MOVE_PLAYED = Template('<td>{move}</td>')
+GAME_MOVE_WINNER = Template('<td style="background-color:lightgreen">{move}</td>')
+
+GAME_SCRIPT = Template('''
+<script>
+    function callback(event) {{
+        if (event.target.readyState == 4 && event.target.responseText != '{version}') {{
+            window.location = '{app_root}/game?id={id}'
+        }}
+    }}
+    function timeFunc(event) {{
+        var xmlhttp = new XMLHttpRequest();
+        xmlhttp.addEventListener("readystatechange", callback)
+        xmlhttp.open("GET", "{app_root}/updated_game?id={id}", true)
+        xmlhttp.setRequestHeader("Content-Type", "text/plain")
+        xmlhttp.send()
+    }}
+    function waitFunc() {{
+        // Wait for the server to push a change. Fall back to polling every second if it cannot.
+        var xmlhttp = new XMLHttpRequest();
+        xmlhttp.addEventListener("load", function (event) {{
+            if (event.target.status == 200 && event.target.responseText == 'changed') {{
+                window.location = '{app_root}/game?id={id}'
+            }} else if (event.target.status == 200 && event.target.responseText == 'timeout') {{
+                waitFunc()
+            }} else {{
+                setInterval(timeFunc, 1000)
+            }}
+        }})
+        xmlhttp.addEventListener("error", function (event) {{ setInterval(timeFunc, 1000) }})
+        xmlhttp.open("GET", "{app_root}/wait_game?id={id}&since={since}", true)
+        xmlhttp.send()
+    }}
+    waitFunc()
+</script>''')
+
+# ----- Dump tables ------------------------------------------------
+
+DUMP = Template(
+    '<a href="{app_root}">Home</a> | <a href="{app_root}/clear_games">Clear games and players</a>'
+    ' | <a href="{app_root}/clear_all">Clear all</a>'
+    ' | Export <a href="{app_root}/dump?format=ndjson">NDJSON</a>{csv_links}{tables}'
+)
+DUMP_CSV_LINK = Template(' | <a href="{app_root}/dump?format=csv&amp;table={table}">{table}.csv</a>')
+
+DUMP_TABLE = Template('''<h2>Table "{table}"</h2>
+<p>{description}</p>
+<table><tr>{headings}</tr>
+''')
+DUMP_TABLE_END = b'</table>\n'
+DUMP_HEADING = Template('<th>{0}</th>')
+DUMP_NEXT = Template('<p><a href="{app_root}/dump?table={table}&amp;after={after}&amp;limit={limit}">Next {limit} rows</a></p>\n')
+
+DUMP_DESCRIPTIONS = {
+    'user': 'Contains all registered users and their passwords.',
+    'game': 'One row for every game.',
+    'player': 'Connects players with games. One row for every player in a game.',
+    'move': 'One row for every paddle played. player is the position of the player in the game.',
+    'archived_game': 'Finished games moved out of game by pyro_archive.py, under the id they had.',
+    'archived_player': 'The players of the archived games. position is the place of the player in join order.',
+    'archived_move': 'The paddles played in the archived games.',
+    'user_stats': 'Totals of the finished games of every user, for the leaderboard.',
+}
+
+DUMP_ROWS = {
+    'user': Template('<tr><td>{0}</td><td>{1}</td></tr>\n'),
+    'game': Template(
+        '<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td><td>{6}</td><td>{7}</td></tr>\n'
+    ),
+    'player': Template('<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td></tr>\n'),
+    'move': Template('<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td></tr>\n'),
+    'archived_game': Template(
+        '<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td><td>{6}</td><td>{7}</td></tr>\n'
+    ),
+    'archived_player': Template(
+        '<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td><td>{5}</td></tr>\n'
+    ),
+    'archived_move': Template('<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td></tr>\n'),
+    'user_stats': Template('<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td></tr>\n'),
+}